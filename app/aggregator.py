@@ -1,8 +1,122 @@
 from datetime import datetime, timedelta
-from typing import List, Tuple, Dict
+from typing import Callable, Iterable, List, Tuple, Dict, Optional, Sequence, Union
+import numpy as np
+
+from minute_series import MinuteSeries
+from units import UnitScale
+
+MINUTE = timedelta(minutes=1)
+
+# Recibe posiciones (minutos relativos al inicio) y devuelve las sumas y
+# conteos de minutos válidos acumulados hasta cada una (exclusivo).
+PrefixLookup = Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]]
+
+def _minutes_in_range(from_dt: datetime, to_dt: datetime) -> int:
+    """Cantidad de minutos que empiezan dentro de [from_dt, to_dt)."""
+    return -(-(to_dt - from_dt) // MINUTE)
+
+def _prefix_sums(
+    values: np.ndarray,
+    minutes: int,
+    valid: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sumas y conteos acumulados (con un 0 inicial) de los primeros `minutes`
+    valores. Lo que falte al final de `values` cuenta como minuto ausente,
+    igual que lo enmascarado si values es un np.ma.MaskedArray.
+    """
+    if valid is None and isinstance(values, np.ma.MaskedArray):
+        valid = ~np.ma.getmaskarray(values)
+        values = values.data
+    available = min(len(values), minutes)
+
+    padded_values = np.zeros(minutes, dtype=np.int64)
+    padded_valid = np.zeros(minutes, dtype=bool)
+    padded_values[:available] = values[:available]
+    padded_valid[:available] = True if valid is None else valid[:available]
+    padded_values[~padded_valid] = 0
+
+    sums = np.zeros(minutes + 1, dtype=np.int64)
+    counts = np.zeros(minutes + 1, dtype=np.int64)
+    np.cumsum(padded_values, out=sums[1:])
+    np.cumsum(padded_valid, out=counts[1:])
+    return sums, counts
+
+def aggregate_windows(
+    values: np.ndarray,
+    windows: Sequence[int],
+    from_dt: datetime,
+    to_dt: datetime,
+    valid: Optional[np.ndarray] = None,
+    block_ranges: Optional[Dict[int, Tuple[int, int]]] = None,
+    scale: Optional[UnitScale] = None
+) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Promedia la serie minuto a minuto (values[i] corresponde a from_dt + i
+    minutos) para todas las ventanas pedidas en una sola pasada.
+
+    Devuelve {ventana: (offsets, promedios)}, donde offsets es el minuto de
+    inicio de cada bloque relativo a from_dt. Igual que aggregate_by_window:
+    el último bloque puede quedar incompleto y los bloques sin ningún minuto
+    válido se omiten.
+
+    block_ranges permite acotar cada ventana a su propio tramo [desde, hasta)
+    en minutos relativos a from_dt (por defecto, todo el rango); los bloques
+    se alinean al inicio de ese tramo.
+
+    Con scale (units.unit_scale) los promedios salen ya convertidos de
+    l/min a la unidad de destino, sobre el array de cada ventana.
+    """
+    minutes = _minutes_in_range(from_dt, to_dt) if from_dt < to_dt else 0
+    sums, counts = _prefix_sums(values, minutes, valid)
+    return aggregate_windows_from_prefix(
+        lambda positions: (sums[positions], counts[positions]),
+        windows, from_dt, to_dt, block_ranges, scale
+    )
+
+def aggregate_windows_from_prefix(
+    prefix_at: PrefixLookup,
+    windows: Sequence[int],
+    from_dt: datetime,
+    to_dt: datetime,
+    block_ranges: Optional[Dict[int, Tuple[int, int]]] = None,
+    scale: Optional[UnitScale] = None
+) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Igual que aggregate_windows, pero a partir de sumas acumuladas ya
+    calculadas (p. ej. el índice .idx de blob_store.py): sólo se consultan
+    los bordes de cada bloque, así que el costo no depende del largo de la
+    ventana sino de la cantidad de bloques.
+    """
+    result: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+    minutes = _minutes_in_range(from_dt, to_dt) if from_dt < to_dt else 0
+
+    for window_minutes in windows:
+        if window_minutes <= 0 or minutes <= 0:
+            result[window_minutes] = (np.empty(0, dtype=np.int64), np.empty(0))
+            continue
+
+        range_start, range_end = (block_ranges or {}).get(window_minutes, (0, minutes))
+        range_start, range_end = max(range_start, 0), min(range_end, minutes)
+
+        block_starts = np.arange(range_start, range_end, window_minutes, dtype=np.int64)
+        block_ends = np.minimum(block_starts + window_minutes, range_end)
+        start_sums, start_counts = prefix_at(block_starts)
+        end_sums, end_counts = prefix_at(block_ends)
+        block_counts = end_counts - start_counts
+        block_sums = end_sums - start_sums
+
+        has_data = block_counts > 0
+        averages = block_sums[has_data] / block_counts[has_data]
+        result[window_minutes] = (
+            block_starts[has_data],
+            scale.apply(averages) if scale is not None else averages,
+        )
+
+    return result
 
 def aggregate_by_window(
-    raw_series: List[Tuple[datetime, int]],
+    raw_series: Union[MinuteSeries, Iterable[Tuple[datetime, int]]],
     window_minutes: int,
     from_dt: datetime,
     to_dt: datetime
@@ -10,38 +124,38 @@ def aggregate_by_window(
     """
     Promedio la serie minuto a minuto en bloques consecutivos de window_minutes,
     y etiqueto cada promedio con la hora real de inicio del bloque.
+    Con una MinuteSeries no se recorre minuto a minuto: se copia el tramo.
     """
     if window_minutes <= 0 or from_dt >= to_dt:
         return []
 
-    # Convierto la serie a un diccionario para acceder por timestamp en O(1).
-    series_by_timestamp: Dict[datetime, int] = {
-        timestamp: value for timestamp, value in raw_series
-    }
-
-    aggregated_series: List[Tuple[datetime, float]] = []
-    block_start_time = from_dt
-
-    while block_start_time < to_dt:
-        block_values: List[int] = []
-
-        # Recorro los minutos que forman el bloque actual.
-        for minute_offset in range(window_minutes):
-            current_time = block_start_time + timedelta(minutes=minute_offset)
-            if current_time >= to_dt:
-                break
-
-            # El blob no debe tener huecos, pero lo dejo robusto igual.
-            value = series_by_timestamp.get(current_time)
-            if value is not None:
-                block_values.append(value)
-
-        if block_values:
-            block_average = sum(block_values) / len(block_values)
-            aggregated_series.append((block_start_time, block_average))
+    minutes = _minutes_in_range(from_dt, to_dt)
+    if isinstance(raw_series, MinuteSeries):
+        values, valid = raw_series.aligned(from_dt, minutes)
+        return _label_blocks(aggregate_windows(
+            values, [window_minutes], from_dt, to_dt, valid=valid
+        )[window_minutes], from_dt)
 
-        # Paso al siguiente bloque.
-        block_start_time += timedelta(minutes=window_minutes)
+    # Paso la lista de tuplas a un array por minuto; los minutos que no
+    # aparecen en la serie quedan marcados como no válidos.
+    values = np.zeros(minutes, dtype=np.int64)
+    valid = np.zeros(minutes, dtype=bool)
+    for timestamp, value in raw_series:
+        offset = timestamp - from_dt
+        if offset < timedelta(0) or offset % MINUTE:
+            continue
+        index = offset // MINUTE
+        if index < minutes:
+            values[index] = value
+            valid[index] = True
 
-    return aggregated_series
+    return _label_blocks(aggregate_windows(
+        values, [window_minutes], from_dt, to_dt, valid=valid
+    )[window_minutes], from_dt)
 
+def _label_blocks(blocks: Tuple[np.ndarray, np.ndarray], from_dt: datetime) -> List[Tuple[datetime, float]]:
+    offsets, averages = blocks
+    return [
+        (from_dt + timedelta(minutes=offset), average)
+        for offset, average in zip(offsets.tolist(), averages.tolist())
+    ]
@@ -0,0 +1,113 @@
+# /opt/aqua104/app/asdu_packer.py
+from typing import Callable, Iterator, List, NamedTuple, Sequence, TypeVar
+
+# --- límites del protocolo (IEC 60870-5-104) ---
+
+# El campo longitud del APCI admite como máximo 253 bytes (control + ASDU).
+MAX_APDU_LENGTH = 253
+APCI_CONTROL_SIZE = 4
+# VSQ: 7 bits para la cantidad de objetos/elementos.
+MAX_OBJECTS_PER_ASDU = 127
+# Type ID + VSQ
+ASDU_FIXED_HEADER_SIZE = 2
+
+# Bytes de cada elemento de información (sin la IOA), por tipo.
+ELEMENT_SIZES = {
+    "M_SP_NA_1": 1,   # SIQ
+    "M_ME_NA_1": 3,   # NVA + QDS
+    "M_ME_NB_1": 3,   # SVA + QDS
+    "M_ME_NC_1": 5,   # IEEE STD 754 + QDS
+    "M_ME_ND_1": 2,   # NVA sin calidad
+    "M_IT_NA_1": 5,   # BCR
+    "M_SP_TB_1": 8,   # SIQ + CP56Time2a
+    "M_ME_TD_1": 10,  # NVA + QDS + CP56Time2a
+    "M_ME_TE_1": 10,  # SVA + QDS + CP56Time2a
+    "M_ME_TF_1": 12,  # IEEE STD 754 + QDS + CP56Time2a
+    "M_IT_TB_1": 12,  # BCR + CP56Time2a
+}
+
+# Los tipos con marca de tiempo sólo se transmiten con SQ=0.
+TIME_TAGGED_TYPES = {"M_SP_TB_1", "M_ME_TD_1", "M_ME_TE_1", "M_ME_TF_1", "M_IT_TB_1"}
+
+# Largo mínimo de un tramo de IOAs contiguas para que convenga SQ=1
+# en lugar de seguir llenando el ASDU SQ=0 en curso.
+SEQUENCE_MIN_RUN = 8
+
+T = TypeVar("T")
+
+
+class PackedASDU(NamedTuple):
+    sequence: bool   # SQ=1: IOA del primer objeto y los demás consecutivos
+    objects: List    # objetos de información, en el orden original
+
+
+def max_objects(
+    element_size: int,
+    ioa_size: int,
+    asdu_size: int,
+    cot_size: int,
+    sequence: bool
+) -> int:
+    """Cuántos objetos entran en un ASDU con esta configuración de enlace."""
+    budget = (
+        MAX_APDU_LENGTH - APCI_CONTROL_SIZE
+        - ASDU_FIXED_HEADER_SIZE - cot_size - asdu_size
+    )
+    if sequence:
+        count = (budget - ioa_size) // element_size
+    else:
+        count = budget // (ioa_size + element_size)
+    return max(min(count, MAX_OBJECTS_PER_ASDU), 1)
+
+
+def pack_objects(
+    objects: Sequence[T],
+    ioa_of: Callable[[T], int],
+    type_name: str,
+    ioa_size: int,
+    asdu_size: int,
+    cot_size: int = 2
+) -> Iterator[PackedASDU]:
+    """
+    Agrupa objetos del mismo tipo y causa de transmisión en la menor
+    cantidad de ASDUs posible, respetando el orden de entrada:
+    - tramos de al menos SEQUENCE_MIN_RUN IOAs contiguas van como SQ=1
+      (si el tipo lo permite);
+    - el resto se junta en ASDUs SQ=0 hasta llenar el APDU.
+    """
+    element_size = ELEMENT_SIZES[type_name]
+    allow_sequence = type_name not in TIME_TAGGED_TYPES
+    plain_limit = max_objects(element_size, ioa_size, asdu_size, cot_size, sequence=False)
+    sequence_limit = max_objects(element_size, ioa_size, asdu_size, cot_size, sequence=True)
+
+    pending: List[T] = []
+    index = 0
+    while index < len(objects):
+        # Largo del tramo de IOAs contiguas que empieza en index.
+        run_end = index + 1
+        if allow_sequence:
+            while (
+                run_end < len(objects)
+                and ioa_of(objects[run_end]) == ioa_of(objects[run_end - 1]) + 1
+            ):
+                run_end += 1
+
+        # SQ=1 mientras quede un tramo que lo justifique; la cola corta
+        # del tramo sigue por el camino SQ=0.
+        while run_end - index >= SEQUENCE_MIN_RUN:
+            if pending:
+                yield PackedASDU(False, pending)
+                pending = []
+            chunk_end = min(index + sequence_limit, run_end)
+            yield PackedASDU(True, list(objects[index:chunk_end]))
+            index = chunk_end
+
+        for item in objects[index:run_end]:
+            pending.append(item)
+            if len(pending) == plain_limit:
+                yield PackedASDU(False, pending)
+                pending = []
+        index = run_end
+
+    if pending:
+        yield PackedASDU(False, pending)
@@ -0,0 +1,6 @@
+"""
+Benchmarks del pipeline sobre una flota sintética.
+
+Uso (desde app/):
+    python -m bench.run --counters 500 --output bench.json
+"""
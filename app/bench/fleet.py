@@ -0,0 +1,133 @@
+# /opt/aqua104/app/bench/fleet.py
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+from sqlalchemy import insert
+from sqlalchemy.engine import Engine
+
+from models import Counter, Iec104Config
+
+# Tamaño real de un BLOB anual (ver seed_db.py): 2 bytes por minuto de 366 días + cola.
+YEAR_BLOB_BYTES = 1056958
+MINUTES_PER_DAY = 1440
+
+# Contadores por dispositivo y por ASDU en la flota sintética.
+COUNTERS_PER_DEVICE = 1000
+COUNTERS_PER_ASDU = 100
+IOA_BASE = 1000
+IOA_STRIDE = 10  # deja lugar para varios periodos por medidor
+
+INSERT_BATCH_SIZE = 50
+
+
+def _constant(rng: np.random.Generator, minutes: np.ndarray) -> np.ndarray:
+    return np.full(len(minutes), rng.integers(100, 2000), dtype=np.float64)
+
+def _daily(rng: np.random.Generator, minutes: np.ndarray) -> np.ndarray:
+    """Consumo doméstico: picos a la mañana y a la tarde, valle nocturno, ruido."""
+    base = rng.uniform(200, 1500)
+    hour = (minutes % MINUTES_PER_DAY) / 60.0
+    shape = (
+        0.35
+        + 0.9 * np.exp(-((hour - 7.5) ** 2) / 2.0)
+        + 0.7 * np.exp(-((hour - 19.0) ** 2) / 3.0)
+    )
+    return base * shape * rng.normal(1.0, 0.08, len(minutes))
+
+def _industrial(rng: np.random.Generator, minutes: np.ndarray) -> np.ndarray:
+    """Dos turnos de lunes a viernes, casi nada el fin de semana."""
+    base = rng.uniform(2000, 20000)
+    hour = (minutes % MINUTES_PER_DAY) // 60
+    weekday = (minutes // MINUTES_PER_DAY) % 7 < 5
+    on_shift = weekday & (hour >= 6) & (hour < 22)
+    return np.where(on_shift, base, base * 0.05) * rng.normal(1.0, 0.03, len(minutes))
+
+# Perfiles de caudal (l/min por minuto del año).
+PROFILES: Dict[str, Callable[[np.random.Generator, np.ndarray], np.ndarray]] = {
+    "constant": _constant,
+    "daily": _daily,
+    "industrial": _industrial,
+}
+
+
+def year_blob(
+    rng: np.random.Generator,
+    profile: str = "daily",
+    gap_ratio: float = 0.0,
+    gap_minutes: int = 120,
+    year_bytes: int = YEAR_BLOB_BYTES
+) -> bytes:
+    """
+    BLOB anual con el layout de counters.kumuliertedaten ('>u2' por minuto).
+    gap_ratio es la fracción aproximada del año en huecos de gap_minutes
+    sin lectura (se guardan como 0, igual que un medidor caído).
+    """
+    minutes = np.arange(year_bytes // 2, dtype=np.int64)
+    values = PROFILES[profile](rng, minutes)
+
+    if gap_ratio > 0:
+        gap_count = int(len(minutes) * gap_ratio / gap_minutes)
+        for gap_start in rng.integers(0, len(minutes), gap_count):
+            values[gap_start:gap_start + gap_minutes] = 0
+
+    blob = np.clip(np.rint(values), 0, 0xFFFF).astype(">u2").tobytes()
+    return blob + bytes(year_bytes - len(blob))
+
+
+def fleet_keys(counters: int) -> Iterator[Tuple[int, int, int, int]]:
+    """(device_id, counter_id, ASDU, IOA base) de cada contador de la flota."""
+    for index in range(counters):
+        yield (
+            1 + index // COUNTERS_PER_DEVICE,
+            1 + index % COUNTERS_PER_DEVICE,
+            1 + index // COUNTERS_PER_ASDU,
+            IOA_BASE + (index % COUNTERS_PER_ASDU) * IOA_STRIDE,
+        )
+
+
+def populate(
+    engine: Engine,
+    counters: int,
+    profile: str = "daily",
+    gap_ratio: float = 0.0,
+    agg_periods: str = "15|60",
+    flow_unit: str = "m3/h",
+    send_interval: int = 0,
+    seed: int = 0
+) -> List[Tuple[int, int]]:
+    """
+    Crea `counters` contadores con su BLOB anual y su Iec104Config en la DB
+    de `engine` (que debe tener el esquema creado). Devuelve los pares
+    (device_id, counter_id).
+    """
+    rng = np.random.default_rng(seed)
+    modified = datetime.now().replace(microsecond=0)
+    keys = list(fleet_keys(counters))
+
+    with engine.begin() as conn:
+        for batch_start in range(0, len(keys), INSERT_BATCH_SIZE):
+            batch = keys[batch_start:batch_start + INSERT_BATCH_SIZE]
+            conn.execute(insert(Counter), [
+                dict(
+                    device_id=device_id, id=counter_id, typ="A",
+                    name=f"bench {device_id}/{counter_id}",
+                    kumuliertedaten=year_blob(rng, profile, gap_ratio),
+                    modified=modified
+                )
+                for device_id, counter_id, _, _ in batch
+            ])
+            conn.execute(insert(Iec104Config), [
+                dict(
+                    device_id=device_id, counter_id=counter_id,
+                    remote_ip_1="127.0.0.1", remote_ip_2="127.0.0.2",
+                    common_address=asdu,
+                    information_object_address=ioa,
+                    information_object_address_start=IOA_BASE,
+                    send_interval=send_interval, enabled=True,
+                    flow_unit=flow_unit, agg_periods=agg_periods
+                )
+                for device_id, counter_id, asdu, ioa in batch
+            ])
+
+    return [(device_id, counter_id) for device_id, counter_id, _, _ in keys]
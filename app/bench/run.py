@@ -0,0 +1,247 @@
+# /opt/aqua104/app/bench/run.py
+"""
+Mide cada etapa del pipeline (fetch, decode, aggregate, export_chunk,
+persist, GI) sobre una flota sintética en una SQLite descartable y escribe
+el resultado en JSON, para comparar versiones y dimensionar hardware. Cada
+etapa llama a las mismas funciones que el exportador.
+
+    python -m bench.run --counters 1000 --profile daily --gaps 0.01 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Tuple
+
+from bench.fleet import PROFILES
+
+RESULT_VERSION = 2
+
+
+class StageTimer:
+    """Acumula (segundos, cantidad procesada) por etapa."""
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, Any]] = {}
+
+    @contextmanager
+    def stage(self, name: str, unit: str) -> Iterator[Dict[str, Any]]:
+        record = dict(seconds=0.0, items=0, unit=unit)
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - started
+            record["per_second"] = record["items"] / record["seconds"] if record["seconds"] else None
+            self.stages[name] = record
+
+
+def _bench_range(hours: int) -> Tuple[datetime, datetime]:
+    """[desde, hasta) de `hours` horas terminando en la hora actual, dentro de un mismo año."""
+    to_dt = datetime.now().replace(minute=0, second=0, microsecond=0)
+    from_dt = to_dt - timedelta(hours=hours)
+    if from_dt.year != to_dt.year:
+        from_dt = datetime(to_dt.year, 1, 1)
+        to_dt = from_dt + timedelta(hours=hours)
+    return from_dt, to_dt
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    # Los módulos de la app leen el DSN al importarse.
+    import numpy as np
+    import sqlalchemy
+
+    import blob_store
+    import latest_values
+    import segment_cache
+    from db import engine, get_session
+    from models import Base, Iec104Config
+    from fetcher import fetch_series_many
+    from aggregator import aggregate_windows
+    from sql_aggregator import aggregate_windows_in_db
+    from units import unit_scale
+    from writer import ensure_upsert_index, upsert_aggregated
+    from main import ExportJob, compute_export_chunk
+    from metrics import REGISTRY
+    from bench.fleet import populate
+
+    # Medir la DB, no las capas locales.
+    blob_store.BLOB_STORE_DIR = None
+    segment_cache.SEGMENT_CACHE_BYTES = 0
+    latest_values.SHM_NAME = f"aqua104_bench_{os.getpid()}"
+
+    Base.metadata.create_all(engine)
+    ensure_upsert_index(engine)
+
+    periods = [int(period) for period in args.periods.split("|")]
+    from_dt, to_dt = _bench_range(args.hours)
+    timer = StageTimer()
+
+    with timer.stage("generate", "counters") as record:
+        pairs = populate(
+            engine, args.counters, args.profile, args.gaps,
+            agg_periods=args.periods, flow_unit=args.unit, seed=args.seed
+        )
+        record["items"] = len(pairs)
+
+    session = get_session()
+    configs = {
+        (config.device_id, config.counter_id): config
+        for config in session.query(Iec104Config).all()
+    }
+
+    # fetch: fetch_series_many, con la decodificación incluida como en el
+    # exportador; decode es la parte de ese tiempo que mide el propio fetcher.
+    REGISTRY.reset()
+    with timer.stage("fetch", "counters") as record:
+        values_by_counter = fetch_series_many(pairs, from_dt, to_dt, field="kumuliertedaten")
+        record["items"] = len(values_by_counter)
+        record["bytes"] = sum(values.nbytes for values in values_by_counter.values())
+    decode_seconds = sum(sample["value"]["sum"] for sample in REGISTRY.snapshot().get("aqua104_decode_seconds", []))
+    items = sum(len(values) for values in values_by_counter.values())
+    timer.stages["decode"] = dict(
+        seconds=decode_seconds, items=items, unit="minutes",
+        per_second=items / decode_seconds if decode_seconds else None
+    )
+
+    # aggregate: promedios ya convertidos a la unidad de cada config.
+    with timer.stage("aggregate", "blocks") as record:
+        averaged_by_counter = {
+            key: aggregate_windows(values, periods, from_dt, to_dt, scale=unit_scale(configs[key].flow_unit))
+            for key, values in values_by_counter.items()
+        }
+        record["items"] = sum(
+            len(offsets)
+            for averaged in averaged_by_counter.values()
+            for offsets, _ in averaged.values()
+        )
+
+    with timer.stage("aggregate_in_db", "blocks") as record:
+        in_db = aggregate_windows_in_db(pairs, periods, from_dt, to_dt)
+        record["items"] = sum(
+            len(offsets) for averaged in in_db.values() for offsets, _ in averaged.values()
+        )
+
+    # export_chunk: la tarea completa del exportador (lectura, promedios,
+    # conversión y filas) para toda la flota como un único rango.
+    jobs = [
+        ExportJob(
+            device_id=config.device_id,
+            counter_id=config.counter_id,
+            common_address=config.common_address,
+            flow_unit=config.flow_unit,
+            pending={
+                window_minutes: (config.information_object_address + ioa_offset, from_dt, to_dt)
+                for ioa_offset, window_minutes in enumerate(config.periods)
+            }
+        )
+        for config in configs.values()
+    ]
+    with timer.stage("export_chunk", "rows") as record:
+        rows, _ = compute_export_chunk(from_dt, to_dt, jobs)
+        record["items"] = len(rows)
+
+    with timer.stage("persist", "rows") as record:
+        with engine.begin() as conn:
+            record["items"] = upsert_aggregated(conn, rows)
+
+    gi_result = _bench_gi(timer, list(configs.values()))
+    session.close()
+
+    return dict(
+        version=RESULT_VERSION,
+        created=datetime.now().isoformat(timespec="seconds"),
+        environment=dict(
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpu_count=os.cpu_count(),
+            numpy=np.__version__,
+            sqlalchemy=sqlalchemy.__version__,
+            dialect=engine.dialect.name,
+        ),
+        parameters=dict(
+            counters=args.counters,
+            profile=args.profile,
+            gaps=args.gaps,
+            periods=periods,
+            unit=args.unit,
+            hours=args.hours,
+            from_dt=from_dt.isoformat(),
+            to_dt=to_dt.isoformat(),
+            seed=args.seed,
+        ),
+        stages=timer.stages,
+        gi=gi_result,
+    )
+
+
+class _NullSlave:
+    """Slave que descarta las tramas: se mide armar y encolar, no la red."""
+
+    def send_asdu(self, **kwargs) -> None:
+        pass
+
+    def send_gi_response(self, **kwargs) -> None:
+        pass
+
+
+def _bench_gi(timer: StageTimer, configs: List) -> Dict[str, Any]:
+    """GI de todos los ASDU sobre los datos persistidos, si c104 está instalado."""
+    try:
+        import sender
+    except ImportError as e:
+        return dict(skipped=f"c104 no disponible: {e}")
+
+    handler = sender.Aqua104DataHandler(configs, _NullSlave())
+    asdu_addresses = sorted({config.common_address for config in configs})
+    # Los avisos del handler van a stderr: stdout queda para el JSON.
+    with timer.stage("gi", "asdus") as record, redirect_stdout(sys.stderr):
+        for common_address in asdu_addresses:
+            handler.on_gi(sender.ASDU(common_address), None)
+        handler.outbox.join()
+        record["items"] = len(asdu_addresses)
+    handler.outbox.close()
+    return dict(masters=handler.outbox.stats())
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline sobre una flota sintética")
+    parser.add_argument("--counters", type=int, default=100, help="contadores de la flota")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="daily", help="perfil de caudal")
+    parser.add_argument("--gaps", type=float, default=0.0, help="fracción del año sin lectura")
+    parser.add_argument("--periods", default="15|60", help="periodos de agregación (como agg_periods)")
+    parser.add_argument("--unit", default="m3/h", help="flow_unit de las configs")
+    parser.add_argument("--hours", type=int, default=24, help="horas a exportar")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", help="archivo SQLite nuevo a crear (por defecto, uno temporal)")
+    parser.add_argument("--keep-db", action="store_true", help="no borrar la SQLite temporal")
+    parser.add_argument("--output", help="archivo JSON de salida (por defecto, stdout)")
+    args = parser.parse_args(argv)
+
+    if args.db and os.path.exists(args.db):
+        parser.error(f"{args.db} ya existe; el benchmark sólo escribe en una DB nueva")
+    db_path = args.db or tempfile.mkstemp(prefix="aqua104_bench_", suffix=".sqlite")[1]
+    os.environ["AQUA104_DB_DSN"] = f"sqlite:///{db_path}"
+
+    try:
+        result = run_benchmark(args)
+    finally:
+        if not args.db and not args.keep_db and os.path.exists(db_path):
+            os.remove(db_path)
+
+    output = json.dumps(result, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+        print(f"Resultados del benchmark en {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
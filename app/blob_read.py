@@ -1,8 +1,8 @@
 # /opt/aqua104/app/blob_read.py
 from datetime import datetime, timedelta, timezone
-from sqlalchemy import text
-from db import engine
-from typing import List, Tuple, Literal
+from fetcher import fetch_range_many
+from minute_series import MinuteSeries
+from typing import Literal
 
 # --- helpers de índice (equivalentes a tus _indexMinute y _indexBlob) ---
 
@@ -33,47 +33,6 @@ def minutes_between(from_dt: datetime, to_dt: datetime) -> int:
         to_dt = to_dt.astimezone(timezone.utc).replace(tzinfo=None)
     return int((to_dt - from_dt).total_seconds() // 60)
 
-# --- extracción SQL dependiente de motor ---
-
-def _select_hex_sql(dialect: str, field: Literal["diagrammdaten","kumuliertedaten"]) -> str:
-    """
-    Devuelve el SELECT que retorna un único valor 'hexdata' con el segmento hex.
-    - SQLite: HEX(SUBSTR(blob, start, len))
-    - Postgres: ENCODE(SUBSTRING(blob FROM start FOR len), 'hex')
-    """
-    if dialect == "sqlite":
-        return f"""
-            SELECT HEX(SUBSTR({field}, :start, :length)) AS hexdata
-            FROM counters
-            WHERE device_id = :device_id AND id = :counter_id
-        """
-    elif dialect in ("postgresql", "postgres"):
-        return f"""
-            SELECT ENCODE(SUBSTRING({field} FROM :start FOR :length), 'hex') AS hexdata
-            FROM counters
-            WHERE device_id = :device_id AND id = :counter_id
-        """
-    else:
-        # Podés agregar MySQL si querés (HEX(SUBSTRING(...)))
-        raise NotImplementedError(f"DB dialect '{dialect}' no soportado aún")
-
-# --- decodificación del hex a lista de uint16 ---
-
-def _decode_hex_u16_be(hex_str: str) -> List[int]:
-    """
-    Decodifica una cadena hex (longitud par) en una lista de enteros uint16 big-endian.
-    """
-    if not hex_str:
-        return []
-    raw = bytes.fromhex(hex_str)
-    if len(raw) % 2 != 0:
-        # Si llega impar, recortamos el último byte por seguridad (no debería pasar)
-        raw = raw[:-1]
-    out = []
-    for i in range(0, len(raw), 2):
-        out.append(int.from_bytes(raw[i:i+2], byteorder="big", signed=False))
-    return out
-
 # --- API pública: extraer una serie minuto a minuto ---
 
 def fetch_series(
@@ -82,39 +41,16 @@ def fetch_series(
     from_dt: datetime,
     to_dt: datetime,
     field: Literal["diagrammdaten","kumuliertedaten"] = "diagrammdaten",
-) -> List[Tuple[datetime, int]]:
+) -> MinuteSeries:
     """
     Extrae (timestamp_minuto, valor_uint16) para [from_dt, to_dt) desde 'field'.
-    Devuelve lista ordenada por tiempo.
+    Devuelve una MinuteSeries ordenada por tiempo (timestamps calculados al iterar)
+    con máscara de validez: sale de fetcher.fetch_range_many, así que un rango
+    que cruza el año se lee por tramos y los minutos que el BLOB ya no tiene
+    (o futuros) no cuentan como lecturas.
     """
-    assert to_dt > from_dt, "to_dt debe ser posterior a from_dt"
-    minutes = minutes_between(from_dt, to_dt)
-    if minutes <= 0:
-        return []
-
-    start = blob_start_pos(from_dt)
-    length = minutes * 2  # 2 bytes por minuto
-
-    dialect = engine.dialect.name
-    sql = _select_hex_sql(dialect, field)
-
-    with engine.connect() as conn:
-        row = conn.execute(
-            text(sql),
-            dict(start=start, length=length, device_id=device_id, counter_id=counter_id)
-        ).mappings().first()
-
-    hexdata = row["hexdata"] if row and row["hexdata"] is not None else ""
-    values = _decode_hex_u16_be(hexdata)
-
-    # construir timestamps por minuto
-    out = []
-    t = from_dt
-    for v in values:
-        out.append((t, v))
-        t += timedelta(minutes=1)
-
-    return out
+    key = (device_id, counter_id)
+    return fetch_range_many([key], from_dt, to_dt, field)[key]
 
 # --- ejemplo de uso manual (quitar/ajustar a gusto) ---
 if __name__ == "__main__":
@@ -123,4 +59,4 @@ if __name__ == "__main__":
     serie = fetch_series(device_id=100, counter_id=1, from_dt=today, to_dt=today + timedelta(hours=1))
     print(f"Leídos {len(serie)} puntos")
     if serie:
-        print(serie[:5], "...")
+        print(serie[:5].tolist(), "...")
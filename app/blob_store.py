@@ -0,0 +1,332 @@
+# /opt/aqua104/app/blob_store.py
+import hashlib
+import json
+import mmap
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import and_, select, text, tuple_
+from sqlalchemy.engine import Connection, Engine
+
+from models import Counter, CounterWrite
+
+# Directorio del almacén local de BLOBs. None = desactivado (se lee de la DB).
+BLOB_STORE_DIR: Optional[str] = None
+# Ejemplo: "/opt/aqua104/blobstore"
+
+STATE_FILE = "sync_state.json"
+# Contadores por consulta de versiones en sync(pairs=...).
+SYNC_CHUNK_SIZE = 500
+
+# Índice de sumas acumuladas que acompaña a cada archivo (.idx): para n
+# minutos guarda n+1 sumas '<i8' y luego n+1 conteos de minutos válidos
+# '<u4', ambos con un 0 inicial. El promedio de cualquier [desde, hasta)
+# sale de dos lecturas por arreglo, sin importar el largo de la ventana.
+INDEX_SUM_DTYPE = np.dtype("<i8")
+INDEX_COUNT_DTYPE = np.dtype("<u4")
+
+MINUTE = timedelta(minutes=1)
+# Tras este plazo desde el 1 de enero el archivo del año anterior se da por
+# cerrado: sync() deja de completarlo con lo que todavía queda en el BLOB.
+PREVIOUS_YEAR_SETTLE = timedelta(days=7)
+
+# --- almacén ---
+
+class LocalBlobStore:
+    """
+    Copia en disco de counters.<field>: un archivo por año y por
+    (device, counter, field), con los mismos bytes que el BLOB.
+    Las lecturas se hacen con mmap, sin tráfico a la DB y sin copias;
+    varios procesos que leen el mismo archivo comparten el page cache.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        # path -> (inode, mtime_ns, mmap) de los archivos ya abiertos
+        self._maps: Dict[str, Tuple[int, int, mmap.mmap]] = {}
+
+    def path(self, device_id: int, counter_id: int, field: str, year: int) -> str:
+        return os.path.join(
+            self.root, str(year), f"counters-{device_id}_{counter_id}_{field}.bin"
+        )
+
+    def index_path(self, device_id: int, counter_id: int, field: str, year: int) -> str:
+        return self.path(device_id, counter_id, field, year)[:-len(".bin")] + ".idx"
+
+    def _map(self, path: str) -> Optional[mmap.mmap]:
+        """
+        Devuelve el mmap del archivo, reabriéndolo si sync() lo reemplazó.
+        Los arrays ya entregados siguen apuntando al archivo anterior.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._maps.pop(path, None)
+            return None
+
+        cached = self._maps.get(path)
+        if cached and cached[0] == stat.st_ino and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        if stat.st_size == 0:
+            return None
+
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[path] = (stat.st_ino, stat.st_mtime_ns, mapped)
+        return mapped
+
+    def has(self, device_id: int, counter_id: int, field: str, year: int) -> bool:
+        return os.path.exists(self.path(device_id, counter_id, field, year))
+
+    def read(
+        self,
+        device_id: int,
+        counter_id: int,
+        field: str,
+        year: int,
+        start_minute: int,
+        minutes: int
+    ) -> Optional[np.ndarray]:
+        """
+        Lee `minutes` minutos desde el minuto del año `start_minute` (mismo
+        layout que el BLOB: 2 bytes por minuto) como array '>u2' sobre el
+        mmap, sin copia. Devuelve None si no hay archivo para ese año, para
+        que quien llama vaya a la DB. Igual que SUBSTR, si el archivo es más
+        corto se devuelve lo que haya.
+        """
+        mapped = self._map(self.path(device_id, counter_id, field, year))
+        if mapped is None:
+            return None
+
+        offset = min(start_minute * 2, len(mapped))
+        available = max(min(minutes * 2, len(mapped) - offset), 0)
+        return np.frombuffer(mapped, dtype=">u2", count=available // 2, offset=offset)
+
+    # --- índice de sumas acumuladas ---
+
+    def build_index(self, device_id: int, counter_id: int, field: str, year: int) -> bool:
+        """(Re)genera el .idx a partir del archivo del año. False si no hay archivo."""
+        path = self.path(device_id, counter_id, field, year)
+        try:
+            values = np.fromfile(path, dtype=">u2")
+        except FileNotFoundError:
+            return False
+
+        sums = np.zeros(len(values) + 1, dtype=INDEX_SUM_DTYPE)
+        np.cumsum(values, dtype=INDEX_SUM_DTYPE, out=sums[1:])
+        # Hoy todo minuto guardado en el BLOB cuenta como válido.
+        counts = np.arange(len(values) + 1, dtype=INDEX_COUNT_DTYPE)
+
+        self._write_atomic(
+            self.index_path(device_id, counter_id, field, year),
+            sums.tobytes() + counts.tobytes()
+        )
+        return True
+
+    def prefix_at(
+        self,
+        device_id: int,
+        counter_id: int,
+        field: str,
+        year: int,
+        positions: np.ndarray
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        (sumas, conteos) acumulados hasta cada minuto del año de `positions`
+        (exclusivo). Pasado el final del archivo el acumulado ya no crece,
+        igual que los minutos ausentes en aggregator. None si no hay índice
+        o si es más viejo que el archivo (hay que ir a los datos crudos).
+        """
+        index_path = self.index_path(device_id, counter_id, field, year)
+        try:
+            if os.stat(index_path).st_mtime_ns < os.stat(self.path(device_id, counter_id, field, year)).st_mtime_ns:
+                return None
+        except FileNotFoundError:
+            return None
+
+        mapped = self._map(index_path)
+        if mapped is None:
+            return None
+        entries = len(mapped) // (INDEX_SUM_DTYPE.itemsize + INDEX_COUNT_DTYPE.itemsize)
+        sums = np.frombuffer(mapped, dtype=INDEX_SUM_DTYPE, count=entries)
+        counts = np.frombuffer(
+            mapped, dtype=INDEX_COUNT_DTYPE, count=entries, offset=entries * INDEX_SUM_DTYPE.itemsize
+        )
+        positions = np.clip(positions, 0, entries - 1)
+        return sums[positions], counts[positions].astype(np.int64)
+
+    # --- sincronización con la DB ---
+
+    def _load_state(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.root, STATE_FILE)) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        # Estados de versiones anteriores (sólo la versión, como texto): se
+        # vuelven a copiar una vez.
+        return {key: entry for key, entry in state.items() if isinstance(entry, dict)}
+
+    def _save_state(self, state: Dict[str, Dict[str, Any]]) -> None:
+        path = os.path.join(self.root, STATE_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        # Escribir aparte y renombrar: los lectores nunca ven un archivo a medias.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def _refresh_previous_year(
+        self,
+        device_id: int,
+        counter_id: int,
+        field: str,
+        blob: bytes,
+        now: datetime,
+        state: Dict[str, Dict[str, Any]]
+    ) -> int:
+        """
+        Completa el archivo del año anterior (si existe y no está cerrado)
+        con las posiciones del BLOB que el año en curso todavía no pisó:
+        las posteriores a `now`, igual que _ring_valid_range en fetcher.
+        Pasado PREVIOUS_YEAR_SETTLE lo marca cerrado. Devuelve 1 si lo escribió.
+        """
+        year = now.year - 1
+        key = f"{device_id}_{counter_id}_{field}_{year}"
+        entry = state.get(key, {})
+        if entry.get("sealed"):
+            return 0
+        path = self.path(device_id, counter_id, field, year)
+        try:
+            with open(path, "rb") as f:
+                previous = f.read()
+        except FileNotFoundError:
+            return 0
+
+        written = 0
+        overwritten = ((now - datetime(now.year, 1, 1)) // MINUTE + 1) * 2
+        tail = blob[overwritten:]
+        # Si el archivo no llega hasta overwritten quedaría un hueco: se deja como está.
+        if tail and len(previous) >= overwritten:
+            refreshed = previous[:overwritten] + tail + previous[overwritten + len(tail):]
+            if refreshed != previous:
+                self._write_atomic(path, refreshed)
+                self.build_index(device_id, counter_id, field, year)
+                written = 1
+
+        if now - datetime(now.year, 1, 1) >= PREVIOUS_YEAR_SETTLE:
+            state[key] = dict(entry, sealed=True)
+        return written
+
+    @staticmethod
+    def _versions(conn: Connection, pairs: Optional[List[Tuple[int, int]]]) -> List:
+        """(device_id, id, modified, last_read, written) de todos los contadores o de pairs."""
+        counters = Counter.__table__
+        writes = CounterWrite.__table__
+        query = select(
+            counters.c.device_id, counters.c.id, counters.c.modified, counters.c.last_read,
+            writes.c.modified.label("written")
+        ).select_from(counters.outerjoin(writes, and_(
+            writes.c.device_id == counters.c.device_id, writes.c.counter_id == counters.c.id
+        )))
+        if pairs is None:
+            return conn.execute(query).all()
+        rows = []
+        for chunk_start in range(0, len(pairs), SYNC_CHUNK_SIZE):
+            chunk = pairs[chunk_start:chunk_start + SYNC_CHUNK_SIZE]
+            rows += conn.execute(query.where(tuple_(counters.c.device_id, counters.c.id).in_(chunk))).all()
+        return rows
+
+    def sync(
+        self,
+        engine: Engine,
+        fields: Iterable[str] = ("kumuliertedaten",),
+        pairs: Optional[Iterable[Tuple[int, int]]] = None,
+        now: Optional[datetime] = None
+    ) -> int:
+        """
+        Trae a disco los BLOBs de los contadores (todos, o sólo pairs) que
+        cambiaron desde la última sincronización o que todavía no tienen
+        archivo. Si la versión (modified, last_read y la de counter_writes)
+        no cambió no se lee el BLOB; si cambió o no hay versión, se compara
+        su contenido (sha1) y sólo se escribe si es otro.
+
+        El BLOB es un anillo anual y se archiva como el año de `now`: hasta
+        `now` tiene datos de este año (fetcher recorta ahí las lecturas) y
+        después todavía los del anterior, que completan el archivo de ese
+        año mientras no esté cerrado (ver _refresh_previous_year). No
+        depende de last_read, que los escritores no mantienen. Cada archivo
+        escrito (o sin .idx todavía) regenera su índice. Devuelve la
+        cantidad de archivos escritos.
+        """
+        now = now or datetime.now()
+        year = now.year
+        state = self._load_state()
+        written = 0
+        pairs = list(dict.fromkeys(pairs)) if pairs is not None else None
+
+        with engine.connect() as conn:
+            for device_id, counter_id, *version_parts in self._versions(conn, pairs):
+                version = (
+                    "|".join(part.isoformat() if part else "" for part in version_parts)
+                    if any(version_parts) else ""
+                )
+
+                for field in fields:
+                    key = f"{device_id}_{counter_id}_{field}_{year}"
+                    entry = state.get(key, {})
+                    path = self.path(device_id, counter_id, field, year)
+                    exists = os.path.exists(path)
+                    if version and entry.get("version") == version and exists:
+                        if not os.path.exists(self.index_path(device_id, counter_id, field, year)):
+                            self.build_index(device_id, counter_id, field, year)
+                        continue
+
+                    blob = conn.execute(
+                        text(f"SELECT {field} FROM counters WHERE device_id = :device_id AND id = :counter_id"),
+                        dict(device_id=device_id, counter_id=counter_id)
+                    ).scalar()
+                    if blob is None:
+                        continue
+                    blob = bytes(blob)
+                    digest = hashlib.sha1(blob).hexdigest()
+
+                    if entry.get("digest") != digest or not exists:
+                        # El final del BLOB puede traer minutos atrasados del año anterior.
+                        written += self._refresh_previous_year(device_id, counter_id, field, blob, now, state)
+                        self._write_atomic(path, blob)
+                        self.build_index(device_id, counter_id, field, year)
+                        written += 1
+                    state[key] = dict(version=version, digest=digest)
+
+        self._save_state(state)
+        return written
+
+
+_store: Optional[LocalBlobStore] = None
+
+def get_store() -> Optional[LocalBlobStore]:
+    """Almacén configurado en BLOB_STORE_DIR, o None si está desactivado."""
+    global _store
+    if BLOB_STORE_DIR is None:
+        return None
+    if _store is None or _store.root != BLOB_STORE_DIR:
+        _store = LocalBlobStore(BLOB_STORE_DIR)
+    return _store
+
+
+if __name__ == "__main__":
+    from db import engine
+
+    store = get_store()
+    if store is None:
+        print("BLOB_STORE_DIR no está configurado en blob_store.py")
+    else:
+        count = store.sync(engine)
+        print(f"Sincronización finalizada. {count} archivos actualizados en {store.root}.")
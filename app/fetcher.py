@@ -1,7 +1,41 @@
-from datetime import datetime, timezone, timedelta
+import asyncio
+import time
+from datetime import datetime, timezone
 from sqlalchemy import text
-from db import engine
-from typing import List, Tuple
+from db import engine, get_async_engine
+from blob_store import get_store
+from segment_cache import get_cache, page_bounds
+from metrics import BYTES_BUCKETS, REGISTRY
+from minute_series import MINUTE_STEP, MinuteSeries
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+import numpy as np
+
+# Cada minuto ocupa 2 bytes (uint16 big-endian) dentro del BLOB.
+MINUTE_DTYPE = np.dtype(">u2")
+
+# Contadores por consulta en fetch_series_many (2 parámetros por contador;
+# SQLite antiguo limita a 999 parámetros por sentencia).
+FETCH_CHUNK_SIZE = 400
+# fetch_series_many_async: contadores por consulta y consultas en vuelo a
+# la vez. Lotes más chicos reparten la lectura entre varias conexiones.
+FETCH_ASYNC_CHUNK_SIZE = 50
+FETCH_ASYNC_CONCURRENCY = 16
+
+_FETCH_SECONDS = REGISTRY.histogram(
+    "aqua104_fetch_seconds", "Latencia de cada consulta de segmentos a la DB"
+)
+_FETCH_BYTES = REGISTRY.histogram(
+    "aqua104_fetch_bytes", "Bytes de BLOB traídos por consulta", BYTES_BUCKETS
+)
+_DECODE_SECONDS = REGISTRY.histogram(
+    "aqua104_decode_seconds", "Decodificación de los segmentos de una consulta"
+)
+_SEGMENTS_BY_SOURCE = {
+    source: REGISTRY.counter(
+        "aqua104_fetch_segments_total", "Segmentos leídos, por origen", labels=dict(source=source)
+    )
+    for source in ("store", "cache", "db")
+}
 
 # --- helpers de índice ---
 def minute_index(dt: datetime) -> int:
@@ -21,59 +55,522 @@ def minutes_between(from_dt: datetime, to_dt: datetime) -> int:
         to_dt = to_dt.astimezone(timezone.utc).replace(tzinfo=None)
     return int((to_dt - from_dt).total_seconds() // 60)
 
+# --- rangos que cruzan el año ---
+# El BLOB guarda un año: la posición de cada minuto se cuenta desde el 1 de
+# enero y el año siguiente escribe encima de las mismas posiciones.
+
+class YearSegment(NamedTuple):
+    """Tramo de un rango dentro de un mismo año."""
+    year: int
+    start_minute: int   # posición en el BLOB (minuto del año)
+    minutes: int
+    offset: int         # posición dentro del rango pedido
+
+def _naive_utc(dt: datetime) -> datetime:
+    return dt.astimezone(timezone.utc).replace(tzinfo=None) if dt.tzinfo is not None else dt
+
+def crosses_year(from_dt: datetime, to_dt: datetime) -> bool:
+    """True si [from_dt, to_dt) tiene minutos de más de un año."""
+    return to_dt > from_dt and _naive_utc(to_dt - MINUTE_STEP).year != _naive_utc(from_dt).year
+
+def plan_year_segments(from_dt: datetime, to_dt: datetime) -> List[YearSegment]:
+    """Parte [from_dt, to_dt) en tramos por año, en orden."""
+    segments = []
+    current, end = _naive_utc(from_dt), _naive_utc(to_dt)
+    offset = 0
+    while current < end:
+        segment_end = min(end, datetime(current.year + 1, 1, 1))
+        minutes = minutes_between(current, segment_end)
+        if minutes > 0:
+            segments.append(YearSegment(current.year, minute_index(current), minutes, offset))
+        offset += minutes
+        current = segment_end
+    return segments
+
+def _ring_valid_range(segment: YearSegment, now: datetime) -> Tuple[int, int]:
+    """
+    [desde, hasta) dentro del tramo cuyas posiciones en la DB todavía
+    tienen datos de segment.year: ni futuras ni pisadas por el año siguiente.
+    """
+    now = _naive_utc(now)
+    now_minute = minute_index(now)
+    first, last = segment.start_minute, segment.start_minute + segment.minutes
+    if segment.year == now.year:
+        last = min(last, now_minute + 1)
+    elif segment.year == now.year - 1:
+        first = max(first, now_minute + 1)
+    else:
+        return 0, 0
+    return max(first - segment.start_minute, 0), max(last - segment.start_minute, 0)
+
 # --- decodificación ---
-def _decode_hex_u16_be(hex_str: str) -> List[int]:
-    if not hex_str:
-        return []
-    raw = bytes.fromhex(hex_str)
-    if len(raw) % 2 != 0:
-        raw = raw[:-1]
-    return [int.from_bytes(raw[i:i+2], "big") for i in range(0, len(raw), 2)]
-
-# --- función principal ---
-def fetch_series(
+def _decode_u16_be(raw) -> np.ndarray:
+    """
+    Expone los bytes crudos como uint16 big-endian sin copiarlos.
+    Si llega un largo impar se ignora el último byte (no debería pasar).
+    """
+    if not raw:
+        return np.empty(0, dtype=MINUTE_DTYPE)
+    return np.frombuffer(raw, dtype=MINUTE_DTYPE, count=len(raw) // 2)
+
+def _pairs_sql(pair_count: int) -> str:
+    """Lista VALUES de pares (device_id, id) con parámetros :d<i>, :c<i>."""
+    return ", ".join(f"(:d{i}, :c{i})" for i in range(pair_count))
+
+def _pairs_params(pairs: List[Tuple[int, int]]) -> Dict[str, int]:
+    params = {}
+    for i, (device_id, counter_id) in enumerate(pairs):
+        params[f"d{i}"] = device_id
+        params[f"c{i}"] = counter_id
+    return params
+
+# Versión de un contador para la caché: (modified, last_read, written), con
+# written la de las escrituras por minuto (counter_writes, ver ingest.py).
+_VERSION_COLUMNS = "counters.modified, counters.last_read, counter_writes.modified AS written"
+_VERSION_JOIN = """
+    LEFT JOIN counter_writes
+        ON counter_writes.device_id = counters.device_id AND counter_writes.counter_id = counters.id
+"""
+
+def _select_raw_many_sql(dialect: str, field: str, pair_count: int) -> str:
+    """
+    SELECT que devuelve el segmento binario tal cual (sin HEX/ENCODE), así
+    viajan 2 bytes por minuto y no 4, para varios (device_id, id) a la vez
+    filtrando con un IN sobre una lista VALUES de pares. Incluye la versión
+    del contador (_VERSION_COLUMNS) para la caché de segmentos.
+    """
+    if dialect == "sqlite":
+        segment = f"SUBSTR({field}, :start, :length)"
+    elif dialect in ("postgresql", "postgres"):
+        segment = f"SUBSTRING({field} FROM :start FOR :length)"
+    else:
+        raise NotImplementedError(f"DB dialect '{dialect}' no soportado")
+    return f"""
+        SELECT counters.device_id, counters.id, {_VERSION_COLUMNS}, {segment} AS rawdata
+        FROM counters {_VERSION_JOIN}
+        WHERE (counters.device_id, counters.id) IN (VALUES {_pairs_sql(pair_count)})
+    """
+
+def _select_segments_many_sql(dialect: str, field: str, segment_count: int, pair_count: int) -> str:
+    """Como _select_raw_many_sql, pero un tramo por año (:s<i>/:l<i>) en columnas seg<i>."""
+    if dialect == "sqlite":
+        segment = "SUBSTR({field}, :s{i}, :l{i}) AS seg{i}"
+    elif dialect in ("postgresql", "postgres"):
+        segment = "SUBSTRING({field} FROM :s{i} FOR :l{i}) AS seg{i}"
+    else:
+        raise NotImplementedError(f"DB dialect '{dialect}' no soportado")
+    columns = ", ".join(segment.format(field=field, i=i) for i in range(segment_count))
+    return f"""
+        SELECT device_id, id, {columns}
+        FROM counters
+        WHERE (device_id, id) IN (VALUES {_pairs_sql(pair_count)})
+    """
+
+def _select_versions_sql(pair_count: int) -> str:
+    """Sólo la versión (_VERSION_COLUMNS): alcanza para validar la caché."""
+    return f"""
+        SELECT counters.device_id, counters.id, {_VERSION_COLUMNS}
+        FROM counters {_VERSION_JOIN}
+        WHERE (counters.device_id, counters.id) IN (VALUES {_pairs_sql(pair_count)})
+    """
+
+# --- pasos de fetch_series_many (compartidos con la variante async) ---
+def _read_from_store(
+    keys: List[Tuple[int, int]],
+    field: str,
+    year: int,
+    start_minute: int,
+    minutes: int,
+    result: Dict[Tuple[int, int], np.ndarray]
+) -> List[Tuple[int, int]]:
+    """Completa result desde el almacén local; devuelve los que faltan."""
+    store = get_store()
+    if store is None:
+        return keys
+    missing = []
+    for device_id, counter_id in keys:
+        values = store.read(device_id, counter_id, field, year, start_minute, minutes)
+        if values is None:
+            missing.append((device_id, counter_id))
+        else:
+            result[(device_id, counter_id)] = values
+    _SEGMENTS_BY_SOURCE["store"].inc(len(keys) - len(missing))
+    return missing
+
+def _read_from_cache(
+    cache,
+    chunk: List[Tuple[int, int]],
+    version_rows,
+    field: str,
+    year: int,
+    start_minute: int,
+    minutes: int,
+    result: Dict[Tuple[int, int], np.ndarray]
+) -> List[Tuple[int, int]]:
+    """
+    Completa result con los segmentos en caché cuya versión sigue vigente
+    (version_rows: device_id, id, modified, last_read, written). Devuelve los que hay
+    que pedir a la DB; los contadores inexistentes no se piden.
+    """
+    versions = {(row.device_id, row.id): (row.modified, row.last_read, row.written) for row in version_rows}
+    misses = []
+    hits = 0
+    for key in chunk:
+        if key not in versions:
+            continue
+        cached = cache.get((*key, field, year), versions[key], start_minute, minutes)
+        if cached is None:
+            misses.append(key)
+        else:
+            result[key] = cached
+            hits += 1
+    _SEGMENTS_BY_SOURCE["cache"].inc(hits)
+    return misses
+
+def _decode_rows(
+    rows,
+    cache,
+    field: str,
+    year: int,
+    start_minute: int,
+    minutes: int,
+    result: Dict[Tuple[int, int], np.ndarray],
+    page: Optional[Tuple[int, int]] = None
+) -> None:
+    """
+    Decodifica los segmentos traídos de la DB y los guarda en la caché.
+    Si se leyó una página más ancha (page: inicio, minutos), se cachea
+    entera y result recibe sólo lo pedido.
+    """
+    page_start, page_minutes = page or (start_minute, minutes)
+    fetched_bytes = 0
+    decode_started = time.perf_counter()
+    for row in rows:
+        key = (row["device_id"], row["id"])
+        values = _decode_u16_be(row["rawdata"])
+        fetched_bytes += values.nbytes
+        result[key] = values[start_minute - page_start:start_minute - page_start + minutes]
+        if cache is not None:
+            cache.put(
+                (*key, field, year),
+                (row["modified"], row["last_read"], row["written"]),
+                page_start,
+                page_minutes,
+                values
+            )
+    _DECODE_SECONDS.observe(time.perf_counter() - decode_started)
+    _FETCH_BYTES.observe(fetched_bytes)
+    _SEGMENTS_BY_SOURCE["db"].inc(len(rows))
+
+# --- funciones principales ---
+def fetch_raw(
     device_id: int,
     counter_id: int,
     from_dt: datetime,
     to_dt: datetime,
-    field: str = "kumuliertedaten"   # usamos crudo por defecto
-) -> List[Tuple[datetime, int]]:
+    field: str = "kumuliertedaten"
+) -> Tuple[datetime, np.ndarray]:
+    """
+    Lee [from_dt, to_dt) y devuelve (inicio, valores): los valores son un
+    array '>u2' montado sobre los bytes leídos (sin copia) y el paso
+    entre posiciones es fijo (MINUTE_STEP).
+    """
+    key = (device_id, counter_id)
+    return from_dt, fetch_series_many([key], from_dt, to_dt, field)[key]
+
+def fetch_series_many(
+    pairs: Iterable[Tuple[int, int]],
+    from_dt: datetime,
+    to_dt: datetime,
+    field: str = "kumuliertedaten"
+) -> Dict[Tuple[int, int], np.ndarray]:
+    """
+    Versión por lotes de fetch_raw: lee [from_dt, to_dt) para muchos
+    (device_id, counter_id) con una sola conexión y una consulta por cada
+    FETCH_CHUNK_SIZE contadores. Todas las series empiezan en from_dt.
+    Los contadores que no existen quedan con un array vacío.
+
+    Orden de lectura: almacén local (blob_store.py), caché de segmentos
+    (segment_cache.py, validada contra la versión del contador) y por último
+    SUBSTR en la DB.
+
+    Si el rango cruza el año se lee con fetch_range_many y cada serie es un
+    np.ma.MaskedArray: los minutos que el BLOB ya no tiene quedan
+    enmascarados (mean(), compressed() y aggregator los ignoran) en lugar
+    de pasar por lecturas en 0.
+    """
     assert to_dt > from_dt, "to_dt debe ser posterior a from_dt"
+    if crosses_year(from_dt, to_dt):
+        return {
+            key: np.ma.MaskedArray(series.values, mask=~series.valid)
+            for key, series in fetch_range_many(pairs, from_dt, to_dt, field).items()
+        }
+    keys = list(dict.fromkeys(pairs))
+    result = {key: _decode_u16_be(None) for key in keys}
     minutes = minutes_between(from_dt, to_dt)
-    if minutes <= 0:
-        return []
+    if minutes <= 0 or not keys:
+        return result
+
+    year = from_dt.year
+    start_minute = minute_index(from_dt)
+    keys = _read_from_store(keys, field, year, start_minute, minutes, result)
+    if not keys:
+        return result
 
-    start = blob_start_pos(from_dt)
-    length = minutes * 2
+    cache = get_cache()
+    # Con caché se lee la página alineada entera (segment_cache.page_bounds).
+    page = page_bounds(start_minute, minutes) if cache is not None else (start_minute, minutes)
+    start = page[0] * 2 + 1
+    length = page[1] * 2
     dialect = engine.dialect.name
 
-    if dialect == "sqlite":
-        sql = f"""
-            SELECT HEX(SUBSTR({field}, :start, :length)) AS hexdata
-            FROM counters
-            WHERE device_id = :device_id AND id = :counter_id
-        """
-    elif dialect in ("postgresql", "postgres"):
-        sql = f"""
-            SELECT ENCODE(SUBSTRING({field} FROM :start FOR :length), 'hex') AS hexdata
-            FROM counters
-            WHERE device_id = :device_id AND id = :counter_id
-        """
+    with engine.connect() as conn:
+        for chunk_start in range(0, len(keys), FETCH_CHUNK_SIZE):
+            chunk = keys[chunk_start:chunk_start + FETCH_CHUNK_SIZE]
+
+            if cache is not None and cache.holds((*key, field, year) for key in chunk):
+                # Consulta mínima de versiones; sólo se piden los segmentos
+                # que no están en caché con la versión vigente. Si ninguno
+                # del lote está en caché, se va directo a los segmentos.
+                versions = conn.execute(text(_select_versions_sql(len(chunk))), _pairs_params(chunk))
+                chunk = _read_from_cache(cache, chunk, versions, field, year, start_minute, minutes, result)
+                if not chunk:
+                    continue
+
+            params = dict(start=start, length=length, **_pairs_params(chunk))
+            with _FETCH_SECONDS.time():
+                rows = conn.execute(
+                    text(_select_raw_many_sql(dialect, field, len(chunk))),
+                    params
+                ).mappings().all()
+            _decode_rows(rows, cache, field, year, start_minute, minutes, result, page)
+
+    return result
+
+async def fetch_series_many_async(
+    pairs: Iterable[Tuple[int, int]],
+    from_dt: datetime,
+    to_dt: datetime,
+    field: str = "kumuliertedaten"
+) -> Dict[Tuple[int, int], np.ndarray]:
+    """
+    Variante asyncio de fetch_series_many, con el mismo resultado: parte
+    los contadores en lotes de FETCH_ASYNC_CHUNK_SIZE y mantiene hasta
+    FETCH_ASYNC_CONCURRENCY consultas en vuelo, cada una en su conexión del
+    engine async (db.get_async_engine). Sin driver async corre
+    fetch_series_many en un hilo.
+    """
+    async_engine = get_async_engine()
+    if async_engine is None or crosses_year(from_dt, to_dt):
+        return await asyncio.to_thread(fetch_series_many, pairs, from_dt, to_dt, field)
+
+    assert to_dt > from_dt, "to_dt debe ser posterior a from_dt"
+    keys = list(dict.fromkeys(pairs))
+    result = {key: _decode_u16_be(None) for key in keys}
+    minutes = minutes_between(from_dt, to_dt)
+    if minutes <= 0 or not keys:
+        return result
+
+    year = from_dt.year
+    start_minute = minute_index(from_dt)
+    keys = _read_from_store(keys, field, year, start_minute, minutes, result)
+    if not keys:
+        return result
+
+    cache = get_cache()
+    page = page_bounds(start_minute, minutes) if cache is not None else (start_minute, minutes)
+    start = page[0] * 2 + 1
+    length = page[1] * 2
+    dialect = async_engine.dialect.name
+    in_flight = asyncio.Semaphore(FETCH_ASYNC_CONCURRENCY)
+
+    async def fetch_chunk(chunk: List[Tuple[int, int]]) -> None:
+        async with in_flight, async_engine.connect() as conn:
+            if cache is not None and cache.holds((*key, field, year) for key in chunk):
+                versions = await conn.execute(text(_select_versions_sql(len(chunk))), _pairs_params(chunk))
+                chunk = _read_from_cache(cache, chunk, versions, field, year, start_minute, minutes, result)
+                if not chunk:
+                    return
+
+            params = dict(start=start, length=length, **_pairs_params(chunk))
+            with _FETCH_SECONDS.time():
+                rows = (await conn.execute(
+                    text(_select_raw_many_sql(dialect, field, len(chunk))),
+                    params
+                )).mappings().all()
+        _decode_rows(rows, cache, field, year, start_minute, minutes, result, page)
+
+    await asyncio.gather(*(
+        fetch_chunk(keys[chunk_start:chunk_start + FETCH_ASYNC_CHUNK_SIZE])
+        for chunk_start in range(0, len(keys), FETCH_ASYNC_CHUNK_SIZE)
+    ))
+    return result
+
+def fetch_range_many(
+    pairs: Iterable[Tuple[int, int]],
+    from_dt: datetime,
+    to_dt: datetime,
+    field: str = "kumuliertedaten",
+    now: Optional[datetime] = None
+) -> Dict[Tuple[int, int], MinuteSeries]:
+    """
+    Lee [from_dt, to_dt) aunque abarque varios años: un tramo por año
+    (plan_year_segments) unidos en un único array, con máscara de validez.
+
+    Cada tramo sale del archivo de ese año en el almacén local si existe;
+    si no, de la DB, con todos los tramos en la misma consulta (una por
+    cada FETCH_CHUNK_SIZE contadores). De la DB sólo valen los minutos que
+    el año siguiente todavía no pisó y que no son futuros respecto de
+    `now`; el resto queda en 0 y marcado como no válido.
+    """
+    assert to_dt > from_dt, "to_dt debe ser posterior a from_dt"
+    now = now or datetime.now()
+    keys = list(dict.fromkeys(pairs))
+    segments = plan_year_segments(from_dt, to_dt)
+    total = sum(segment.minutes for segment in segments)
+    values = {key: np.zeros(total, dtype=MINUTE_DTYPE) for key in keys}
+    valid = {key: np.zeros(total, dtype=bool) for key in keys}
+
+    def place(key, segment: YearSegment, raw: np.ndarray, first: int, last: int) -> None:
+        last = min(last, len(raw))
+        if last > first:
+            values[key][segment.offset + first:segment.offset + last] = raw[first:last]
+            valid[key][segment.offset + first:segment.offset + last] = True
+
+    # Almacén local: un archivo por año. El del año en curso es copia del
+    # BLOB, así que igual que en la DB vale sólo hasta `now`.
+    store = get_store()
+    store_bounds = [
+        (0, _ring_valid_range(segment, now)[1]) if segment.year >= _naive_utc(now).year else (0, segment.minutes)
+        for segment in segments
+    ]
+    pending: List[Tuple[int, int]] = []
+    for key in keys:
+        missing = False
+        for segment, (first, last) in zip(segments, store_bounds):
+            raw = store.read(*key, field, segment.year, segment.start_minute, segment.minutes) if store else None
+            if raw is None:
+                missing = True
+            else:
+                place(key, segment, raw, first, last)
+        if missing:
+            pending.append(key)
+    _SEGMENTS_BY_SOURCE["store"].inc(len(keys) - len(pending))
+
+    # DB: sólo los tramos que todavía están en el BLOB.
+    db_segments = [(segment, _ring_valid_range(segment, now)) for segment in segments]
+    db_segments = [(segment, bounds) for segment, bounds in db_segments if bounds[1] > bounds[0]]
+    if pending and db_segments:
+        params = {}
+        for i, (segment, _) in enumerate(db_segments):
+            params[f"s{i}"] = segment.start_minute * 2 + 1
+            params[f"l{i}"] = segment.minutes * 2
+        with engine.connect() as conn:
+            for chunk_start in range(0, len(pending), FETCH_CHUNK_SIZE):
+                chunk = pending[chunk_start:chunk_start + FETCH_CHUNK_SIZE]
+                with _FETCH_SECONDS.time():
+                    rows = conn.execute(
+                        text(_select_segments_many_sql(engine.dialect.name, field, len(db_segments), len(chunk))),
+                        dict(params, **_pairs_params(chunk))
+                    ).mappings().all()
+
+                fetched_bytes = 0
+                for row in rows:
+                    key = (row["device_id"], row["id"])
+                    for i, (segment, (first, last)) in enumerate(db_segments):
+                        if valid[key][segment.offset:segment.offset + segment.minutes].all():
+                            continue # ya vino del almacén local
+                        raw = _decode_u16_be(row[f"seg{i}"])
+                        fetched_bytes += raw.nbytes
+                        place(key, segment, raw, first, last)
+                _FETCH_BYTES.observe(fetched_bytes)
+                _SEGMENTS_BY_SOURCE["db"].inc(len(rows))
+
+    start = _naive_utc(from_dt)
+    return {key: MinuteSeries(start, values[key], valid[key]) for key in keys}
+
+def fetch_prefix_many(
+    pairs: Iterable[Tuple[int, int]],
+    from_dt: datetime,
+    to_dt: datetime,
+    field: str = "kumuliertedaten"
+) -> Dict[Tuple[int, int], Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Para los contadores con índice de sumas acumuladas en el almacén local
+    (blob_store.py), una función posiciones -> (sumas, conteos) con las
+    posiciones en minutos relativos a from_dt, lista para
+    aggregator.aggregate_windows_from_prefix. Los que no tienen índice (o
+    si el rango cruza el año) no aparecen: hay que leerlos con fetch_series_many.
+    """
+    store = get_store()
+    if store is None or to_dt <= from_dt or crosses_year(from_dt, to_dt):
+        return {}
+
+    year = from_dt.year
+    start_minute = minute_index(from_dt)
+    probe = np.zeros(1, dtype=np.int64)
+
+    lookups = {}
+    for device_id, counter_id in dict.fromkeys(pairs):
+        if store.prefix_at(device_id, counter_id, field, year, probe) is None:
+            continue
+        lookups[(device_id, counter_id)] = (
+            lambda positions, device_id=device_id, counter_id=counter_id:
+                store.prefix_at(device_id, counter_id, field, year, start_minute + positions)
+        )
+    return lookups
+
+def window_average(
+    device_id: int,
+    counter_id: int,
+    from_dt: datetime,
+    to_dt: datetime,
+    field: str = "kumuliertedaten"
+) -> Optional[float]:
+    """
+    Promedio de los minutos válidos de [from_dt, to_dt), o None si no hay
+    ninguno. Con índice local son dos lecturas; si no, se leen los crudos.
+    """
+    key = (device_id, counter_id)
+    lookup = fetch_prefix_many([key], from_dt, to_dt, field).get(key)
+    if lookup is not None:
+        sums, counts = lookup(np.array([0, minutes_between(from_dt, to_dt)], dtype=np.int64))
+        count = int(counts[1] - counts[0])
+        return int(sums[1] - sums[0]) / count if count else None
+
+    if crosses_year(from_dt, to_dt):
+        series = fetch_range_many([key], from_dt, to_dt, field)[key]
+        values = series.values[series.valid]
     else:
-        raise NotImplementedError(f"DB dialect '{dialect}' no soportado")
+        values = fetch_series_many([key], from_dt, to_dt, field)[key]
+    return float(values.mean()) if len(values) else None
 
-    with engine.connect() as conn:
-        row = conn.execute(
-            text(sql),
-            dict(start=start, length=length, device_id=device_id, counter_id=counter_id)
-        ).mappings().first()
-
-    hexdata = row["hexdata"] if row and row["hexdata"] else ""
-    values = _decode_hex_u16_be(hexdata)
-
-    series = []
-    t = from_dt
-    for v in values:
-        series.append((t, v))
-        t += timedelta(minutes=1)
-    return series
+def fetch_series(
+    device_id: int,
+    counter_id: int,
+    from_dt: datetime,
+    to_dt: datetime,
+    field: str = "kumuliertedaten"   # usamos crudo por defecto
+) -> MinuteSeries:
+    """
+    Serie minuto a minuto de [from_dt, to_dt) sobre los bytes leídos, sin
+    armar un datetime por minuto (ver minute_series.py).
+    """
+    if crosses_year(from_dt, to_dt):
+        return fetch_range_many([(device_id, counter_id)], from_dt, to_dt, field)[(device_id, counter_id)]
+    start, values = fetch_raw(device_id, counter_id, from_dt, to_dt, field)
+    return MinuteSeries(start, values)
+
+async def fetch_series_async(
+    device_id: int,
+    counter_id: int,
+    from_dt: datetime,
+    to_dt: datetime,
+    field: str = "kumuliertedaten"
+) -> MinuteSeries:
+    """fetch_series sin bloquear el event loop (ver fetch_series_many_async)."""
+    if crosses_year(from_dt, to_dt):
+        return await asyncio.to_thread(fetch_series, device_id, counter_id, from_dt, to_dt, field)
+    key = (device_id, counter_id)
+    values = (await fetch_series_many_async([key], from_dt, to_dt, field))[key]
+    return MinuteSeries(from_dt, values)
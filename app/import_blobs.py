@@ -0,0 +1,254 @@
+# /opt/aqua104/app/import_blobs.py
+import argparse
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+
+from db import engine, reset_engine_after_fork
+from models import Counter
+
+# Archivos que exporta el sistema de origen, uno por (dispositivo, contador, campo).
+FILE_PATTERN = re.compile(r"^counters-(\d+)_(\d+)_(kumuliertedaten|diagrammdaten)\.bin$")
+# Tamaño de un BLOB anual (ver seed_db.py). Otros tamaños se rechazan.
+YEAR_BLOB_BYTES = 1056958
+# Archivos por transacción.
+IMPORT_BATCH_FILES = 20
+# Bytes por escritura al copiar un archivo en el BLOB (SQLite).
+STREAM_CHUNK_BYTES = 1 << 16
+# Archivo con lo ya importado, dentro del directorio de origen.
+STATE_FILE = ".aqua104_import_state.json"
+
+# counters.id es SMALLINT
+MAX_COUNTER_ID = 32767
+
+_table = Counter.__table__
+
+
+class BlobFile(NamedTuple):
+    path: str
+    device_id: int
+    counter_id: int
+    field: str
+    size: int
+    version: str    # tamaño y mtime: si cambia, se vuelve a importar
+
+    @property
+    def key(self) -> str:
+        return os.path.basename(self.path)
+
+
+def scan_directory(
+    directory: str,
+    year_bytes: int = YEAR_BLOB_BYTES
+) -> Tuple[List[BlobFile], List[Tuple[str, str]]]:
+    """
+    Busca counters-<device>_<counter>_<field>.bin en `directory`.
+    Devuelve (archivos válidos, [(archivo, motivo)] de los rechazados).
+    """
+    files: List[BlobFile] = []
+    rejected: List[Tuple[str, str]] = []
+
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if not entry.is_file() or not entry.name.endswith(".bin"):
+            continue
+        match = FILE_PATTERN.match(entry.name)
+        if match is None:
+            rejected.append((entry.name, "nombre no reconocido"))
+            continue
+
+        device_id, counter_id, field = int(match.group(1)), int(match.group(2)), match.group(3)
+        stat = entry.stat()
+        if counter_id > MAX_COUNTER_ID:
+            rejected.append((entry.name, f"counter_id fuera de rango (máx. {MAX_COUNTER_ID})"))
+        elif stat.st_size != year_bytes:
+            rejected.append((entry.name, f"{stat.st_size} bytes, se esperaban {year_bytes}"))
+        else:
+            files.append(BlobFile(
+                entry.path, device_id, counter_id, field, stat.st_size,
+                f"{stat.st_size}:{stat.st_mtime_ns}"
+            ))
+
+    return files, rejected
+
+
+# --- estado para reanudar ---
+
+def _load_state(path: str) -> Dict[str, str]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _save_state(path: str, state: Dict[str, str]) -> None:
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+# --- escritura ---
+
+def _upsert_counter(conn: Connection, blob_file: BlobFile, blob, modified: datetime) -> None:
+    """Crea el contador si no existe y reemplaza el campo con `blob` (bytes o expresión SQL)."""
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        stmt = sqlite.insert(_table)
+    elif dialect in ("postgresql", "postgres"):
+        stmt = postgresql.insert(_table)
+    else:
+        raise NotImplementedError(f"DB dialect '{dialect}' no soportado")
+
+    stmt = stmt.values(
+        device_id=blob_file.device_id,
+        id=blob_file.counter_id,
+        modified=modified,
+        **{blob_file.field: blob}
+    )
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=["id", "device_id"],
+        set_={blob_file.field: stmt.excluded[blob_file.field], "modified": stmt.excluded.modified},
+    ))
+
+def _stream_into_sqlite(conn: Connection, blob_file: BlobFile) -> None:
+    # El BLOB ya tiene el tamaño final (zeroblob): se copia por tramos con
+    # E/S incremental, sin tener el archivo entero en memoria.
+    rowid = conn.execute(
+        select(literal_column("rowid")).select_from(_table)
+        .where(_table.c.device_id == blob_file.device_id, _table.c.id == blob_file.counter_id)
+    ).scalar_one()
+    dbapi_connection = conn.connection.driver_connection
+    with open(blob_file.path, "rb") as source, \
+            dbapi_connection.blobopen(_table.name, blob_file.field, rowid) as blob:
+        while True:
+            chunk = source.read(STREAM_CHUNK_BYTES)
+            if not chunk:
+                break
+            blob.write(chunk)
+
+def import_batch(files: List[BlobFile]) -> List[Tuple[str, str]]:
+    """
+    Importa `files` en una sola transacción: o quedan todos o ninguno.
+    Devuelve [(archivo, versión)] de lo importado, para el estado.
+    """
+    modified = datetime.now()
+    with engine.begin() as conn:
+        for blob_file in files:
+            if conn.dialect.name == "sqlite":
+                _upsert_counter(conn, blob_file, func.zeroblob(blob_file.size), modified)
+                _stream_into_sqlite(conn, blob_file)
+            else:
+                # PostgreSQL no tiene escritura parcial de bytea: un archivo
+                # por sentencia, así en memoria hay a lo sumo uno por proceso.
+                with open(blob_file.path, "rb") as source:
+                    _upsert_counter(conn, blob_file, source.read(), modified)
+    return [(blob_file.key, blob_file.version) for blob_file in files]
+
+
+def import_directory(
+    directory: str,
+    workers: int = 1,
+    batch_files: int = IMPORT_BATCH_FILES,
+    year_bytes: int = YEAR_BLOB_BYTES,
+    state_path: Optional[str] = None,
+    restart: bool = False
+) -> Dict[str, int]:
+    """
+    Importa todos los counters-*.bin de `directory` en counters, por lotes
+    de `batch_files` archivos (una transacción cada uno) repartidos en
+    `workers` procesos. Crea los contadores que no existan y actualiza
+    counters.modified.
+
+    Cada lote confirmado se anota en el estado (STATE_FILE en el directorio
+    o state_path): si el proceso se interrumpe, la siguiente ejecución
+    sigue desde ahí. Un archivo modificado desde su importación se vuelve a
+    importar; restart=True ignora el estado.
+    """
+    state_path = state_path or os.path.join(directory, STATE_FILE)
+    state = {} if restart else _load_state(state_path)
+
+    files, rejected = scan_directory(directory, year_bytes)
+    for name, reason in rejected:
+        print(f"Aviso: se omite {name}: {reason}")
+    pending = [blob_file for blob_file in files if state.get(blob_file.key) != blob_file.version]
+    batches = [pending[start:start + batch_files] for start in range(0, len(pending), batch_files)]
+    print(
+        f"{len(files)} archivos válidos, {len(files) - len(pending)} ya importados, "
+        f"{len(pending)} pendientes en {len(batches)} lotes."
+    )
+
+    if workers > 1 and engine.dialect.name == "sqlite":
+        print("SQLite admite un solo escritor: se importa con un proceso.")
+        workers = 1
+
+    imported = 0
+    failed = 0
+
+    def record(done: List[Tuple[str, str]]) -> None:
+        nonlocal imported
+        state.update(done)
+        _save_state(state_path, state)
+        imported += len(done)
+
+    if workers <= 1 or len(batches) <= 1:
+        for batch in batches:
+            try:
+                record(import_batch(batch))
+            except Exception as e:
+                failed += len(batch)
+                print(f"ERROR importando el lote de {batch[0].key}: {e}")
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=reset_engine_after_fork) as pool:
+            futures = {pool.submit(import_batch, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    record(future.result())
+                except Exception as e:
+                    failed += len(batch)
+                    print(f"ERROR importando el lote de {batch[0].key}: {e}")
+
+    return dict(
+        imported=imported,
+        skipped=len(files) - len(pending),
+        rejected=len(rejected),
+        failed=failed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Importa un directorio de counters-<device>_<counter>_<field>.bin a la tabla counters"
+    )
+    parser.add_argument("directory", help="directorio con los archivos .bin")
+    parser.add_argument("--workers", type=int, default=1, help="procesos en paralelo (sólo PostgreSQL)")
+    parser.add_argument(
+        "--batch-size", type=int, default=IMPORT_BATCH_FILES,
+        help="archivos por transacción"
+    )
+    parser.add_argument(
+        "--year-bytes", type=int, default=YEAR_BLOB_BYTES,
+        help="tamaño esperado de cada archivo"
+    )
+    parser.add_argument("--state", help=f"archivo de estado (por defecto, {STATE_FILE} en el directorio)")
+    parser.add_argument("--restart", action="store_true", help="ignorar el estado e importar todo de nuevo")
+    args = parser.parse_args()
+
+    summary = import_directory(
+        args.directory,
+        workers=args.workers,
+        batch_files=args.batch_size,
+        year_bytes=args.year_bytes,
+        state_path=args.state,
+        restart=args.restart
+    )
+    print(
+        f"Importación finalizada: {summary['imported']} importados, {summary['skipped']} ya estaban, "
+        f"{summary['rejected']} rechazados, {summary['failed']} con error."
+    )
@@ -0,0 +1,197 @@
+# /opt/aqua104/app/ingest.py
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from db import engine
+from fetcher import MINUTE_DTYPE, minute_index
+
+
+class MinuteWrite(NamedTuple):
+    """Minutos consecutivos de un contador a partir de start_dt."""
+    device_id: int
+    counter_id: int
+    field: str
+    start_dt: datetime
+    values: Union[Sequence[int], np.ndarray]
+
+
+class _Patch(NamedTuple):
+    device_id: int
+    counter_id: int
+    field: str
+    offset: int     # byte 0-based dentro del BLOB
+    data: bytes
+
+
+def _encode(values: Union[Sequence[int], np.ndarray]) -> bytes:
+    array = np.asarray(values)
+    if array.size and (array.min() < 0 or array.max() > 0xFFFF):
+        raise ValueError("Los valores por minuto deben estar entre 0 y 65535")
+    return array.astype(MINUTE_DTYPE).tobytes()
+
+
+def _patches(write: MinuteWrite) -> List[_Patch]:
+    """
+    Traduce una escritura a tramos de bytes. El BLOB es de un año: si el
+    rango cruza el 1 de enero, lo que sigue va desde el comienzo del BLOB.
+    """
+    data = _encode(write.values)
+    patches = []
+    start_dt = write.start_dt
+    while data:
+        next_year = datetime(start_dt.year + 1, 1, 1, tzinfo=start_dt.tzinfo)
+        fits = min(len(data), max((next_year - start_dt) // timedelta(minutes=1), 1) * 2)
+        patches.append(_Patch(
+            write.device_id, write.counter_id, write.field, minute_index(start_dt) * 2, data[:fits]
+        ))
+        data = data[fits:]
+        start_dt = next_year
+    return patches
+
+
+# --- PostgreSQL: overlay() en el servidor ---
+
+def _overlay_sql(field: str) -> str:
+    # Si el BLOB es más corto que el tramo (o NULL), se completa con ceros
+    # para que los datos queden en su minuto y no pegados al final.
+    current = f"COALESCE({field}, CAST('' AS BYTEA))"
+    return f"""
+        UPDATE counters
+        SET {field} = overlay(
+                CASE WHEN octet_length({current}) >= :end_pos THEN {current}
+                     ELSE {current} || decode(repeat('00', :end_pos - octet_length({current})), 'hex')
+                END
+                PLACING :data FROM :start FOR :length
+            ),
+            modified = :modified
+        WHERE device_id = :device_id AND id = :counter_id
+    """
+
+
+def _write_postgresql(conn: Connection, patches: List[_Patch], modified: datetime) -> int:
+    written = 0
+    for field in {patch.field for patch in patches}:
+        params = [
+            dict(
+                device_id=patch.device_id,
+                counter_id=patch.counter_id,
+                data=patch.data,
+                start=patch.offset + 1,
+                length=len(patch.data),
+                end_pos=patch.offset + len(patch.data),
+                modified=modified,
+            )
+            for patch in patches if patch.field == field
+        ]
+        written += conn.execute(text(_overlay_sql(field)), params).rowcount
+    return written
+
+
+# --- SQLite: E/S incremental de BLOBs ---
+
+def _write_sqlite(conn: Connection, patches: List[_Patch], modified: datetime) -> int:
+    # Cualquier UPDATE sobre counters reescribe la fila entera (~1 MB por
+    # BLOB). La versión va a counter_writes, una vez por contador y lote; ese
+    # INSERT además abre la transacción (los parches del lote van juntos).
+    conn.execute(
+        text("""
+            INSERT INTO counter_writes (device_id, counter_id, modified)
+            SELECT device_id, id, :modified FROM counters
+            WHERE device_id = :device_id AND id = :counter_id
+            ON CONFLICT (device_id, counter_id) DO UPDATE SET modified = excluded.modified
+        """),
+        [
+            dict(modified=modified, device_id=device_id, counter_id=counter_id)
+            for device_id, counter_id in dict.fromkeys((patch.device_id, patch.counter_id) for patch in patches)
+        ]
+    )
+
+    patches_by_blob = defaultdict(list)
+    for patch in patches:
+        patches_by_blob[(patch.device_id, patch.counter_id, patch.field)].append(patch)
+
+    dbapi_connection = conn.connection.driver_connection
+    written = 0
+    for (device_id, counter_id, field), blob_patches in patches_by_blob.items():
+        # length() de un BLOB no lo lee: sale del encabezado de la fila.
+        row = conn.execute(
+            text(f"SELECT rowid, length({field}) FROM counters WHERE device_id = :device_id AND id = :counter_id"),
+            dict(device_id=device_id, counter_id=counter_id)
+        ).first()
+        if row is None:
+            continue
+        rowid, length = row[0], row[1] or 0
+
+        # La E/S incremental no puede cambiar el tamaño: sólo si el BLOB
+        # queda corto (o es NULL) se agranda con ceros, reescribiendo la fila.
+        end_pos = max(patch.offset + len(patch.data) for patch in blob_patches)
+        if length < end_pos:
+            conn.execute(
+                text(f"""
+                    UPDATE counters
+                    SET {field} = CAST(COALESCE({field}, X'') || zeroblob(:grow) AS BLOB)
+                    WHERE rowid = :rowid
+                """),
+                dict(grow=end_pos - length, rowid=rowid)
+            )
+
+        with dbapi_connection.blobopen("counters", field, rowid) as blob:
+            for patch in blob_patches:
+                blob.seek(patch.offset)
+                blob.write(patch.data)
+        written += len(blob_patches)
+    return written
+
+
+def write_minutes_many(
+    writes: Iterable[MinuteWrite],
+    connection: Optional[Connection] = None
+) -> int:
+    """
+    Escribe muchos tramos de minutos (de uno o varios contadores) en una
+    sola transacción, tocando sólo los bytes afectados del BLOB: overlay()
+    en PostgreSQL y E/S incremental de BLOBs en SQLite. Actualiza la
+    versión del contador (counters.modified en PostgreSQL, counter_writes
+    en SQLite), que invalida la caché de segmentos y dispara la
+    sincronización del almacén local.
+
+    Con connection se usa la transacción de quien llama (sin commit).
+    Devuelve cuántos tramos se aplicaron (los contadores inexistentes se omiten).
+    """
+    patches = [patch for write in writes for patch in _patches(write)]
+    if not patches:
+        return 0
+    modified = datetime.now()
+
+    if connection is None:
+        with engine.begin() as conn:
+            return _write_patches(conn, patches, modified)
+    return _write_patches(connection, patches, modified)
+
+
+def _write_patches(conn: Connection, patches: List[_Patch], modified: datetime) -> int:
+    dialect = conn.dialect.name
+    if dialect in ("postgresql", "postgres"):
+        return _write_postgresql(conn, patches, modified)
+    if dialect == "sqlite":
+        return _write_sqlite(conn, patches, modified)
+    raise NotImplementedError(f"DB dialect '{dialect}' no soportado")
+
+
+def write_minutes(
+    device_id: int,
+    counter_id: int,
+    field: str,
+    start_dt: datetime,
+    values: Union[Sequence[int], np.ndarray],
+    connection: Optional[Connection] = None
+) -> int:
+    """Escribe values (uno por minuto) desde start_dt. Ver write_minutes_many."""
+    return write_minutes_many(
+        [MinuteWrite(device_id, counter_id, field, start_dt, values)], connection
+    )
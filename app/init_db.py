@@ -1,7 +1,12 @@
 # /opt/aqua104/app/init_db.py
 from db import engine
 from models import Base
+from writer import ensure_upsert_index
+from retention import ensure_unsent_index
 
 if __name__ == "__main__":
     Base.metadata.create_all(engine)
+    # Bases creadas con versiones anteriores no tienen el índice único.
+    ensure_upsert_index(engine)
+    ensure_unsent_index(engine)
     print("SQLite schema created at /opt/aqua104/app/local.sqlite")
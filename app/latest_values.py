@@ -0,0 +1,248 @@
+# /opt/aqua104/app/latest_values.py
+import time
+from datetime import datetime
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# Nombre del segmento de memoria compartida (/dev/shm/aqua104_latest).
+SHM_NAME = "aqua104_latest"
+
+MAGIC = 0xA0104
+LAYOUT_VERSION = 1
+MIN_CAPACITY = 1024
+
+# Calidad IEC-104 (QDS): 0 = válido; bit IV = inválido.
+QUALITY_GOOD = 0x00
+QUALITY_INVALID = 0x80
+
+_HEADER_DTYPE = np.dtype([
+    ("magic", "<u4"),
+    ("version", "<u4"),
+    ("capacity", "<u4"),
+    ("count", "<u4"),      # slots en uso (el directorio de claves sólo crece)
+    ("retired", "<u4"),    # 1 = el escritor creó un segmento nuevo, reconectar
+    ("_pad", "<u4"),
+])
+
+# seq es un seqlock por slot: impar mientras el escritor lo está modificando.
+_SLOT_DTYPE = np.dtype([
+    ("seq", "<u4"),
+    ("asdu", "<u4"),
+    ("ioa", "<u4"),
+    ("quality", "<u4"),
+    ("timestamp", "<i8"),  # epoch (s) de timestamp_start; 0 = sin dato
+    ("value", "<f8"),
+], align=True)
+
+LatestValue = Tuple[float, datetime, int]  # (valor, timestamp, calidad)
+
+
+def _open_segment(create: bool, size: int = 0) -> shared_memory.SharedMemory:
+    """
+    Abre/crea el segmento sin que el resource_tracker lo borre al salir el
+    proceso: el exportador termina en cada corrida y la tabla debe seguir.
+    """
+    segment = shared_memory.SharedMemory(name=SHM_NAME, create=create, size=size)
+    try:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    except Exception:
+        pass
+    return segment
+
+
+def _unlink_segment(segment: shared_memory.SharedMemory) -> None:
+    # unlink() desregistra del resource_tracker: lo registramos de nuevo
+    # para que no se queje de un nombre que ya habíamos sacado.
+    resource_tracker.register(segment._name, "shared_memory")
+    segment.unlink()
+
+
+class LatestValueTable:
+    """
+    Tabla de layout fijo en memoria compartida con un slot por (ASDU, IOA):
+    valor, timestamp y calidad del último bloque agregado.
+
+    Un único escritor (el exportador) y cualquier cantidad de lectores
+    (el slave IEC-104). Los lectores no toman locks: cada slot tiene un
+    seqlock y se relee si cambió durante la copia.
+    """
+
+    def __init__(self, segment: shared_memory.SharedMemory):
+        self._segment = segment
+        self._header = np.ndarray((1,), dtype=_HEADER_DTYPE, buffer=segment.buf)
+        capacity = int(self._header["capacity"][0])
+        self._slots = np.ndarray(
+            (capacity,), dtype=_SLOT_DTYPE, buffer=segment.buf, offset=_HEADER_DTYPE.itemsize
+        )
+        self._index: Dict[Tuple[int, int], int] = {}
+        self._indexed_count = 0
+
+    # --- apertura ---
+
+    @classmethod
+    def _create(cls, capacity: int) -> "LatestValueTable":
+        size = _HEADER_DTYPE.itemsize + capacity * _SLOT_DTYPE.itemsize
+        segment = _open_segment(create=True, size=size)
+        segment.buf[:size] = bytes(size)
+        header = np.ndarray((1,), dtype=_HEADER_DTYPE, buffer=segment.buf)
+        header["capacity"] = capacity
+        header["version"] = LAYOUT_VERSION
+        header["magic"] = MAGIC
+        del header
+        return cls(segment)
+
+    @classmethod
+    def attach(cls) -> Optional["LatestValueTable"]:
+        """Lector: se conecta a la tabla existente, o None si no hay."""
+        try:
+            segment = _open_segment(create=False)
+        except FileNotFoundError:
+            return None
+        header = np.ndarray((1,), dtype=_HEADER_DTYPE, buffer=segment.buf)
+        valid = header["magic"][0] == MAGIC and header["version"][0] == LAYOUT_VERSION
+        del header
+        if not valid:
+            segment.close()
+            return None
+        return cls(segment)
+
+    @classmethod
+    def open_writer(cls, keys: Iterable[Tuple[int, int]]) -> "LatestValueTable":
+        """
+        Escritor: se conecta a la tabla (o la crea) y se asegura de que
+        tenga un slot para cada (ASDU, IOA). Si no hay lugar, crea un
+        segmento más grande, copia los slots y avisa a los lectores.
+        """
+        keys = list(dict.fromkeys(keys))
+        table = cls.attach()
+        if table is not None and table._free_slots() >= len(table._missing(keys)):
+            table._add_keys(keys)
+            return table
+
+        old = table
+        known = list(old.items()) if old is not None else []
+        capacity = max(MIN_CAPACITY, 2 * (len(known) + len(keys)))
+        if old is not None:
+            old._header["retired"] = 1
+            _unlink_segment(old._segment)
+            old.close()
+
+        table = cls._create(capacity)
+        for (asdu, ioa), (value, timestamp, quality) in known:
+            table.update(asdu, ioa, value, timestamp, quality)
+        table._add_keys(keys)
+        return table
+
+    def close(self) -> None:
+        self._header = None
+        self._slots = None
+        self._segment.close()
+
+    # --- directorio de claves ---
+
+    def _refresh_index(self) -> None:
+        count = int(self._header["count"][0])
+        for slot in range(self._indexed_count, count):
+            key = (int(self._slots["asdu"][slot]), int(self._slots["ioa"][slot]))
+            self._index[key] = slot
+        self._indexed_count = count
+
+    def _missing(self, keys: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        self._refresh_index()
+        return [key for key in keys if key not in self._index]
+
+    def _free_slots(self) -> int:
+        return int(self._header["capacity"][0] - self._header["count"][0])
+
+    def _add_keys(self, keys: List[Tuple[int, int]]) -> None:
+        for asdu, ioa in self._missing(keys):
+            slot = int(self._header["count"][0])
+            self._slots[slot] = (0, asdu, ioa, QUALITY_INVALID, 0, 0.0)
+            self._index[(asdu, ioa)] = slot
+            # El slot se publica recién cuando está completo.
+            self._header["count"] = slot + 1
+        self._indexed_count = int(self._header["count"][0])
+
+    # --- escritura ---
+
+    def update(
+        self,
+        asdu: int,
+        ioa: int,
+        value: float,
+        timestamp: datetime,
+        quality: int = QUALITY_GOOD
+    ) -> None:
+        """
+        Escribe el último valor de (ASDU, IOA). Una clave nueva ocupa un slot
+        libre: open_writer() ya reserva lugar para todas las configuradas.
+        """
+        self._refresh_index()
+        slot = self._index.get((asdu, ioa))
+        if slot is None:
+            self._add_keys([(asdu, ioa)])
+            slot = self._index[(asdu, ioa)]
+
+        record = self._slots[slot:slot + 1]
+        record["seq"] += 1
+        record["value"] = value
+        record["timestamp"] = int(timestamp.timestamp())
+        record["quality"] = quality
+        record["seq"] += 1
+
+    # --- lectura ---
+
+    @property
+    def retired(self) -> bool:
+        return bool(self._header["retired"][0])
+
+    def _read_slot(self, slot: int) -> Optional[LatestValue]:
+        record = self._slots[slot:slot + 1]
+        while True:
+            before = int(record["seq"][0])
+            if before % 2:
+                time.sleep(0)
+                continue
+            value = float(record["value"][0])
+            timestamp = int(record["timestamp"][0])
+            quality = int(record["quality"][0])
+            if int(record["seq"][0]) == before:
+                break
+        if timestamp == 0:
+            return None
+        return value, datetime.fromtimestamp(timestamp), quality
+
+    def get(self, asdu: int, ioa: int) -> Optional[LatestValue]:
+        self._refresh_index()
+        slot = self._index.get((asdu, ioa))
+        return None if slot is None else self._read_slot(slot)
+
+    def items(self, asdu: Optional[int] = None) -> Iterator[Tuple[Tuple[int, int], LatestValue]]:
+        """((ASDU, IOA), (valor, timestamp, calidad)) de los slots con dato."""
+        self._refresh_index()
+        for key, slot in sorted(self._index.items()):
+            if asdu is not None and key[0] != asdu:
+                continue
+            latest = self._read_slot(slot)
+            if latest is not None:
+                yield key, latest
+
+
+class LatestValueReader:
+    """
+    Acceso de sólo lectura para el slave: se conecta perezosamente y se
+    reconecta si el exportador reemplazó el segmento.
+    """
+
+    def __init__(self):
+        self._table: Optional[LatestValueTable] = None
+
+    def table(self) -> Optional[LatestValueTable]:
+        if self._table is not None and self._table.retired:
+            self._table.close()
+            self._table = None
+        if self._table is None:
+            self._table = LatestValueTable.attach()
+        return self._table
@@ -1,89 +1,513 @@
+import argparse
+import asyncio
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
-from db import get_session
-from models import Iec104Config, Iec104AggregatedData 
-from fetcher import fetch_series
-from aggregator import aggregate_by_window
-from units import convert_value
+from db import dispose_async_engine, engine, get_session, reset_engine_after_fork
+from blob_store import get_store
+from models import Counter, Iec104Config, Iec104ExportWatermark
+from fetcher import crosses_year, fetch_prefix_many, fetch_range_many, fetch_series_many, fetch_series_many_async, minutes_between
+from aggregator import aggregate_windows, aggregate_windows_from_prefix
+from units import unit_scale
+from writer import upsert_aggregated
+from sql_aggregator import aggregate_windows_in_db
+from latest_values import LatestValueTable
+import metrics
+from metrics import COUNT_BUCKETS, REGISTRY
 # from sender import send_to_scada # Ya no se usa aquí
 
+# Sin marca de agua previa se exportan las últimas 24 horas (como antes).
+INITIAL_LOOKBACK = timedelta(hours=24)
+# Si el exportador estuvo parado, no se recupera más atrás que esto.
+MAX_CATCHUP = timedelta(days=31)
+# Minutos recientes que pueden no haber llegado todavía: un bloque se
+# exporta recién cuando termina antes de la hora de ejecución menos esto
+# (y antes de counters.last_read, si el lector lo informa).
+SETTLE_DELAY = timedelta(minutes=10)
+# Contadores por tarea cuando se reparte el trabajo entre procesos.
+DEFAULT_CHUNK_SIZE = 200
+# Calcular los promedios en la DB (sql_aggregator.py) en lugar de traer
+# los minutos: útil en equipos chicos con el servidor de DB al lado.
+AGGREGATE_IN_DB = False
+# Leer los minutos con el engine async (fetcher.fetch_series_many_async):
+# varias consultas en vuelo por tarea. Rinde con PostgreSQL y asyncpg.
+ASYNC_FETCH = False
+# Publicar el último valor de cada IOA en memoria compartida para el slave.
+PUBLISH_LATEST_VALUES = True
 
-def run_daily_export() -> None:
+_AGGREGATE_SECONDS = REGISTRY.histogram(
+    "aqua104_aggregate_seconds", "Promedios y conversión de un grupo de contadores"
+)
+_ROWS_WRITTEN = REGISTRY.histogram(
+    "aqua104_rows_written", "Filas agregadas escritas por upsert", COUNT_BUCKETS
+)
+_PERSIST_SECONDS = REGISTRY.histogram(
+    "aqua104_persist_seconds", "Upsert y marcas de agua de un grupo de contadores"
+)
+_EXPORT_SECONDS = REGISTRY.histogram(
+    "aqua104_export_seconds", "Duración total de una corrida del exportador"
+)
+
+
+class ExportJob(NamedTuple):
+    """
+    Trabajo pendiente de un contador, sin objetos ORM para poder enviarlo
+    a otro proceso. pending: {ventana: (ioa_única, desde, hasta)}.
+    """
+    device_id: int
+    counter_id: int
+    common_address: int
+    flow_unit: str
+    pending: Dict[int, Tuple[int, datetime, datetime]]
+
+
+def pending_block_range(
+    last_block_end: Optional[datetime],
+    execution_time: datetime,
+    window_minutes: int
+) -> Optional[Tuple[datetime, datetime]]:
+    """
+    Devuelve el tramo [desde, hasta) con los bloques de window_minutes ya
+    cerrados y todavía no exportados, o None si no cerró ninguno nuevo.
+    Los bloques se alinean a la marca de agua, así cada ejecución sigue
+    exactamente donde terminó la anterior.
+    """
+    window = timedelta(minutes=window_minutes)
+    block_start = last_block_end or (execution_time - INITIAL_LOOKBACK)
+
+    # Saltamos bloques enteros (sin perder la alineación) si quedó muy atrás.
+    oldest_allowed = execution_time - MAX_CATCHUP
+    if block_start < oldest_allowed:
+        block_start += -(-(oldest_allowed - block_start) // window) * window
+
+    closed_blocks = (execution_time - block_start) // window
+    if closed_blocks <= 0:
+        return None
+    return block_start, block_start + closed_blocks * window
+
+
+def plan_export(
+    enabled_configs: List[Iec104Config],
+    watermarks: Dict[Tuple[int, int, int], Iec104ExportWatermark],
+    execution_time: datetime,
+    last_reads: Optional[Dict[Tuple[int, int], datetime]] = None
+) -> Dict[Tuple[datetime, datetime], List[ExportJob]]:
+    """
+    Por cada contador, los bloques pendientes de cada ventana.
+    Se agrupan por rango de lectura para leer juntos los contadores que
+    están al día (en régimen normal, casi todos comparten el mismo rango).
+
+    Sólo se toman bloques que terminan antes de execution_time - SETTLE_DELAY
+    y, si last_reads trae la última lectura del contador, no después de
+    ella: lo que sigue todavía no llegó (o es el año anterior del BLOB).
+    """
+    jobs_by_range = defaultdict(list)
+    last_reads = last_reads or {}
+    settled_until = execution_time - SETTLE_DELAY
+
+    for config in enabled_configs:
+        asdu = config.common_address
+        base_ioa = config.information_object_address # IOA base del medidor
+
+        ready_until = settled_until
+        last_read = last_reads.get((config.device_id, config.counter_id))
+        if last_read is not None:
+            ready_until = min(ready_until, last_read.replace(second=0, microsecond=0) + timedelta(minutes=1))
+
+        pending = {}
+        # USAMOS ENUMERATE PARA OBTENER EL ÍNDICE (ioa_offset)
+        for ioa_offset, window_minutes in enumerate(config.periods):
+            # Cálculo de la IOA única (IOA base + índice del periodo)
+            unique_ioa = base_ioa + ioa_offset
+
+            mark = watermarks.get((asdu, unique_ioa, window_minutes))
+            block_range = pending_block_range(
+                mark.last_block_end if mark else None,
+                ready_until,
+                window_minutes
+            )
+            if block_range:
+                pending[window_minutes] = (unique_ioa, *block_range)
+
+        if pending:
+            read_from = min(block_from for _, block_from, _ in pending.values())
+            read_to = max(block_to for _, _, block_to in pending.values())
+            jobs_by_range[(read_from, read_to)].append(ExportJob(
+                device_id=config.device_id,
+                counter_id=config.counter_id,
+                common_address=asdu,
+                flow_unit=config.flow_unit,
+                pending=pending
+            ))
+
+    return jobs_by_range
+
+
+def compute_export_chunk(
+    read_from: datetime,
+    read_to: datetime,
+    jobs: List[ExportJob],
+    aggregate_in_db: bool = False,
+    async_fetch: bool = False
+) -> Tuple[List[dict], List[Tuple[int, int, int, datetime]]]:
+    """
+    Lee, agrega y convierte un grupo de contadores que comparten rango.
+    No escribe en la DB: devuelve (filas agregadas, marcas de agua nuevas)
+    para que un único escritor las persista.
+    """
+    aggregated_rows = []
+    new_watermarks = []
+
+    # Promedios calculados en la DB: de esos contadores no se lee nada más.
+    # Un rango que cruza el año (p. ej. la corrida de las 00:30 del 1 de
+    # enero) necesita un tramo por año: se lee con fetch_range_many.
+    spans_years = crosses_year(read_from, read_to)
+    in_db_by_counter = (
+        _aggregate_chunk_in_db(read_from, read_to, jobs) if aggregate_in_db and not spans_years else {}
+    )
+    pairs = [
+        (job.device_id, job.counter_id)
+        for job in jobs
+        if (job.device_id, job.counter_id) not in in_db_by_counter
+    ]
+
+    # Con índice de sumas acumuladas en el almacén local, los promedios
+    # salen de los bordes de cada bloque sin leer los minutos.
+    prefix_by_counter = fetch_prefix_many(
+        pairs, read_from, read_to, field="kumuliertedaten"
+    ) if pairs else {}
+
+    # El resto: leer de una vez la serie cruda minuto a minuto (l/min)
+    # de todos los contadores del grupo, desde kumuliertedaten.
+    raw_pairs = [pair for pair in pairs if pair not in prefix_by_counter]
+    valid_by_counter = {}
+    if not raw_pairs:
+        raw_values_by_counter = {}
+    elif spans_years:
+        series_by_counter = fetch_range_many(raw_pairs, read_from, read_to, field="kumuliertedaten")
+        raw_values_by_counter = {key: series.values for key, series in series_by_counter.items()}
+        valid_by_counter = {key: series.valid for key, series in series_by_counter.items()}
+    elif async_fetch:
+        raw_values_by_counter = asyncio.run(_fetch_series_async(raw_pairs, read_from, read_to))
+    else:
+        raw_values_by_counter = fetch_series_many(
+            pairs=raw_pairs,
+            from_dt=read_from,
+            to_dt=read_to,
+            field="kumuliertedaten"
+        )
+
+    aggregate_started = time.perf_counter()
+    for job in jobs:
+        key = (job.device_id, job.counter_id)
+        # Unidad solicitada por el cliente, resuelta una vez: los promedios
+        # salen ya convertidos, array por array.
+        scale = unit_scale(job.flow_unit)
+        block_ranges = {
+            window_minutes: (
+                minutes_between(read_from, block_from),
+                minutes_between(read_from, block_to)
+            )
+            for window_minutes, (_, block_from, block_to) in job.pending.items()
+        }
+
+        # Cálculo de los promedios por reloj para todas las ventanas a la vez,
+        # cada una sobre su propio tramo pendiente.
+        if key in in_db_by_counter:
+            averaged_by_window = {
+                window_minutes: (offsets, scale.apply(averages))
+                for window_minutes, (offsets, averages) in in_db_by_counter[key].items()
+            }
+        elif key in prefix_by_counter:
+            averaged_by_window = aggregate_windows_from_prefix(
+                prefix_at=prefix_by_counter[key],
+                windows=list(job.pending),
+                from_dt=read_from,
+                to_dt=read_to,
+                block_ranges=block_ranges,
+                scale=scale
+            )
+        else:
+            averaged_by_window = aggregate_windows(
+                values=raw_values_by_counter[key],
+                windows=list(job.pending),
+                from_dt=read_from,
+                to_dt=read_to,
+                valid=valid_by_counter.get(key),
+                block_ranges=block_ranges,
+                scale=scale
+            )
+
+        for window_minutes, (unique_ioa, block_from, block_to) in job.pending.items():
+            block_offsets, block_values = averaged_by_window[window_minutes]
+
+            for block_offset, converted_value in zip(block_offsets.tolist(), block_values.tolist()):
+                aggregated_rows.append(dict(
+                    common_address=job.common_address,
+                    ioa_address=unique_ioa, # IOA única
+                    period_minutes=window_minutes,
+                    timestamp_start=read_from + timedelta(minutes=block_offset),
+                    value=converted_value
+                ))
+
+            # La marca avanza hasta el último bloque con datos: si la ventana
+            # no produjo ninguno, se vuelve a intentar en la próxima corrida.
+            if block_offsets.size:
+                last_block_end = read_from + timedelta(minutes=int(block_offsets.max()) + window_minutes)
+                new_watermarks.append((job.common_address, unique_ioa, window_minutes, last_block_end))
+    _AGGREGATE_SECONDS.observe(time.perf_counter() - aggregate_started)
+
+    return aggregated_rows, new_watermarks
+
+
+async def _fetch_series_async(
+    pairs: List[Tuple[int, int]],
+    from_dt: datetime,
+    to_dt: datetime
+) -> Dict[Tuple[int, int], Any]:
+    """Un loop por tarea: las conexiones async se cierran en el mismo loop que las abrió."""
+    try:
+        return await fetch_series_many_async(pairs, from_dt, to_dt, field="kumuliertedaten")
+    finally:
+        await dispose_async_engine()
+
+
+def _compute_export_chunk_in_worker(*task) -> Tuple[List[dict], List, List]:
+    """En un worker del pool: devuelve además las métricas de esta tarea."""
+    REGISTRY.reset()
+    aggregated_rows, new_watermarks = compute_export_chunk(*task)
+    return aggregated_rows, new_watermarks, REGISTRY.export_state()
+
+
+def _aggregate_chunk_in_db(
+    read_from: datetime,
+    read_to: datetime,
+    jobs: List[ExportJob]
+) -> Dict[Tuple[int, int], Dict[int, Tuple]]:
+    """
+    Promedios calculados en la DB. Una consulta por (ventana, tramo
+    pendiente): en régimen normal todos los contadores del grupo comparten
+    los mismos tramos, así que son pocas.
+    """
+    pairs_by_range = defaultdict(list)
+    for job in jobs:
+        for window_minutes, (_, block_from, block_to) in job.pending.items():
+            block_range = (minutes_between(read_from, block_from), minutes_between(read_from, block_to))
+            pairs_by_range[(window_minutes, block_range)].append((job.device_id, job.counter_id))
+
+    averaged_by_counter = defaultdict(dict)
+    for (window_minutes, block_range), pairs in pairs_by_range.items():
+        in_db = aggregate_windows_in_db(
+            pairs,
+            windows=[window_minutes],
+            from_dt=read_from,
+            to_dt=read_to,
+            field="kumuliertedaten",
+            block_ranges={window_minutes: block_range}
+        )
+        for key, averaged_by_window in in_db.items():
+            averaged_by_counter[key][window_minutes] = averaged_by_window[window_minutes]
+    return averaged_by_counter
+
+
+def publish_latest_values(
+    enabled_configs: List[Iec104Config],
+    latest_by_key: Dict[Tuple[int, int], Tuple[datetime, float]]
+) -> None:
+    """
+    Escribe en la tabla de memoria compartida (latest_values.py) el último
+    bloque de cada (ASDU, IOA). Un fallo acá no invalida la exportación:
+    el slave sigue pudiendo leer de la DB.
+    """
+    keys = [
+        (config.common_address, config.information_object_address + ioa_offset)
+        for config in enabled_configs
+        for ioa_offset, _ in enumerate(config.periods)
+    ]
+    try:
+        table = LatestValueTable.open_writer(keys)
+        for (asdu, ioa), (timestamp, value) in latest_by_key.items():
+            table.update(asdu, ioa, value, timestamp)
+        table.close()
+    except Exception as e:
+        print(f"Aviso: no se pudo publicar la tabla de últimos valores: {e}")
+
+
+def run_daily_export(
+    workers: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    aggregate_in_db: bool = AGGREGATE_IN_DB,
+    metrics_json: Optional[str] = None,
+    async_fetch: bool = ASYNC_FETCH
+) -> None:
     """
     Este es el orquestador principal.
     Lee configs, extrae datos, calcula promedios/convierte y ALMACENA el resultado
     en la tabla Iec104AggregatedData, listo para ser enviado por el servidor IEC-104.
-    """
 
+    Es incremental: por cada (ASDU, IOA, periodo) sólo procesa los bloques
+    cerrados desde su marca de agua (Iec104ExportWatermark), de modo que se
+    puede ejecutar cada pocos minutos sin recalcular ni duplicar datos.
+
+    Con workers > 1 la lectura/agregación se reparte en un pool de procesos
+    (tareas de hasta chunk_size contadores); la escritura la hace siempre
+    este proceso, en una única transacción.
+
+    Con aggregate_in_db los promedios se calculan en la DB y sólo viaja un
+    renglón por bloque (ver sql_aggregator.py). Con async_fetch los minutos
+    se leen con varias consultas en vuelo (fetcher.fetch_series_many_async).
+
+    Al terminar resume los tiempos por etapa (metrics.py) y, con
+    metrics_json (o METRICS_JSON_PATH), los vuelca completos en JSON.
+    """
+    run_started = time.perf_counter()
     database_session = get_session()
 
-    # Rango de trabajo: últimas 24 horas hasta el minuto actual.
+    # Hora de referencia: sólo se exportan bloques que terminan antes de ella.
     execution_time = datetime.now().replace(second=0, microsecond=0)
-    to_datetime = execution_time
-    from_datetime = to_datetime - timedelta(hours=24)
 
     enabled_configs = (
         database_session.query(Iec104Config)
         .filter_by(enabled=True)
         .all()
     )
-    
-    saved_count = 0
 
-    for config in enabled_configs:
-        device_id = config.device_id
-        counter_id = config.counter_id
-        asdu = config.common_address
-        base_ioa = config.information_object_address # IOA base del medidor
+    # El almacén local (blob_store.py) no se compara con la DB al leer: se
+    # pone al día antes, así las marcas de agua no avanzan sobre minutos viejos.
+    store = get_store()
+    if store is not None:
+        store.sync(engine, pairs=[(config.device_id, config.counter_id) for config in enabled_configs])
 
-        # 1. Leer la serie cruda minuto a minuto (l/min) desde kumuliertedaten.
-        raw_minute_series = fetch_series(
-            device_id=device_id,
-            counter_id=counter_id,
-            from_dt=from_datetime,
-            to_dt=to_datetime,
-            field="kumuliertedaten"
+    last_reads = {
+        (device_id, counter_id): last_read
+        for device_id, counter_id, last_read in (
+            database_session.query(Counter.device_id, Counter.id, Counter.last_read)
+            .join(Counter.iec104_config)
+            .filter(Iec104Config.enabled.is_(True), Counter.last_read.isnot(None))
         )
+    }
+    watermarks = {
+        (mark.common_address, mark.ioa_address, mark.period_minutes): mark
+        for mark in database_session.query(Iec104ExportWatermark).all()
+    }
 
-        # 2. Procesar y almacenar para cada ventana pedida.
-        # USAMOS ENUMERATE PARA OBTENER EL ÍNDICE (ioa_offset)
-        for ioa_offset, window_minutes in enumerate(config.periods):
-            
-            # Cálculo de los promedios por reloj.
-            averaged_series = aggregate_by_window(
-                raw_series=raw_minute_series,
-                window_minutes=window_minutes,
-                from_dt=from_datetime,
-                to_dt=to_datetime
-            )
+    # 1. Planificar los bloques pendientes y partirlos en tareas.
+    jobs_by_range = plan_export(enabled_configs, watermarks, execution_time, last_reads)
+    tasks = [
+        (read_from, read_to, jobs[chunk_start:chunk_start + chunk_size], aggregate_in_db, async_fetch)
+        for (read_from, read_to), jobs in jobs_by_range.items()
+        for chunk_start in range(0, len(jobs), chunk_size)
+    ]
 
-            # Cálculo de la IOA única (IOA base + índice del periodo)
-            unique_ioa = base_ioa + ioa_offset
+    saved_count = 0
+    connection = database_session.connection()
+    latest_by_key: Dict[Tuple[int, int], Tuple[datetime, float]] = {}
 
-            # 3. Guardar cada dato procesado en el buffer de la DB.
-            for timestamp, raw_average_value in averaged_series:
-                
-                # Convertir el valor a la unidad solicitada por el cliente.
-                converted_value = convert_value(raw_average_value, config.flow_unit)
-                
-                # Crear el objeto de dato agregado.
-                new_data = Iec104AggregatedData(
-                    common_address=asdu,
-                    ioa_address=unique_ioa, # IOA única
-                    period_minutes=window_minutes,
-                    timestamp_start=timestamp,
-                    value=converted_value
+    def persist(aggregated_rows, new_watermarks):
+        # 3. Upsert en bloque y avance de marcas de agua, en la misma transacción.
+        nonlocal saved_count
+        persist_started = time.perf_counter()
+        written = upsert_aggregated(connection, aggregated_rows)
+        saved_count += written
+        _ROWS_WRITTEN.observe(written)
+        for row in aggregated_rows:
+            key = (row["common_address"], row["ioa_address"])
+            if key not in latest_by_key or latest_by_key[key][0] < row["timestamp_start"]:
+                latest_by_key[key] = (row["timestamp_start"], row["value"])
+        for common_address, ioa_address, period_minutes, block_to in new_watermarks:
+            key = (common_address, ioa_address, period_minutes)
+            mark = watermarks.get(key)
+            if mark is None:
+                mark = Iec104ExportWatermark(
+                    common_address=common_address,
+                    ioa_address=ioa_address,
+                    period_minutes=period_minutes,
+                    last_block_end=block_to
                 )
-                
-                database_session.add(new_data)
-                saved_count += 1
+                database_session.add(mark)
+                watermarks[key] = mark
+            else:
+                mark.last_block_end = block_to
+        _PERSIST_SECONDS.observe(time.perf_counter() - persist_started)
+
+    # 2. Leer, agregar y convertir (en serie o en paralelo).
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            persist(*compute_export_chunk(*task))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=reset_engine_after_fork) as pool:
+            futures = [pool.submit(_compute_export_chunk_in_worker, *task) for task in tasks]
+            for future in as_completed(futures):
+                aggregated_rows, new_watermarks, worker_metrics = future.result()
+                REGISTRY.merge(worker_metrics)
+                persist(aggregated_rows, new_watermarks)
 
-    # 4. Confirmar todos los cambios.
+    # 4. Confirmar todos los cambios (datos y marcas de agua juntos).
     database_session.commit()
+
+    # 5. Recién confirmado, publicar los últimos valores para el slave.
+    if PUBLISH_LATEST_VALUES:
+        publish_latest_values(enabled_configs, latest_by_key)
     database_session.close()
-    
+    _EXPORT_SECONDS.observe(time.perf_counter() - run_started)
+
     print(f"Proceso de agregación finalizado. Se guardaron {saved_count} datos en el buffer.")
+    print_stage_summary()
+
+    metrics_json = metrics_json or metrics.METRICS_JSON_PATH
+    if metrics_json:
+        REGISTRY.dump_json(metrics_json)
+        print(f"Métricas de la corrida en {metrics_json}")
+
+
+def print_stage_summary() -> None:
+    """Una línea con el tiempo total de cada etapa: DB, CPU o escritura."""
+    snapshot = REGISTRY.snapshot()
+    stages = [
+        ("fetch", "aqua104_fetch_seconds"),
+        ("decode", "aqua104_decode_seconds"),
+        ("agregación", "aqua104_aggregate_seconds"),
+        ("escritura", "aqua104_persist_seconds"),
+        ("total", "aqua104_export_seconds"),
+    ]
+    parts = [
+        f"{label} {sum(sample['value']['sum'] for sample in snapshot.get(name, [])):.2f}s"
+        for label, name in stages
+    ]
+    print("Tiempos: " + ", ".join(parts))
 
 
 if __name__ == "__main__":
-    run_daily_export()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Exportador de datos agregados IEC-104")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="procesos para leer/agregar en paralelo (1 = sin pool)"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+        help="contadores por tarea en modo paralelo"
+    )
+    parser.add_argument(
+        "--aggregate-in-db", action="store_true", default=AGGREGATE_IN_DB,
+        help="calcular los promedios en la DB en lugar de traer los minutos"
+    )
+    parser.add_argument(
+        "--async-fetch", action="store_true", default=ASYNC_FETCH,
+        help="leer los minutos con el engine async, varias consultas a la vez"
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="archivo donde volcar las métricas de la corrida (JSON)"
+    )
+    args = parser.parse_args()
+
+    run_daily_export(
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        aggregate_in_db=args.aggregate_in_db,
+        metrics_json=args.metrics_json,
+        async_fetch=args.async_fetch
+    )
@@ -0,0 +1,186 @@
+# /opt/aqua104/app/master_queue.py
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+from metrics import REGISTRY
+
+# Tramas pendientes por master. Si un enlace no da abasto, se descartan
+# tramas de ese master en lugar de frenar al resto.
+QUEUE_MAX_FRAMES = 2000
+# Plazo total (segundos) para repartir un envío que no se puede perder (una
+# página de la backlog) cuando alguna cola está llena. Es por envío, no por
+# trama: un master lento frena a los demás a lo sumo esto.
+FAN_OUT_BUDGET = 0.5
+# Espera máxima al cerrar una cola (close()).
+CLOSE_TIMEOUT = 0.5
+
+
+class Frame(NamedTuple):
+    """Una trama ya armada: el método del Slave que la envía y sus argumentos."""
+    method: str              # "send_asdu" o "send_gi_response"
+    kwargs: Dict[str, Any]
+
+
+class MasterSendQueue:
+    """
+    Cola acotada y hilo de envío propios de un master. Quien produce
+    (GI, push periódico) no queda atado al enlace: con la cola llena la
+    trama nueva se descarta y se cuenta. El aviso de congestión se da una
+    vez y se levanta cuando la cola vuelve a bajar de la mitad.
+    """
+
+    def __init__(self, slave_server, master_ip: str, max_frames: int = QUEUE_MAX_FRAMES):
+        self.slave_server = slave_server
+        self.master_ip = master_ip
+        self._queue: "queue.Queue[Optional[Frame]]" = queue.Queue(maxsize=max_frames)
+        self._lock = threading.Lock()
+        self._congested = False
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.high_water = 0
+        self._thread = threading.Thread(
+            target=self._drain, name=f"iec104-send-{master_ip}", daemon=True
+        )
+        self._thread.start()
+
+    def offer(self, frame: Frame, deadline: Optional[float] = None) -> bool:
+        """
+        Encola sin esperar; con deadline (time.monotonic()) espera lugar
+        hasta ese momento. False si la trama se descartó.
+        """
+        try:
+            timeout = deadline - time.monotonic() if deadline is not None else 0
+            if timeout > 0:
+                self._queue.put(frame, timeout=timeout)
+            else:
+                self._queue.put_nowait(frame)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                first_drop = not self._congested
+                self._congested = True
+            if first_drop:
+                print(f"Aviso: cola hacia el master {self.master_ip} llena; se descartan tramas.")
+            return False
+
+        with self._lock:
+            self.enqueued += 1
+            depth = self._queue.qsize()
+            self.high_water = max(self.high_water, depth)
+            recovered = self._congested and depth <= self._queue.maxsize // 2
+            if recovered:
+                self._congested = False
+        if recovered:
+            print(f"Cola hacia el master {self.master_ip} normalizada ({self.dropped} tramas descartadas en total).")
+        return True
+
+    def _drain(self) -> None:
+        while True:
+            frame = self._queue.get()
+            try:
+                if frame is None:
+                    return
+                getattr(self.slave_server, frame.method)(remote_ip=self.master_ip, **frame.kwargs)
+                with self._lock:
+                    self.sent += 1
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                print(f"Error enviando al master {self.master_ip}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def join(self) -> None:
+        """Espera a que se envíe todo lo encolado."""
+        self._queue.join()
+
+    def close(self) -> None:
+        """Termina el hilo tras enviar lo pendiente (sin colgarse si el enlace no responde)."""
+        try:
+            self._queue.put(None, timeout=CLOSE_TIMEOUT)
+        except queue.Full:
+            return
+        self._thread.join(timeout=CLOSE_TIMEOUT)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(
+                master=self.master_ip,
+                depth=self._queue.qsize(),
+                capacity=self._queue.maxsize,
+                high_water=self.high_water,
+                enqueued=self.enqueued,
+                sent=self.sent,
+                dropped=self.dropped,
+                errors=self.errors,
+            )
+
+
+class MasterFanOut:
+    """
+    Reparte cada trama a las colas de todos los masters de un listener.
+    La trama (lectura de DB y armado de objetos) se construye una sola vez.
+    Ofrece send_asdu/send_gi_response con la misma firma que el Slave, más
+    remote_ip (sólo a ese master) y deadline (ver MasterSendQueue.offer).
+    Devuelven True si todas las colas destino aceptaron la trama.
+    """
+
+    def __init__(
+        self,
+        slave_server,
+        master_ips: Iterable[str],
+        max_frames: int = QUEUE_MAX_FRAMES,
+        listener: str = ""
+    ):
+        self.listener = listener # para distinguir el mismo master en varios puertos
+        self.queues: List[MasterSendQueue] = [
+            MasterSendQueue(slave_server, ip, max_frames) for ip in dict.fromkeys(master_ips)
+        ]
+        self._by_ip = {master_queue.master_ip: master_queue for master_queue in self.queues}
+        REGISTRY.add_collector(self._collect_metrics)
+
+    def _collect_metrics(self) -> List:
+        samples = []
+        for queue_stats in self.stats():
+            labels = (("listener", self.listener), ("master", queue_stats["master"]))
+            samples += [
+                ("aqua104_master_queue_depth", "gauge", "Tramas esperando en la cola del master", labels, queue_stats["depth"]),
+                ("aqua104_master_queue_high_water", "gauge", "Máximo de tramas en cola", labels, queue_stats["high_water"]),
+                ("aqua104_master_frames_sent_total", "counter", "Tramas enviadas al master", labels, queue_stats["sent"]),
+                ("aqua104_master_frames_dropped_total", "counter", "Tramas descartadas por cola llena", labels, queue_stats["dropped"]),
+                ("aqua104_master_send_errors_total", "counter", "Errores al enviar al master", labels, queue_stats["errors"]),
+            ]
+        return samples
+
+    def deadline(self) -> float:
+        """Vencimiento de FAN_OUT_BUDGET contado desde ahora, para compartir entre tramas."""
+        return time.monotonic() + FAN_OUT_BUDGET
+
+    def _fan_out(self, frame: Frame, remote_ip: Optional[str] = None, deadline: Optional[float] = None) -> bool:
+        # Sin remote_ip, o con una IP que no es de este listener, va a todos.
+        targets = [self._by_ip[remote_ip]] if remote_ip in self._by_ip else self.queues
+        delivered = True
+        for master_queue in targets:
+            delivered = master_queue.offer(frame, deadline) and delivered
+        return delivered
+
+    def send_asdu(self, remote_ip: Optional[str] = None, deadline: Optional[float] = None, **kwargs) -> bool:
+        return self._fan_out(Frame("send_asdu", kwargs), remote_ip, deadline)
+
+    def send_gi_response(self, remote_ip: Optional[str] = None, deadline: Optional[float] = None, **kwargs) -> bool:
+        return self._fan_out(Frame("send_gi_response", kwargs), remote_ip, deadline)
+
+    def join(self) -> None:
+        for master_queue in self.queues:
+            master_queue.join()
+
+    def close(self) -> None:
+        for master_queue in self.queues:
+            master_queue.close()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [master_queue.stats() for master_queue in self.queues]
@@ -0,0 +1,262 @@
+# /opt/aqua104/app/metrics.py
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Puerto HTTP local con /metrics (Prometheus) y /metrics.json. None = sin HTTP.
+METRICS_PORT: Optional[int] = None
+METRICS_HOST = "127.0.0.1"
+# Archivo JSON que escribe el exportador al terminar cada corrida. None = no escribir.
+METRICS_JSON_PATH: Optional[str] = None
+
+# Límites superiores de los buckets por tipo de medida.
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+BYTES_BUCKETS = (1 << 10, 1 << 14, 1 << 17, 1 << 20, 1 << 23, 1 << 26, 1 << 29)
+COUNT_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Histograma acumulativo al estilo Prometheus. observe() es O(log buckets)."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Labels, buckets: Sequence[float]):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)  # el último es +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def state(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(counts=list(self._counts), sum=self._sum)
+
+    def merge(self, state: Dict[str, Any]) -> None:
+        with self._lock:
+            self._counts = [mine + theirs for mine, theirs in zip(self._counts, state["counts"])]
+            self._sum += state["sum"]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts = [0] * len(self._counts)
+            self._sum = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        state = self.state()
+        count = sum(state["counts"])
+        return dict(
+            count=count,
+            sum=state["sum"],
+            mean=state["sum"] / count if count else None,
+            buckets={str(bound): hits for bound, hits in zip(self.buckets + ("+Inf",), state["counts"])},
+        )
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        state = self.state()
+        samples = []
+        cumulative = 0
+        for bound, hits in zip(self.buckets + (float("inf"),), state["counts"]):
+            cumulative += hits
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            samples.append((f"{self.name}_bucket", self.labels + (("le", le),), cumulative))
+        samples.append((f"{self.name}_sum", self.labels, state["sum"]))
+        samples.append((f"{self.name}_count", self.labels, cumulative))
+        return samples
+
+
+class Counter:
+    """Contador monotónico (por convención, el nombre termina en _total)."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Labels):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def state(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(value=self._value)
+
+    def merge(self, state: Dict[str, Any]) -> None:
+        self.inc(state["value"])
+
+    def reset(self) -> None:
+        with self._lock:
+            self._value = 0.0
+
+    def snapshot(self) -> float:
+        return self.state()["value"]
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        return [(self.name, self.labels, self.state()["value"])]
+
+
+class Registry:
+    """
+    Métricas del proceso, identificadas por (nombre, etiquetas). Los
+    collectors se llaman al exportar, para valores que ya se cuentan en
+    otro lado (p. ej. las colas por master): no cuestan nada en caliente.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[Tuple[str, Labels], Any] = {}
+        self._collectors: List[Callable[[], List[Tuple[str, str, str, Labels, float]]]] = []
+        self._lock = threading.Lock()
+
+    def _get(self, factory, name: str, help_text: str, labels: Optional[Dict[str, Any]], *args):
+        key = (name, tuple(sorted((label, str(value)) for label, value in (labels or {}).items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = factory(name, help_text, key[1], *args)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        buckets: Sequence[float] = SECONDS_BUCKETS,
+        labels: Optional[Dict[str, Any]] = None
+    ) -> Histogram:
+        return self._get(Histogram, name, help_text, labels, buckets)
+
+    def counter(self, name: str, help_text: str, labels: Optional[Dict[str, Any]] = None) -> Counter:
+        return self._get(Counter, name, help_text, labels)
+
+    def add_collector(self, collector: Callable[[], List[Tuple[str, str, str, Labels, float]]]) -> None:
+        """collector() -> [(nombre, tipo, ayuda, etiquetas, valor)]"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def reset(self) -> None:
+        """Pone todo en cero; las referencias que guardan los módulos siguen valiendo."""
+        for metric in list(self._metrics.values()):
+            metric.reset()
+
+    # --- traspaso entre procesos (workers del exportador) ---
+
+    def export_state(self) -> List[Tuple[str, str, str, Labels, Any, Dict[str, Any]]]:
+        return [
+            (metric.kind, metric.name, metric.help, metric.labels,
+             getattr(metric, "buckets", None), metric.state())
+            for metric in list(self._metrics.values())
+        ]
+
+    def merge(self, exported: List[Tuple[str, str, str, Labels, Any, Dict[str, Any]]]) -> None:
+        for kind, name, help_text, labels, buckets, state in exported:
+            if kind == "histogram":
+                metric = self.histogram(name, help_text, buckets, dict(labels))
+            else:
+                metric = self.counter(name, help_text, dict(labels))
+            metric.merge(state)
+
+    # --- salida ---
+
+    def snapshot(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        for (name, labels), metric in sorted(self._metrics.items()):
+            result.setdefault(name, []).append(dict(labels=dict(labels), value=metric.snapshot()))
+        for collector in self._collectors:
+            for name, _, _, labels, value in collector():
+                result.setdefault(name, []).append(dict(labels=dict(labels), value=value))
+        return result
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = []
+        described = set()
+
+        def describe(name: str, kind: str, help_text: str) -> None:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        def sample(name: str, labels: Labels, value: float) -> None:
+            label_text = ",".join(f'{label}="{_escape(text)}"' for label, text in labels)
+            lines.append(f"{name}{{{label_text}}} {value!r}" if labels else f"{name} {value!r}")
+
+        for (name, _), metric in sorted(self._metrics.items()):
+            describe(name, metric.kind, metric.help)
+            for sample_name, labels, value in metric.samples():
+                sample(sample_name, labels, value)
+        # Prometheus exige las muestras de un mismo nombre juntas, aunque
+        # vengan de varios collectors (p. ej. un listener por puerto).
+        collected = [sample for collector in self._collectors for sample in collector()]
+        for name, kind, help_text, labels, value in sorted(collected, key=lambda sample: sample[0]):
+            describe(name, kind, help_text)
+            sample(name, labels, float(value))
+        return "\n".join(lines) + "\n"
+
+    def dump_json(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path == "/metrics":
+            body = REGISTRY.render_prometheus().encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body = json.dumps(REGISTRY.snapshot()).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass # sin una línea por scrape
+
+
+def start_http_server(port: Optional[int] = None, host: Optional[str] = None) -> Optional[ThreadingHTTPServer]:
+    """Sirve las métricas en un hilo aparte. None si no hay puerto configurado."""
+    port = METRICS_PORT if port is None else port
+    if port is None:
+        return None
+    server = ThreadingHTTPServer((host or METRICS_HOST, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"Métricas en http://{host or METRICS_HOST}:{server.server_address[1]}/metrics")
+    return server
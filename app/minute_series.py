@@ -0,0 +1,111 @@
+# /opt/aqua104/app/minute_series.py
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+MINUTE_STEP = timedelta(minutes=1)
+
+
+class MinuteSeries:
+    """
+    Serie minuto a minuto sobre un array: values[i] corresponde a
+    start + i minutos. Un año ocupa ~1 MB (2 bytes por minuto) en lugar
+    de una tupla (datetime, int) por minuto; los timestamps se calculan
+    al indexar o iterar.
+
+    valid (opcional) marca los minutos con lectura; sin máscara todos son
+    válidos. La iteración sólo recorre los válidos, indexar no filtra.
+
+    series[i] -> (timestamp, valor)
+    series[desde:hasta] -> MinuteSeries (vista, sin copia); desde/hasta
+    pueden ser posiciones o datetimes.
+    """
+
+    __slots__ = ("start", "values", "valid")
+
+    def __init__(self, start: datetime, values: np.ndarray, valid: Optional[np.ndarray] = None):
+        if valid is not None and len(valid) != len(values):
+            raise ValueError("valid debe tener el mismo largo que values")
+        self.start = start
+        self.values = values
+        self.valid = valid
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    @property
+    def end(self) -> datetime:
+        """Fin exclusivo de la serie."""
+        return self.start + len(self.values) * MINUTE_STEP
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + (self.valid.nbytes if self.valid is not None else 0)
+
+    def position(self, dt: datetime) -> int:
+        """Posición del minuto que contiene dt (puede quedar fuera de la serie)."""
+        return (dt - self.start) // MINUTE_STEP
+
+    def timestamp(self, position: int) -> datetime:
+        return self.start + position * MINUTE_STEP
+
+    def _bound(self, bound: Union[int, datetime, None]) -> Optional[int]:
+        if isinstance(bound, datetime):
+            return min(max(self.position(bound), 0), len(self.values))
+        return bound
+
+    def __getitem__(self, item: Union[int, slice]):
+        if isinstance(item, slice):
+            if item.step not in (None, 1):
+                raise ValueError("MinuteSeries sólo admite paso 1")
+            start, stop, _ = slice(self._bound(item.start), self._bound(item.stop)).indices(len(self.values))
+            stop = max(stop, start)
+            return MinuteSeries(
+                self.timestamp(start),
+                self.values[start:stop],
+                self.valid[start:stop] if self.valid is not None else None
+            )
+
+        position = item + len(self.values) if item < 0 else item
+        if not 0 <= position < len(self.values):
+            raise IndexError("posición fuera de la serie")
+        return self.timestamp(position), int(self.values[position])
+
+    def __iter__(self) -> Iterator[Tuple[datetime, int]]:
+        positions = range(len(self.values)) if self.valid is None else np.flatnonzero(self.valid).tolist()
+        values = self.values.tolist()
+        for position in positions:
+            yield self.timestamp(position), values[position]
+
+    def at(self, dt: datetime) -> Optional[int]:
+        """Valor del minuto que contiene dt, o None si no está o no es válido."""
+        position = self.position(dt)
+        if not 0 <= position < len(self.values):
+            return None
+        if self.valid is not None and not self.valid[position]:
+            return None
+        return int(self.values[position])
+
+    def aligned(self, from_dt: datetime, minutes: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (valores int64, válidos) de `minutes` minutos desde from_dt, listos
+        para aggregator.aggregate_windows. Lo que cae fuera de la serie
+        queda como no válido.
+        """
+        values = np.zeros(minutes, dtype=np.int64)
+        valid = np.zeros(minutes, dtype=bool)
+        offset = self.position(from_dt)
+        first = max(offset, 0)
+        last = min(offset + minutes, len(self.values))
+        if last > first:
+            values[first - offset:last - offset] = self.values[first:last]
+            valid[first - offset:last - offset] = True if self.valid is None else self.valid[first:last]
+        return values, valid
+
+    def tolist(self) -> List[Tuple[datetime, int]]:
+        """La forma anterior de fetch_series: [(timestamp, valor)] de los minutos válidos."""
+        return list(self)
+
+    def __repr__(self) -> str:
+        return f"MinuteSeries(start={self.start.isoformat()}, minutes={len(self.values)})"
@@ -40,6 +40,24 @@ class Counter(Base):
 
     iec104_config = relationship("Iec104Config", back_populates="counter", uselist=False)
 
+class CounterWrite(Base):
+    # Versión de los BLOBs escritos minuto a minuto (ingest.py en SQLite).
+    # Va aparte de counters: cambiar cualquier columna de esa fila en SQLite
+    # la reescribe entera, BLOBs incluidos.
+    __tablename__ = "counter_writes"
+    device_id = Column(Integer, nullable=False)
+    counter_id = Column(Integer, nullable=False)
+    modified = Column(TIMESTAMP, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('device_id', 'counter_id', name='pk_counter_writes'),
+        ForeignKeyConstraint(
+            ['device_id', 'counter_id'],
+            ['counters.device_id', 'counters.id'],
+            ondelete='CASCADE'
+        ),
+    )
+
 class Iec104Config(Base):
     __tablename__ = "iec104_config"
     device_id = Column(Integer, nullable=False)
@@ -98,6 +116,39 @@ class Iec104AggregatedData(Base):
     created_at = Column(DateTime, default=datetime.now)
 
     # Creamos un índice compuesto para consultas rápidas
+    # y uno único que hace idempotente el upsert del exportador (writer.py).
+    # idx_unsent_asdu_ioa_ts sólo contiene las filas no enviadas, en el orden
+    # de las páginas de la GI y con value (e id) dentro: la GI no pasa por la
+    # tabla y su costo sigue al tamaño de la backlog, no al del histórico.
     __table_args__ = (
         Index('idx_asdu_ioa_ts', 'common_address', 'ioa_address', 'timestamp_start'),
-    )
\ No newline at end of file
+        Index(
+            'uq_asdu_ioa_period_ts',
+            'common_address', 'ioa_address', 'period_minutes', 'timestamp_start',
+            unique=True
+        ),
+        Index(
+            'idx_unsent_asdu_ioa_ts',
+            'common_address', 'ioa_address', 'timestamp_start', 'value',
+            sqlite_where=sent_on_gi == False,
+            postgresql_where=sent_on_gi == False,
+            postgresql_include=['id']
+        ),
+    )
+
+class Iec104ExportWatermark(Base):
+    __tablename__ = 'iec104_export_watermark'
+
+    # Misma clave que identifica la serie en Iec104AggregatedData
+    common_address = Column(Integer, nullable=False) # ASDU
+    ioa_address = Column(Integer, nullable=False)
+    period_minutes = Column(Integer, nullable=False)
+
+    # Fin (exclusivo) del último bloque completo exportado.
+    # La próxima ejecución arranca exactamente aquí.
+    last_block_end = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('common_address', 'ioa_address', 'period_minutes', name='pk_iec104_export_watermark'),
+    )
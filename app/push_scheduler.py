@@ -0,0 +1,77 @@
+# /opt/aqua104/app/push_scheduler.py
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Callable, Dict, List, Tuple
+
+from models import Iec104Config
+
+# Piso del intervalo de envío (segundos), por si una config trae un valor absurdo.
+MIN_SEND_INTERVAL = 1
+# Cada cuánto (segundos) se revisa, como máximo, si hay que seguir corriendo.
+IDLE_CHECK_INTERVAL = 1.0
+
+
+def is_pushed(config: Iec104Config) -> bool:
+    """True si la config tiene envío periódico (send_interval > 0)."""
+    return bool(config.send_interval and config.send_interval > 0)
+
+
+class PushScheduler:
+    """
+    Envía sin GI los datos nuevos de cada config cada send_interval segundos
+    (0 o vacío = sólo por GI). Un único heap ordenado por vencimiento: cada
+    envío cuesta O(log n), sin un hilo ni un timer por medidor. Las configs
+    que vencen juntas se envían en una sola pasada por listener.
+    """
+
+    def __init__(self, handlers: List):
+        self._heap: List[Tuple[float, int, object, Iec104Config]] = []
+        self._sequence = itertools.count() # desempate: nunca compara handlers ni configs
+
+        now = time.monotonic()
+        for handler in handlers:
+            for config in handler.configs:
+                if is_pushed(config):
+                    self._schedule(now + self._interval(config), handler, config)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    @staticmethod
+    def _interval(config: Iec104Config) -> float:
+        return max(config.send_interval, MIN_SEND_INTERVAL)
+
+    def _schedule(self, due: float, handler, config: Iec104Config) -> None:
+        heapq.heappush(self._heap, (due, next(self._sequence), handler, config))
+
+    def pop_due(self, now: float) -> Dict[object, List[Iec104Config]]:
+        """Saca las configs vencidas, agrupadas por handler, y las reprograma."""
+        due_by_handler: Dict[object, List[Iec104Config]] = {}
+        while self._heap and self._heap[0][0] <= now:
+            due, _, handler, config = heapq.heappop(self._heap)
+            due_by_handler.setdefault(handler, []).append(config)
+
+            # Se mantiene la grilla del intervalo; si quedó atrás (DB lenta),
+            # se saltan los envíos perdidos en lugar de encadenarlos.
+            interval = self._interval(config)
+            missed = (now - due) // interval
+            self._schedule(due + (missed + 1) * interval, handler, config)
+        return due_by_handler
+
+    async def run(self, keep_running: Callable[[], bool] = lambda: True) -> None:
+        """Corre mientras haya configs con envío periódico y keep_running() sea cierto."""
+        while self._heap and keep_running():
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(min(delay, IDLE_CHECK_INTERVAL))
+                continue
+
+            # Cada listener por su lado: con engine async en el mismo loop,
+            # si no en un hilo (handler.push_due). La DB no bloquea el loop.
+            due_by_handler = self.pop_due(time.monotonic())
+            await asyncio.gather(*(
+                handler.push_due(configs)
+                for handler, configs in due_by_handler.items()
+            ))
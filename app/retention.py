@@ -0,0 +1,314 @@
+# /opt/aqua104/app/retention.py
+import argparse
+import re
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import and_, delete, not_, or_, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from db import engine, get_session
+from models import Iec104AggregatedData, Iec104Config
+
+# Días que se conserva cada período de agregación (minutos -> días).
+# Las filas de 3 minutos son la mayor parte de la tabla: se guardan menos.
+RETENTION_DAYS: Dict[int, int] = {3: 35, 15: 100, 60: 400}
+# Para los períodos que no están en RETENTION_DAYS; None = sin límite.
+DEFAULT_RETENTION_DAYS: Optional[int] = 400
+# Filas por DELETE en la purga: cada lote es su propia transacción, así
+# el exportador y la GI no esperan a una purga larga.
+PURGE_CHUNK_ROWS = 5000
+# Meses (además del actual) con partición ya creada en PostgreSQL.
+PARTITION_MONTHS_AHEAD = 2
+
+UNSENT_INDEX = "idx_unsent_asdu_ioa_ts"
+
+_table = Iec104AggregatedData.__table__
+
+# PostgreSQL: la tabla queda particionada por (period_minutes, timestamp_start),
+# una partición por período y mes. Lo que no cae en ninguna (incluido el
+# histórico previo a la conversión) va a la partición por defecto.
+DEFAULT_PARTITION = f"{_table.name}_default"
+_PARTITION_NAME = re.compile(rf"^{_table.name}_p(\d+)_(\d{{4}})(\d{{2}})$")
+
+# --- helpers ---
+
+def _is_postgres(dialect_name: str) -> bool:
+    return dialect_name in ("postgresql", "postgres")
+
+def _month_start(dt: datetime) -> datetime:
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def _add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+def _partition_name(period_minutes: int, month: datetime) -> str:
+    return f"{_table.name}_p{period_minutes}_{month:%Y%m}"
+
+def _is_partitioned(conn: Connection) -> bool:
+    return conn.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"),
+        {"name": _table.name}
+    ).scalar() == "p"
+
+def _partitions(conn: Connection) -> List[str]:
+    return list(conn.execute(text("""
+        SELECT c.relname
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:name)
+    """), {"name": _table.name}).scalars())
+
+def configured_periods() -> Set[int]:
+    """Períodos de agregación de las configs habilitadas."""
+    session = get_session()
+    try:
+        configs = session.query(Iec104Config).filter(Iec104Config.enabled == True).all()
+        return {period for config in configs for period in config.periods}
+    finally:
+        session.close()
+
+def retention_cutoffs(
+    now: datetime,
+    retention_days: Dict[int, int],
+    default_days: Optional[int]
+) -> Dict[Optional[int], datetime]:
+    """
+    {período: fecha de corte}; las filas con timestamp_start anterior al
+    corte se borran. La clave None es el corte del resto de los períodos.
+    """
+    cutoffs: Dict[Optional[int], datetime] = {
+        period: now - timedelta(days=days) for period, days in retention_days.items()
+    }
+    if default_days is not None:
+        cutoffs[None] = now - timedelta(days=default_days)
+    return cutoffs
+
+# --- API pública ---
+
+def ensure_unsent_index(engine: Engine) -> None:
+    """Crea idx_unsent_asdu_ioa_ts en bases ya existentes (como ensure_upsert_index)."""
+    index = next(index for index in _table.indexes if index.name == UNSENT_INDEX)
+    with engine.begin() as conn:
+        index.create(conn, checkfirst=True)
+
+def partition_table(engine: Engine) -> bool:
+    """
+    PostgreSQL: convierte iec104_aggregated_data en tabla particionada, sin
+    copiar datos: la tabla actual pasa a ser la partición por defecto (sus
+    índices y su secuencia se conservan) y los meses nuevos van a
+    particiones propias (ensure_partitions). El histórico sale de la
+    partición por defecto con la purga por lotes. False si ya lo estaba.
+    """
+    with engine.begin() as conn:
+        if not _is_postgres(conn.dialect.name):
+            raise NotImplementedError("El particionado sólo está disponible en PostgreSQL")
+        if _is_partitioned(conn):
+            return False
+
+        conn.execute(text(f"ALTER TABLE {_table.name} RENAME TO {DEFAULT_PARTITION}"))
+        # Libera los nombres de índice para la tabla nueva.
+        index_names = conn.execute(
+            text("SELECT indexname FROM pg_indexes WHERE tablename = :name"),
+            {"name": DEFAULT_PARTITION}
+        ).scalars().all()
+        for index_name in index_names:
+            conn.execute(text(f'ALTER INDEX "{index_name}" RENAME TO "{index_name}_default"'))
+
+        # La secuencia del id sigue siendo la misma para todas las particiones.
+        sequence = conn.execute(
+            text("SELECT pg_get_serial_sequence(:name, 'id')"), {"name": DEFAULT_PARTITION}
+        ).scalar()
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+
+        # Sin PRIMARY KEY en la tabla madre (tendría que incluir la clave de
+        # partición); el índice único del upsert sí la incluye.
+        conn.execute(text(f"""
+            CREATE TABLE {_table.name} (LIKE {DEFAULT_PARTITION} INCLUDING DEFAULTS)
+            PARTITION BY RANGE (period_minutes, timestamp_start)
+        """))
+        for index in _table.indexes:
+            index.create(conn)
+        # Los índices equivalentes de la partición se asocian, no se reconstruyen.
+        conn.execute(text(f"ALTER TABLE {_table.name} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    return True
+
+def ensure_partitions(
+    engine: Engine,
+    periods: Set[int],
+    now: datetime,
+    months_ahead: int = PARTITION_MONTHS_AHEAD
+) -> List[str]:
+    """
+    Crea las particiones (período, mes) desde el mes actual hasta
+    months_ahead meses adelante. Si la partición por defecto ya tiene filas
+    de ese rango, se mueven a la nueva antes de asociarla.
+    Devuelve los nombres creados.
+    """
+    created = []
+    first_month = _month_start(now)
+    with engine.begin() as conn:
+        if not _is_partitioned(conn):
+            return created
+        existing = set(_partitions(conn))
+
+        for period in sorted(periods):
+            for months in range(months_ahead + 1):
+                month = _add_months(first_month, months)
+                name = _partition_name(period, month)
+                if name in existing:
+                    continue
+                bounds = dict(period=period, lo=month, hi=_add_months(month, 1))
+
+                conn.execute(text(f"CREATE TABLE {name} (LIKE {_table.name} INCLUDING DEFAULTS)"))
+                conn.execute(text(f"""
+                    WITH moved AS (
+                        DELETE FROM {DEFAULT_PARTITION}
+                        WHERE period_minutes = :period
+                          AND timestamp_start >= :lo AND timestamp_start < :hi
+                        RETURNING *
+                    )
+                    INSERT INTO {name} SELECT * FROM moved
+                """), bounds)
+                conn.execute(text(f"""
+                    ALTER TABLE {_table.name} ATTACH PARTITION {name}
+                    FOR VALUES FROM ({period:d}, '{bounds["lo"]:%Y-%m-%d}')
+                    TO ({period:d}, '{bounds["hi"]:%Y-%m-%d}')
+                """))
+                created.append(name)
+    return created
+
+def drop_expired_partitions(engine: Engine, cutoffs: Dict[Optional[int], datetime]) -> List[str]:
+    """Elimina las particiones cuyo mes entero quedó antes del corte de su período."""
+    dropped = []
+    with engine.begin() as conn:
+        if not _is_partitioned(conn):
+            return dropped
+        for name in _partitions(conn):
+            match = _PARTITION_NAME.match(name)
+            if match is None:
+                continue
+            period = int(match.group(1))
+            cutoff = cutoffs.get(period, cutoffs.get(None))
+            month_end = _add_months(datetime(int(match.group(2)), int(match.group(3)), 1), 1)
+            if cutoff is not None and month_end <= cutoff:
+                conn.execute(text(f"DROP TABLE {name}"))
+                dropped.append(name)
+    return dropped
+
+def purge_expired(
+    engine: Engine,
+    cutoffs: Dict[Optional[int], datetime],
+    chunk_rows: int = PURGE_CHUNK_ROWS
+) -> int:
+    """
+    Borra por lotes de chunk_rows las filas anteriores al corte de su
+    período. Con particiones, sólo quedan por borrar el mes que contiene
+    el corte y la partición por defecto. Devuelve las filas borradas.
+    """
+    expired = [
+        and_(_table.c.period_minutes == period, _table.c.timestamp_start < cutoff)
+        for period, cutoff in cutoffs.items() if period is not None
+    ]
+    if None in cutoffs:
+        others = [period for period in cutoffs if period is not None]
+        expired.append(and_(
+            or_(_table.c.period_minutes.is_(None), not_(_table.c.period_minutes.in_(others))),
+            _table.c.timestamp_start < cutoffs[None]
+        ))
+
+    deleted = 0
+    for condition in expired:
+        chunk = select(_table.c.id).where(condition).limit(chunk_rows).scalar_subquery()
+        while True:
+            with engine.begin() as conn:
+                count = conn.execute(delete(_table).where(condition, _table.c.id.in_(chunk))).rowcount
+            deleted += count
+            if count < chunk_rows:
+                break
+    return deleted
+
+def compact(engine: Engine) -> None:
+    """
+    Devuelve al sistema el espacio liberado por la purga: VACUUM completo
+    en SQLite (bloquea la base mientras dura), VACUUM ANALYZE de la tabla
+    en PostgreSQL.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if conn.dialect.name == "sqlite":
+            conn.execute(text("VACUUM"))
+        else:
+            conn.execute(text(f"VACUUM ANALYZE {_table.name}"))
+
+def run_retention(
+    retention_days: Dict[int, int] = RETENTION_DAYS,
+    default_days: Optional[int] = DEFAULT_RETENTION_DAYS,
+    chunk_rows: int = PURGE_CHUNK_ROWS,
+    months_ahead: int = PARTITION_MONTHS_AHEAD,
+    partition: bool = False,
+    vacuum: bool = False,
+    now: Optional[datetime] = None
+) -> Dict[str, int]:
+    """
+    Pasada completa de retención, pensada para cron (p. ej. una vez por día).
+    partition=True convierte antes la tabla (sólo PostgreSQL, una vez).
+    """
+    now = now or datetime.now()
+    cutoffs = retention_cutoffs(now, retention_days, default_days)
+
+    ensure_unsent_index(engine)
+    if partition:
+        partition_table(engine)
+
+    created, dropped = [], []
+    if _is_postgres(engine.dialect.name):
+        created = ensure_partitions(engine, configured_periods(), now, months_ahead)
+        dropped = drop_expired_partitions(engine, cutoffs)
+    deleted = purge_expired(engine, cutoffs, chunk_rows)
+    if vacuum:
+        compact(engine)
+
+    return dict(created=len(created), dropped=len(dropped), deleted=deleted)
+
+def _parse_retention(value: str):
+    period, _, days = value.partition("=")
+    try:
+        return int(period), int(days)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"se espera PERIODO=DIAS, no '{value}'")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retención de iec104_aggregated_data")
+    parser.add_argument(
+        "--retention", type=_parse_retention, action="append", default=[], metavar="PERIODO=DIAS",
+        help=f"días a conservar por período, reemplaza el de RETENTION_DAYS {RETENTION_DAYS}"
+    )
+    parser.add_argument(
+        "--default-days", type=int, default=DEFAULT_RETENTION_DAYS,
+        help="días para los demás períodos (0 = sin límite)"
+    )
+    parser.add_argument("--chunk-rows", type=int, default=PURGE_CHUNK_ROWS, help="filas por DELETE")
+    parser.add_argument(
+        "--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD,
+        help="meses futuros con partición creada (PostgreSQL)"
+    )
+    parser.add_argument(
+        "--partition", action="store_true",
+        help="convertir la tabla en particionada (PostgreSQL, una sola vez)"
+    )
+    parser.add_argument("--vacuum", action="store_true", help="compactar la base después de purgar")
+    args = parser.parse_args()
+
+    summary = run_retention(
+        retention_days={**RETENTION_DAYS, **dict(args.retention)},
+        default_days=args.default_days or None,
+        chunk_rows=args.chunk_rows,
+        months_ahead=args.months_ahead,
+        partition=args.partition,
+        vacuum=args.vacuum
+    )
+    print(
+        f"Retención: {summary['deleted']} filas borradas, "
+        f"{summary['dropped']} particiones eliminadas, {summary['created']} creadas."
+    )
@@ -0,0 +1,165 @@
+# /opt/aqua104/app/segment_cache.py
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+# Presupuesto de memoria de la caché de segmentos (0 = desactivada). Todo
+# lo que escribe los BLOBs en este repo actualiza su versión
+# (counters.modified o counter_writes: ingest.py, import_blobs.py,
+# update_blob.py); un UPDATE a mano que no lo haga deja la caché sirviendo
+# minutos viejos. 64 MiB son unos 23000 contadores-día.
+SEGMENT_CACHE_BYTES = 64 * 1024 * 1024
+# Ante un fallo se lee de la DB la página alineada que contiene lo pedido
+# (un día): así las ventanas deslizantes del exportador, que se solapan
+# con la anterior, caen dentro del mismo segmento.
+SEGMENT_PAGE_MINUTES = 1440
+
+# (device_id, counter_id, field, year)
+SegmentKey = Tuple[int, int, str, int]
+
+
+def page_bounds(start_minute: int, minutes: int) -> Tuple[int, int]:
+    """[start_minute, start_minute + minutes) ampliado a SEGMENT_PAGE_MINUTES: (inicio, minutos)."""
+    page_start = start_minute - start_minute % SEGMENT_PAGE_MINUTES
+    page_end = -(-(start_minute + minutes) // SEGMENT_PAGE_MINUTES) * SEGMENT_PAGE_MINUTES
+    return page_start, page_end - page_start
+
+
+class _Segment(NamedTuple):
+    version: Hashable       # (modified, last_read, written) del contador al leerlo
+    start_minute: int       # minuto del año del primer valor
+    covered_minutes: int    # minutos pedidos (values puede ser más corto: fin del BLOB)
+    values: np.ndarray
+
+
+class SegmentCache:
+    """
+    Caché en proceso de segmentos ya decodificados del BLOB, con desalojo
+    LRU por bytes. Cada entrada guarda la versión del contador
+    (modified, last_read, written; ver fetcher._VERSION_COLUMNS) con la que
+    se leyó: si la versión actual es otra, la entrada se descarta. Los
+    contadores sin versión (todo NULL) no se cachean: no habría forma de
+    notar que cambiaron.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[SegmentKey, _Segment]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(
+        self,
+        key: SegmentKey,
+        version: Hashable,
+        start_minute: int,
+        minutes: int
+    ) -> Optional[np.ndarray]:
+        """
+        Devuelve la vista de [start_minute, start_minute + minutes) si está
+        cubierta por el segmento cacheado con esa misma versión; si no, None.
+        """
+        if not self._versioned(version):
+            with self._lock:
+                if key in self._entries:
+                    self._drop(key)
+                    self.invalidations += 1
+                self.misses += 1
+            return None
+
+        with self._lock:
+            segment = self._entries.get(key)
+            if segment is not None and segment.version != version:
+                self._drop(key)
+                self.invalidations += 1
+                segment = None
+
+            if (
+                segment is None
+                or start_minute < segment.start_minute
+                or start_minute + minutes > segment.start_minute + segment.covered_minutes
+            ):
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            offset = start_minute - segment.start_minute
+            return segment.values[offset:offset + minutes]
+
+    def put(
+        self,
+        key: SegmentKey,
+        version: Hashable,
+        start_minute: int,
+        minutes: int,
+        values: np.ndarray
+    ) -> None:
+        if values.nbytes > self.max_bytes or not self._versioned(version):
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = _Segment(version, start_minute, minutes, values)
+            self._bytes += values.nbytes
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def holds(self, keys: Iterable[SegmentKey]) -> bool:
+        """True si alguna de las claves tiene una entrada (de cualquier versión)."""
+        with self._lock:
+            return any(key in self._entries for key in keys)
+
+    @staticmethod
+    def _versioned(version: Hashable) -> bool:
+        if isinstance(version, tuple):
+            return any(part is not None for part in version)
+        return version is not None
+
+    def invalidate(self, key: Optional[SegmentKey] = None) -> None:
+        """Descarta una entrada, o todas si no se indica clave."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._bytes = 0
+            elif key in self._entries:
+                self._drop(key)
+
+    def _drop(self, key: SegmentKey) -> None:
+        segment = self._entries.pop(key)
+        self._bytes -= segment.values.nbytes
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_ratio=self.hits / lookups if lookups else 0.0,
+                invalidations=self.invalidations,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+            )
+
+
+_cache: Optional[SegmentCache] = None
+
+def get_cache() -> Optional[SegmentCache]:
+    """Caché de proceso según SEGMENT_CACHE_BYTES, o None si está desactivada."""
+    global _cache
+    if SEGMENT_CACHE_BYTES <= 0:
+        return None
+    if _cache is None:
+        _cache = SegmentCache(SEGMENT_CACHE_BYTES)
+    _cache.max_bytes = SEGMENT_CACHE_BYTES
+    return _cache
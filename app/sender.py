@@ -1,6 +1,11 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict
 from datetime import datetime
+from sqlalchemy import select, tuple_, update
 from sqlalchemy.orm import Session
-from typing import Optional, List
+from typing import Dict, Optional, List, Set, Tuple
 
 # --- Importación de la librería c104 ---
 from c104.enums import CauseOfTransmission as COT, TypeId as TI
@@ -9,95 +14,430 @@ from c104.io import I, ASDU, GI
 from c104.timestamp import Timestamp
 from c104.datagram import Datagram
 
-from db import get_session
+from db import dispose_async_engine, get_async_engine, get_session
 from models import Iec104Config, Iec104AggregatedData
+from asdu_packer import pack_objects
+from latest_values import LatestValueReader
+from push_scheduler import IDLE_CHECK_INTERVAL, PushScheduler, is_pushed
+from master_queue import MasterFanOut
+from metrics import COUNT_BUCKETS, REGISTRY, start_http_server
+
+# Parámetros de enlace: ¡ATENCIÓN! Usar los valores que indique la ASG
+ASDU_SIZE = 2  # bytes de la dirección común (ASDU)
+IOA_SIZE = 3   # bytes de la dirección de objeto (IOA)
+COT_SIZE = 2   # bytes de la causa de transmisión
+
+# Filas por página al responder una GI (se envían y marcan página a página).
+GI_PAGE_SIZE = 500
+
+# La GI responde con los valores actuales de la tabla en memoria
+# (latest_values.py) y recorre la backlog de la DB de las configs sin envío
+# periódico (send_interval 0 o vacío), que no tienen otra vía; la del resto
+# sale por el push. Con True la GI recorre la backlog de todas. Nunca se
+# repiten los bloques que ya salieron de memoria. Sin tabla publicada la
+# GI siempre usa la backlog completa.
+GI_SEND_BACKLOG = False
+
+# Causa con la que el scheduler empuja valores nuevos sin que el Master
+# pregunte (push_scheduler.py). Son bloques con marca de tiempo: espontáneos.
+PUSH_COT = COT.SPONTANEOUS
+
+# Puerto por defecto si la configuración no trae uno.
+DEFAULT_PORT = 2404
+
+_GI_SECONDS = REGISTRY.histogram("aqua104_gi_seconds", "Duración de la respuesta a una GI")
+_GI_FRAMES = REGISTRY.histogram("aqua104_gi_frames", "ASDUs enviados por GI", COUNT_BUCKETS)
+_GI_OBJECTS = REGISTRY.histogram("aqua104_gi_objects", "Objetos de información enviados por GI", COUNT_BUCKETS)
+_PUSH_SECONDS = REGISTRY.histogram("aqua104_push_seconds", "Duración de un envío periódico")
+_PUSH_OBJECTS = REGISTRY.counter("aqua104_push_objects_total", "Objetos enviados por el envío periódico")
+
+# --- RUTEO ASDU/IOA ---
+
+def build_routes(configs: List[Iec104Config]) -> Dict[int, Dict[int, Tuple[Iec104Config, int]]]:
+    """
+    Tabla de ruteo precalculada: ASDU -> IOA -> (config, periodo en minutos).
+    Usa el mismo esquema que el exportador: IOA base + índice del periodo.
+    """
+    routes: Dict[int, Dict[int, Tuple[Iec104Config, int]]] = defaultdict(dict)
+    for config in configs:
+        for ioa_offset, window_minutes in enumerate(config.periods):
+            routes[config.common_address][config.information_object_address + ioa_offset] = (config, window_minutes)
+    return dict(routes)
+
+def group_by_port(configs: List[Iec104Config]) -> Dict[int, List[Iec104Config]]:
+    """Las configs que comparten puerto se sirven desde un mismo listener."""
+    configs_by_port: Dict[int, List[Iec104Config]] = defaultdict(list)
+    for config in configs:
+        configs_by_port[config.local_port or DEFAULT_PORT].append(config)
+    return dict(configs_by_port)
+
+def master_ips(configs: List[Iec104Config]) -> List[str]:
+    """IPs de los masters (redundantes) autorizados para estas configs."""
+    return sorted({
+        ip
+        for config in configs
+        for ip in (config.remote_ip_1, config.remote_ip_2)
+        if ip
+    })
 
 # --- CLASE HANDLER: GESTIONA LA LÓGICA DE DATOS ---
 
 class Aqua104DataHandler:
     """
-    Gestiona los callbacks del protocolo IEC 104 que interactúan con la DB.
+    Gestiona los callbacks del protocolo IEC 104 que interactúan con la DB,
+    para todos los ASDU servidos por un mismo listener.
     """
-    def __init__(self, config: Iec104Config, slave_server):
-        self.config = config
+    def __init__(self, configs: List[Iec104Config], slave_server):
+        self.configs = configs
         self.slave_server = slave_server # Referencia al objeto Slave para enviar
+        # Una cola y un hilo de envío por master: un enlace lento no frena al otro.
+        self.outbox = MasterFanOut(
+            slave_server,
+            master_ips(configs),
+            listener=str(configs[0].local_port or DEFAULT_PORT) if configs else ""
+        )
+        self.routes = build_routes(configs)
+        self.latest = LatestValueReader() # Últimos valores publicados por el exportador
+        # La GI (hilo del listener) y el push periódico marcan las mismas
+        # filas como enviadas: no deben recorrer la backlog a la vez.
+        self.send_lock = threading.Lock()
+        # Event loop del slave cuando hay engine async (run_iec104_slave):
+        # la GI y el push corren ahí y se serializan con async_send_lock.
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.async_send_lock = asyncio.Lock()
+
+    def _send_packed(
+        self,
+        asdu: ASDU,
+        info_objects: List,
+        cot,
+        remote_ip: Optional[str] = None,
+        deadline: Optional[float] = None
+    ) -> Tuple[int, bool]:
+        """
+        Envía objetos M_ME_TD_1 agrupados en ASDUs, a remote_ip o a todos los
+        masters. Devuelve (tramas, True si todas las colas aceptaron todas).
+        """
+        frame_count = 0
+        delivered = True
+        # Envío de las tramas: varios objetos por ASDU, hasta llenar el APDU.
+        for packed in pack_objects(
+            info_objects,
+            ioa_of=lambda info_object: info_object.ioa,
+            type_name=TI.M_ME_TD_1.name,
+            ioa_size=IOA_SIZE,
+            asdu_size=ASDU_SIZE,
+            cot_size=COT_SIZE
+        ):
+            delivered = self.outbox.send_asdu(
+                remote_ip=remote_ip,
+                deadline=deadline,
+                asdu=asdu,
+                ti=TI.M_ME_TD_1, 
+                io=packed.objects,
+                sequence=packed.sequence,
+                cot=cot
+            ) and delivered
+            frame_count += 1
+        return frame_count, delivered
+
+    def _current_values(self, common_address: int) -> Optional[List[Tuple[int, float, datetime, int]]]:
+        """
+        Valores actuales del ASDU desde la memoria compartida, como
+        (ioa, valor, timestamp, calidad), o None si el exportador todavía
+        no publicó la tabla.
+        """
+        table = self.latest.table()
+        if table is None:
+            return None
+        ioa_routes = self.routes.get(common_address, {})
+        return [
+            (ioa, value, timestamp, quality)
+            for (_, ioa), (value, timestamp, quality) in table.items(asdu=common_address)
+            if ioa in ioa_routes
+        ]
+
+    @staticmethod
+    def _gi_page_query(
+        common_address: int,
+        after: Optional[Tuple[int, datetime]],
+        ioa_addresses: Optional[List[int]] = None
+    ):
+        """
+        Siguiente página de datos no enviados, paginando por clave
+        (ioa_address, timestamp_start) en lugar de OFFSET. Se traen sólo
+        columnas (no objetos ORM), así la sesión no acumula la backlog.
+        Con ioa_addresses se limita a esas IOA del ASDU.
+        """
+        query = (
+            select(
+                Iec104AggregatedData.id,
+                Iec104AggregatedData.ioa_address,
+                Iec104AggregatedData.timestamp_start,
+                Iec104AggregatedData.value
+            )
+            .where(
+                Iec104AggregatedData.common_address == common_address,
+                Iec104AggregatedData.sent_on_gi == False
+            )
+        )
+        if ioa_addresses is not None:
+            query = query.where(Iec104AggregatedData.ioa_address.in_(ioa_addresses))
+        if after is not None:
+            query = query.where(
+                tuple_(Iec104AggregatedData.ioa_address, Iec104AggregatedData.timestamp_start)
+                > tuple_(*after)
+            )
+        return (
+            query.order_by(
+                Iec104AggregatedData.ioa_address,
+                Iec104AggregatedData.timestamp_start
+            )
+            .limit(GI_PAGE_SIZE)
+        )
+
+    def _fetch_gi_page(
+        self,
+        session: Session,
+        common_address: int,
+        after: Optional[Tuple[int, datetime]],
+        ioa_addresses: Optional[List[int]] = None
+    ) -> List:
+        return session.execute(self._gi_page_query(common_address, after, ioa_addresses)).all()
+
+    @staticmethod
+    def _page_objects(page: List) -> List:
+        """Arma cada dato de la página como M_ME_TD_1 (Valor Normalizado con Time Tag)."""
+        info_objects = []
+        for data in page:
+            # Calidad (Quality Flags): Asumimos válido (0)
+            quality_flags = 0 
+            
+            # Usamos el timestamp_start del bloque de datos
+            timestamp = Timestamp.from_datetime(data.timestamp_start)
+            
+            # Crear el objeto de información (I) para enviar
+            # Usamos TI.M_ME_TD_1 (Type Identification 13: Valor normalizado con tiempo)
+            info_objects.append(I(
+                ioa=data.ioa_address,
+                normalized_value=data.value, 
+                quality=quality_flags,
+                timestamp=timestamp
+            ))
+        return info_objects
+
+    @staticmethod
+    def _unskipped(page: List, skip: Optional[Set[Tuple[int, datetime]]]) -> List:
+        if not skip:
+            return page
+        return [data for data in page if (data.ioa_address, data.timestamp_start) not in skip]
+
+    @staticmethod
+    def _mark_sent(page: List):
+        # Marcar la página como enviada con un único UPDATE.
+        # Los id no son contiguos en orden (ioa, timestamp), por eso
+        # se marcan por lista de id y no por rango. El rango de timestamps
+        # de la página deja fuera las particiones de otros meses (retention.py).
+        return (
+            update(Iec104AggregatedData)
+            .where(
+                Iec104AggregatedData.id.in_([data.id for data in page]),
+                Iec104AggregatedData.timestamp_start.between(
+                    min(data.timestamp_start for data in page),
+                    max(data.timestamp_start for data in page)
+                )
+            )
+            .values(sent_on_gi=True)
+        )
+
+    def _send_unsent(
+        self,
+        session: Session,
+        asdu: ASDU,
+        cot,
+        ioa_addresses: Optional[List[int]] = None,
+        skip: Optional[Set[Tuple[int, datetime]]] = None
+    ) -> Tuple[int, int]:
+        """
+        Envía los datos no enviados del ASDU y los marca como enviados.
+        Los bloques (ioa, timestamp) de skip ya salieron por otra vía: se
+        marcan sin reenviarlos. Devuelve (objetos, ASDUs). Se llama con
+        send_lock tomado.
+
+        Una página sólo se marca si todas las colas la aceptaron (con
+        FAN_OUT_BUDGET de espera en total). Si un master no da abasto, la
+        página queda sin marcar para el próximo envío o GI, y se corta la
+        pasada: las páginas siguientes tampoco entrarían.
+        """
+        sent_count = 0
+        frame_count = 0
+
+        # Recorrer los datos no enviados página a página: el primer
+        # frame sale apenas llega la primera página, no al final de la query.
+        last_key = None
+        while True:
+            page = self._fetch_gi_page(session, asdu.value, last_key, ioa_addresses)
+            if not page:
+                break
+
+            info_objects = self._page_objects(self._unskipped(page, skip))
+            frames, delivered = self._send_packed(asdu, info_objects, cot, deadline=self.outbox.deadline())
+            if not delivered:
+                print(f"Aviso: backlog del ASDU {asdu.value} sin entregar a todos los masters; se reintenta en el próximo envío.")
+                break
+            frame_count += frames
+            sent_count += len(info_objects)
+
+            session.execute(self._mark_sent(page))
+            session.commit()
+
+            last_key = (page[-1].ioa_address, page[-1].timestamp_start)
+
+        return sent_count, frame_count
+
+    async def _send_unsent_async(
+        self,
+        asdu: ASDU,
+        cot,
+        ioa_addresses: Optional[List[int]] = None,
+        skip: Optional[Set[Tuple[int, datetime]]] = None
+    ) -> Tuple[int, int]:
+        """
+        _send_unsent con el engine async. Mientras se arma y encola una
+        página ya se está pidiendo la siguiente (por clave, así que no
+        depende de que la anterior esté marcada). Se llama con async_send_lock.
+        Encolar una página puede esperar FAN_OUT_BUDGET: se hace en un hilo
+        para no frenar el event loop (las GI y envíos de los demás listeners).
+        """
+        sent_count = 0
+        frame_count = 0
+
+        async_engine = get_async_engine()
+        async with async_engine.connect() as reader, async_engine.connect() as writer:
+            async def fetch(after):
+                return (await reader.execute(self._gi_page_query(asdu.value, after, ioa_addresses))).all()
+
+            page = await fetch(None)
+            while page:
+                last_key = (page[-1].ioa_address, page[-1].timestamp_start)
+                next_page = asyncio.create_task(fetch(last_key)) if len(page) == GI_PAGE_SIZE else None
+
+                info_objects = self._page_objects(self._unskipped(page, skip))
+                frames, delivered = await asyncio.to_thread(
+                    self._send_packed, asdu, info_objects, cot, None, self.outbox.deadline()
+                )
+                if not delivered:
+                    if next_page is not None:
+                        await next_page # no dejar la lectura a medias en la conexión
+                    print(f"Aviso: backlog del ASDU {asdu.value} sin entregar a todos los masters; se reintenta en el próximo envío.")
+                    break
+                frame_count += frames
+                sent_count += len(info_objects)
+
+                await writer.execute(self._mark_sent(page))
+                await writer.commit()
+
+                page = await next_page if next_page is not None else []
+
+        return sent_count, frame_count
+
+    @staticmethod
+    def _ioas_by_asdu(configs: List[Iec104Config]) -> Dict[int, List[int]]:
+        ioas_by_asdu: Dict[int, List[int]] = defaultdict(list)
+        for config in configs:
+            ioas_by_asdu[config.common_address].extend(
+                config.information_object_address + ioa_offset
+                for ioa_offset, _ in enumerate(config.periods)
+            )
+        return ioas_by_asdu
+
+    def push_new_values(self, configs: List[Iec104Config]) -> int:
+        """
+        Envío periódico sin GI (push_scheduler.py): los datos no enviados de
+        las IOA de estas configs, con causa PUSH_COT. Devuelve cuántos objetos salieron.
+        """
+        ioas_by_asdu = self._ioas_by_asdu(configs)
+
+        session = get_session()
+        sent_count = 0
+        started = time.perf_counter()
+        try:
+            with self.send_lock:
+                for common_address, ioa_addresses in ioas_by_asdu.items():
+                    pushed, _ = self._send_unsent(
+                        session, ASDU(common_address), PUSH_COT, sorted(ioa_addresses)
+                    )
+                    sent_count += pushed
+        except Exception as e:
+            print(f"Error en el envío periódico: {e}")
+            session.rollback()
+        finally:
+            session.close()
+            _PUSH_SECONDS.observe(time.perf_counter() - started)
+            _PUSH_OBJECTS.inc(sent_count)
+        return sent_count
+
+    async def push_new_values_async(self, configs: List[Iec104Config]) -> int:
+        """push_new_values en el event loop del slave, con el engine async."""
+        sent_count = 0
+        started = time.perf_counter()
+        try:
+            async with self.async_send_lock:
+                for common_address, ioa_addresses in self._ioas_by_asdu(configs).items():
+                    pushed, _ = await self._send_unsent_async(
+                        ASDU(common_address), PUSH_COT, sorted(ioa_addresses)
+                    )
+                    sent_count += pushed
+        except Exception as e:
+            print(f"Error en el envío periódico: {e}")
+        finally:
+            _PUSH_SECONDS.observe(time.perf_counter() - started)
+            _PUSH_OBJECTS.inc(sent_count)
+        return sent_count
+
+    async def push_due(self, configs: List[Iec104Config]) -> int:
+        """Para push_scheduler: en el event loop si hay engine async, si no en un hilo."""
+        if self.loop is not None:
+            return await self.push_new_values_async(configs)
+        return await asyncio.to_thread(self.push_new_values, configs)
 
     # El callback principal que maneja la Interrogación General (GI)
     def on_gi(self, asdu: ASDU, gi: GI) -> None:
         """
         CALLBACK: Se ejecuta cuando el Master (PSIprins) envía C_IC_NA_1.
+        Con engine async la GI se responde en el event loop del slave y el
+        hilo del listener queda libre de inmediato.
         """
+        # ActCon, valores actuales y ActTerm van sólo al master que preguntó.
+        remote_ip = self._requester(gi)
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.on_gi_async(asdu, remote_ip), self.loop)
+            return
+
         session: Optional[Session] = None
-        sent_count = 0
+        started = time.perf_counter()
         
         try:
             conn_id = 1 # c104 normalmente maneja la conexión internamente
 
-            print(f"\n Master solicitó Interrogación General (GI) para ASDU {asdu.value}.")
-            session = get_session()
-            
-            # 1. QUERY DE LA DB: Traer todos los datos agregados y no enviados.
-            data_to_send: List[Iec104AggregatedData] = (
-                session.query(Iec104AggregatedData)
-                .filter(
-                    Iec104AggregatedData.common_address == self.config.common_address,
-                    Iec104AggregatedData.sent_on_gi == False
-                )
-                .order_by(
-                    Iec104AggregatedData.ioa_address,
-                    Iec104AggregatedData.timestamp_start
-                )
-                .all()
-            )
-            
-            # 2. Enviar respuesta de 'Activación' de la GI (Act/Con)
-            # Esto debe hacerse antes de enviar los datos
-            self.slave_server.send_gi_response(
-                asdu=asdu, 
-                ti=TI.C_IC_NA_1,
-                cot=COT.ACTIVATION_CON
-            )
-
-            # 3. Enviar cada dato como M_ME_TD_1 (Valor Normalizado con Time Tag)
-            for data in data_to_send:
-                # Calidad (Quality Flags): Asumimos válido (0)
-                quality_flags = 0 
-                
-                # Usamos el timestamp_start del bloque de datos
-                timestamp = Timestamp.from_datetime(data.timestamp_start)
-                
-                # Crear el objeto de información (I) para enviar
-                # Usamos TI.M_ME_TD_1 (Type Identification 13: Valor normalizado con tiempo)
-                info_object = I(
-                    ioa=data.ioa_address,
-                    normalized_value=data.value, 
-                    quality=quality_flags,
-                    timestamp=timestamp
-                )
+            begun = self._begin_gi(asdu, remote_ip)
+            if begun is None:
+                return
+            sent_from_memory, sent_count, frame_count = begun
 
-                # Envío de la Trama
-                self.slave_server.send_asdu(
-                    asdu=asdu,
-                    ti=TI.M_ME_TD_1, 
-                    io=info_object,
-                    cot=COT.SPONTANEOUS # La GI se responde con COT Spontaneous
-                )
-                
-                # 4. Marcar como enviado y actualizar la DB
-                data.sent_on_gi = True
-                session.add(data)
-                sent_count += 1
-                
-            session.commit()
-            
-            # 5. Enviar respuesta de 'Terminación' de la GI (Act/Term)
-            self.slave_server.send_gi_response(
-                asdu=asdu, 
-                ti=TI.C_IC_NA_1, 
-                cot=COT.ACTIVATION_TERM
-            )
+            # 3. La backlog de datos no enviados, en el orden de la DB.
+            backlog_ioas = self._gi_backlog_ioas(asdu.value, sent_from_memory)
+            if backlog_ioas is None or backlog_ioas:
+                session = get_session()
+                with self.send_lock:
+                    backlog_count, backlog_frames = self._send_unsent(
+                        session, asdu, COT.SPONTANEOUS, # La GI se responde con COT Spontaneous
+                        backlog_ioas, skip=sent_from_memory
+                    )
+                sent_count += backlog_count
+                frame_count += backlog_frames
 
-            print(f"GI finalizada. Enviados {sent_count} objetos de información.")
+            self._end_gi(asdu, sent_count, frame_count, started, remote_ip)
             
         except Exception as e:
             print(f"Error en el manejo de GI: {e}")
@@ -107,53 +447,295 @@ class Aqua104DataHandler:
             if session:
                 session.close()
 
+    async def on_gi_async(self, asdu: ASDU, remote_ip: Optional[str] = None) -> None:
+        """
+        on_gi en el event loop del slave: mientras espera a la DB no ocupa un
+        hilo. _begin_gi/_end_gi encolan sin esperar, así que pueden correr
+        en el loop; la backlog se encola desde un hilo (_send_unsent_async).
+        """
+        started = time.perf_counter()
+        try:
+            begun = self._begin_gi(asdu, remote_ip)
+            if begun is None:
+                return
+            sent_from_memory, sent_count, frame_count = begun
+
+            backlog_ioas = self._gi_backlog_ioas(asdu.value, sent_from_memory)
+            if backlog_ioas is None or backlog_ioas:
+                async with self.async_send_lock:
+                    backlog_count, backlog_frames = await self._send_unsent_async(
+                        asdu, COT.SPONTANEOUS, backlog_ioas, skip=sent_from_memory
+                    )
+                sent_count += backlog_count
+                frame_count += backlog_frames
+
+            self._end_gi(asdu, sent_count, frame_count, started, remote_ip)
+        except Exception as e:
+            print(f"Error en el manejo de GI: {e}")
+
+    def _gi_backlog_ioas(
+        self,
+        common_address: int,
+        sent_from_memory: Optional[Set[Tuple[int, datetime]]]
+    ) -> Optional[List[int]]:
+        """
+        IOA del ASDU cuya backlog recorre la GI: todas (None) si no hay tabla
+        en memoria o con GI_SEND_BACKLOG; si no, las de configs sin envío
+        periódico. Lista vacía = la GI no toca la backlog.
+        """
+        if GI_SEND_BACKLOG or sent_from_memory is None:
+            return None
+        configs = [
+            config for config in self.configs
+            if config.common_address == common_address and not is_pushed(config)
+        ]
+        return sorted(self._ioas_by_asdu(configs).get(common_address, []))
+
+    @staticmethod
+    def _requester(gi: GI) -> Optional[str]:
+        """IP del master que envió C_IC_NA_1 (None si c104 no la informa: va a todos)."""
+        return getattr(gi, "remote_ip", None)
+
+    def _begin_gi(
+        self,
+        asdu: ASDU,
+        remote_ip: Optional[str] = None
+    ) -> Optional[Tuple[Optional[Set[Tuple[int, datetime]]], int, int]]:
+        """
+        Pasos 1 y 2 de la GI. Devuelve (bloques (ioa, timestamp) enviados
+        desde memoria, o None si no hay tabla; objetos; ASDUs enviados), o
+        None si el ASDU no es de este listener.
+        Nunca espera por una cola llena: lo que no entra se descarta.
+        """
+        print(f"\n Master solicitó Interrogación General (GI) para ASDU {asdu.value}.")
+        common_address = asdu.value
+        if common_address not in self.routes:
+            print(f"ASDU {common_address} no está configurado en este listener. GI ignorada.")
+            return None
+
+        # 1. Enviar respuesta de 'Activación' de la GI (Act/Con)
+        # Esto debe hacerse antes de enviar los datos
+        self.outbox.send_gi_response(
+            remote_ip=remote_ip,
+            asdu=asdu, 
+            ti=TI.C_IC_NA_1,
+            cot=COT.ACTIVATION_CON
+        )
+
+        # 2. Valores actuales directo de memoria, sin tocar la DB.
+        current_values = self._current_values(common_address)
+        sent_count = 0
+        frame_count = 0
+        if current_values:
+            info_objects = [
+                I(
+                    ioa=ioa,
+                    normalized_value=value,
+                    quality=quality,
+                    timestamp=Timestamp.from_datetime(timestamp)
+                )
+                for ioa, value, timestamp, quality in current_values
+            ]
+            frames, _ = self._send_packed(asdu, info_objects, COT.INTERROGATED_BY_STATION, remote_ip)
+            frame_count += frames
+            sent_count += len(info_objects)
+        if current_values is None:
+            return None, sent_count, frame_count
+        return {(ioa, timestamp) for ioa, _, timestamp, _ in current_values}, sent_count, frame_count
+
+    def _end_gi(
+        self,
+        asdu: ASDU,
+        sent_count: int,
+        frame_count: int,
+        started: float,
+        remote_ip: Optional[str] = None
+    ) -> None:
+        # 5. Enviar respuesta de 'Terminación' de la GI (Act/Term)
+        self.outbox.send_gi_response(
+            remote_ip=remote_ip,
+            asdu=asdu, 
+            ti=TI.C_IC_NA_1, 
+            cot=COT.ACTIVATION_TERM
+        )
+
+        _GI_SECONDS.observe(time.perf_counter() - started)
+        _GI_FRAMES.observe(frame_count)
+        _GI_OBJECTS.observe(sent_count)
+        print(f"GI finalizada. Enviados {sent_count} objetos de información en {frame_count} ASDUs.")
+
+    # Lectura puntual (C_RD_NA_1) de una IOA
+    def on_read(self, asdu: ASDU, ioa: int) -> None:
+        """
+        CALLBACK: el Master pide el valor actual de una IOA.
+        Se responde con el último bloque agregado de esa IOA.
+        """
+        route = self.routes.get(asdu.value, {}).get(ioa)
+        if route is None:
+            print(f"Lectura de IOA desconocida: ASDU {asdu.value}, IOA {ioa}.")
+            return
+
+        # Primero la tabla en memoria; la DB sólo si el exportador no la publicó.
+        table = self.latest.table()
+        latest = table.get(asdu.value, ioa) if table is not None else None
+
+        session = None
+        try:
+            if latest is None:
+                session = get_session()
+                data = (
+                    session.query(
+                        Iec104AggregatedData.timestamp_start,
+                        Iec104AggregatedData.value
+                    )
+                    .filter(
+                        Iec104AggregatedData.common_address == asdu.value,
+                        Iec104AggregatedData.ioa_address == ioa
+                    )
+                    .order_by(Iec104AggregatedData.timestamp_start.desc())
+                    .first()
+                )
+                if data is None:
+                    return
+                latest = (data.value, data.timestamp_start, 0)
+
+            value, timestamp, quality = latest
+            self.outbox.send_asdu(
+                asdu=asdu,
+                ti=TI.M_ME_TD_1,
+                io=[I(
+                    ioa=ioa,
+                    normalized_value=value,
+                    quality=quality,
+                    timestamp=Timestamp.from_datetime(timestamp)
+                )],
+                sequence=False,
+                cot=COT.REQUEST
+            )
+        except Exception as e:
+            print(f"Error en la lectura de IOA {ioa}: {e}")
+        finally:
+            if session:
+                session.close()
+
 # --- FUNCIÓN PRINCIPAL DEL SERVIDOR ---
 
+def _serve(slave_server, port: int) -> None:
+    """Corre un listener; un fallo no tumba a los demás."""
+    try:
+        slave_server.run()
+    except Exception as e:
+        print(f"Fallo grave del servidor en puerto TCP/{port}: {e}")
+
+async def _run_event_loop(handlers: List[Aqua104DataHandler], scheduler: PushScheduler, keep_running) -> None:
+    """
+    Event loop del slave: el envío periódico y, si hay engine async, las
+    GI de todos los listeners. Corre mientras keep_running() sea cierto.
+    """
+    if get_async_engine() is not None:
+        loop = asyncio.get_running_loop()
+        for handler in handlers:
+            handler.loop = loop
+    try:
+        if len(scheduler):
+            await scheduler.run(keep_running)
+        while keep_running():
+            await asyncio.sleep(IDLE_CHECK_INTERVAL)
+    finally:
+        for handler in handlers:
+            handler.loop = None
+        await dispose_async_engine()
+
 def run_iec104_slave():
-    """Inicializa y corre el servidor IEC 104 Slave."""
+    """
+    Inicializa y corre el servidor IEC 104 Slave para TODAS las
+    configuraciones habilitadas: un listener por puerto, que atiende
+    todos los ASDU configurados en ese puerto.
+    """
     session = get_session()
     
-    # 1. Obtener la primera configuración activa (ASDU)
-    config: Iec104Config = (
+    # 1. Obtener todas las configuraciones activas (ASDU)
+    configs: List[Iec104Config] = (
         session.query(Iec104Config)
         .filter(Iec104Config.enabled == True)
-        .first()
+        .all()
     )
     session.close()
 
-    if not config:
+    if not configs:
         print("ERROR: No se encontró configuración IEC 104 habilitada en la DB.")
         return
 
-    # 2. Inicializar el Servidor Slave con las IPs y puerto.
-    # El puerto y la IP se configuran directamente.
-    slave_server = Slave(
-        host='0.0.0.0', 
-        port=config.local_port,
-        asdu_address=config.common_address, # Se establece el ASDU principal
-        asdu_size=2,  # ¡ATENCIÓN! Usar el valor que indique la ASG
-        ioa_size=3    # ¡ATENCIÓN! Usar el valor que indique la ASG
-    )
+    # Métricas en Prometheus (/metrics) si METRICS_PORT está configurado.
+    start_http_server()
 
-    # 3. Configurar las IPs Master permitidas (redundancia)
-    slave_server.add_master(config.remote_ip_1)
-    slave_server.add_master(config.remote_ip_2)
-    
-    # 4. Asignar el Handler personalizado al servidor
-    handler = Aqua104DataHandler(config, slave_server)
-    slave_server.set_gi_handler(handler.on_gi) # El handler de la Interrogación General
+    listeners = []
+    handlers = []
+    for port, port_configs in group_by_port(configs).items():
+        asdu_addresses = sorted({config.common_address for config in port_configs})
+        masters = master_ips(port_configs)
+
+        # 2. Inicializar el Servidor Slave del puerto, con todos sus ASDU.
+        slave_server = Slave(
+            host='0.0.0.0', 
+            port=port,
+            asdu_address=asdu_addresses[0], # Se establece el ASDU principal
+            asdu_size=ASDU_SIZE,
+            ioa_size=IOA_SIZE
+        )
+        for asdu_address in asdu_addresses[1:]:
+            slave_server.add_asdu(asdu_address)
 
-    # 5. Iniciar el Servidor
+        # 3. Configurar las IPs Master permitidas (redundancia)
+        for ip in masters:
+            slave_server.add_master(ip)
+        
+        # 4. Asignar el Handler personalizado al servidor
+        handler = Aqua104DataHandler(port_configs, slave_server)
+        slave_server.set_gi_handler(handler.on_gi) # El handler de la Interrogación General
+        slave_server.set_read_handler(handler.on_read)
+
+        print(f"IEC 104 Slave en puerto TCP/{port}: ASDU {asdu_addresses}")
+        print(f"Masters autorizados: {', '.join(masters)}")
+        listeners.append((port, slave_server))
+        handlers.append(handler)
+
+    # 5. Iniciar los Servidores (un hilo por puerto)
+    threads = []
     try:
-        print(f"Iniciando IEC 104 Slave en puerto TCP/{config.local_port}...")
-        print(f"Masters autorizados: {config.remote_ip_1}, {config.remote_ip_2}")
-        slave_server.run()
+        for port, slave_server in listeners:
+            thread = threading.Thread(
+                target=_serve, args=(slave_server, port), name=f"iec104-{port}", daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+
+        # 6. Envío periódico según send_interval y, con engine async, las
+        # GI en el mismo event loop (bloquea mientras corran los listeners)
+        scheduler = PushScheduler(handlers)
+        if len(scheduler):
+            print(f"Envío periódico activo para {len(scheduler)} configuraciones.")
+        if get_async_engine() is not None:
+            print("GI y envío periódico con consultas async a la DB.")
+        if len(scheduler) or get_async_engine() is not None:
+            asyncio.run(_run_event_loop(
+                handlers, scheduler,
+                keep_running=lambda: any(thread.is_alive() for thread in threads)
+            ))
+
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
     except KeyboardInterrupt:
         print("Servidor detenido por el usuario.")
-    except Exception as e:
-        print(f"Fallo grave del servidor: {e}")
     finally:
-        slave_server.stop()
+        for _, slave_server in listeners:
+            slave_server.stop()
+        for handler in handlers:
+            handler.outbox.close()
+            for queue_stats in handler.outbox.stats():
+                if queue_stats["dropped"]:
+                    print(f"Master {queue_stats['master']}: {queue_stats['dropped']} tramas descartadas por cola llena.")
 
 if __name__ == "__main__":
     run_iec104_slave()
\ No newline at end of file
@@ -0,0 +1,140 @@
+# /opt/aqua104/app/sql_aggregator.py
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import text
+
+from db import engine
+from fetcher import FETCH_CHUNK_SIZE, MINUTE_DTYPE, _pairs_params, _pairs_sql, blob_start_pos, minutes_between
+
+# Nombre de la función registrada en cada conexión SQLite.
+SQLITE_AVG_FUNCTION = "aqua104_avg_u16be"
+
+Blocks = Tuple[np.ndarray, np.ndarray]  # (offsets, promedios), igual que aggregator
+
+
+def _avg_u16be(raw: Optional[bytes]) -> Optional[float]:
+    """UDF de SQLite: promedio de un segmento de minutos '>u2', o NULL si está vacío."""
+    if not raw or len(raw) < 2:
+        return None
+    values = np.frombuffer(raw, dtype=MINUTE_DTYPE, count=len(raw) // 2)
+    # Suma entera y una división: el mismo redondeo que aggregator.
+    return int(values.sum(dtype=np.int64)) / len(values)
+
+
+def _register_sqlite_functions(conn) -> None:
+    conn.connection.driver_connection.create_function(
+        SQLITE_AVG_FUNCTION, 1, _avg_u16be, deterministic=True
+    )
+
+
+def _block_averages_sql(dialect: str, field: str, pair_count: int) -> str:
+    """
+    Un renglón por (contador, bloque) con el promedio ya calculado.
+    :start/:length delimitan el tramo en el BLOB (1-based, en bytes) y
+    :window_bytes el tamaño de cada bloque.
+    """
+    if dialect in ("postgresql", "postgres"):
+        return f"""
+            SELECT s.device_id, s.id, g.i / :window_minutes AS block,
+                   CAST(AVG(get_byte(s.raw, 2 * g.i) * 256 + get_byte(s.raw, 2 * g.i + 1)) AS DOUBLE PRECISION) AS average
+            FROM (
+                SELECT device_id, id, SUBSTRING({field} FROM :start FOR :length) AS raw
+                FROM counters
+                WHERE (device_id, id) IN (VALUES {_pairs_sql(pair_count)})
+            ) AS s
+            CROSS JOIN LATERAL generate_series(0, length(s.raw) / 2 - 1) AS g(i)
+            GROUP BY s.device_id, s.id, block
+            ORDER BY s.device_id, s.id, block
+        """
+    if dialect == "sqlite":
+        # El segmento se materializa una vez por contador: si no, cada
+        # bloque vuelve a leer el BLOB anual completo. AS MATERIALIZED
+        # requiere SQLite >= 3.35.
+        return f"""
+            WITH RECURSIVE
+            segments AS MATERIALIZED (
+                SELECT device_id, id, SUBSTR({field}, :start, :length) AS raw
+                FROM counters
+                WHERE (device_id, id) IN (VALUES {_pairs_sql(pair_count)})
+            ),
+            blocks(k) AS (
+                SELECT 0
+                UNION ALL
+                SELECT k + 1 FROM blocks WHERE k + 1 < :block_count
+            )
+            SELECT s.device_id, s.id, k AS block,
+                   {SQLITE_AVG_FUNCTION}(SUBSTR(s.raw, 1 + k * :window_bytes, :window_bytes)) AS average
+            FROM segments AS s, blocks
+            ORDER BY s.device_id, s.id, block
+        """
+    raise NotImplementedError(f"DB dialect '{dialect}' no soportado")
+
+
+def aggregate_windows_in_db(
+    pairs: Iterable[Tuple[int, int]],
+    windows: Sequence[int],
+    from_dt: datetime,
+    to_dt: datetime,
+    field: str = "kumuliertedaten",
+    block_ranges: Optional[Dict[int, Tuple[int, int]]] = None
+) -> Dict[Tuple[int, int], Dict[int, Blocks]]:
+    """
+    Alternativa a fetch_series_many + aggregator.aggregate_windows: los
+    promedios por bloque se calculan en la DB y sólo viaja un renglón por
+    bloque (1/60 de los datos para bloques de 60 minutos).
+
+    Mismo resultado por contador: {ventana: (offsets, promedios)}, offsets
+    en minutos relativos a from_dt, último bloque posiblemente incompleto y
+    sin los bloques que no tienen minutos en el BLOB.
+    """
+    keys = list(dict.fromkeys(pairs))
+    empty: Blocks = (np.empty(0, dtype=np.int64), np.empty(0))
+    result: Dict[Tuple[int, int], Dict[int, Blocks]] = {
+        key: {window_minutes: empty for window_minutes in windows} for key in keys
+    }
+    minutes = minutes_between(from_dt, to_dt)
+    if minutes <= 0 or not keys:
+        return result
+
+    dialect = engine.dialect.name
+    with engine.connect() as conn:
+        if dialect == "sqlite":
+            _register_sqlite_functions(conn)
+
+        for window_minutes in windows:
+            if window_minutes <= 0:
+                continue
+            range_start, range_end = (block_ranges or {}).get(window_minutes, (0, minutes))
+            range_start, range_end = max(range_start, 0), min(range_end, minutes)
+            if range_end <= range_start:
+                continue
+
+            params = dict(
+                start=blob_start_pos(from_dt) + range_start * 2,
+                length=(range_end - range_start) * 2,
+                window_minutes=window_minutes,
+                window_bytes=window_minutes * 2,
+                block_count=-(-(range_end - range_start) // window_minutes),
+            )
+            for chunk_start in range(0, len(keys), FETCH_CHUNK_SIZE):
+                chunk = keys[chunk_start:chunk_start + FETCH_CHUNK_SIZE]
+                rows = conn.execute(
+                    text(_block_averages_sql(dialect, field, len(chunk))),
+                    dict(params, **_pairs_params(chunk))
+                )
+
+                blocks_by_key: Dict[Tuple[int, int], List[Tuple[int, float]]] = {}
+                for device_id, counter_id, block, average in rows:
+                    if average is not None:
+                        blocks_by_key.setdefault((device_id, counter_id), []).append((block, average))
+
+                for key, blocks in blocks_by_key.items():
+                    block_numbers, averages = zip(*blocks)
+                    result[key][window_minutes] = (
+                        range_start + np.asarray(block_numbers, dtype=np.int64) * window_minutes,
+                        np.asarray(averages, dtype=float),
+                    )
+
+    return result
@@ -1,15 +1,55 @@
-def convert_value(value: float, unit: str) -> float:
+from functools import lru_cache
+from typing import NamedTuple
+
+
+class UnitScale(NamedTuple):
+    """Paso de l/min (la unidad de los BLOBs) a otra unidad: valor * multiplier / divisor."""
+    multiplier: float
+    divisor: float
+
+    def apply(self, values):
+        """Convierte un valor o un array entero de una vez."""
+        return values * self.multiplier / self.divisor
+
+
+# Unidades soportadas. Multiplicar y dividir (en lugar de un único factor)
+# da exactamente los mismos valores que la conversión de siempre.
+UNITS = {
+    "l/min": UnitScale(1.0, 1.0),
+    "l/s": UnitScale(1.0, 60.0),
+    "l/h": UnitScale(60.0, 1.0),
+    "m3/min": UnitScale(1.0, 1000.0),
+    "m3/h": UnitScale(60.0, 1000.0),
+    "m3/d": UnitScale(1440.0, 1000.0),
+}
+
+# Otras formas de escribir las mismas unidades (ya en minúsculas y sin espacios).
+UNIT_ALIASES = {
+    "l/m": "l/min",
+    "lpm": "l/min",
+    "l/sec": "l/s",
+    "l/seg": "l/s",
+    "lps": "l/s",
+    "l/hr": "l/h",
+    "m³/min": "m3/min",
+    "m³/h": "m3/h",
+    "m3/hr": "m3/h",
+    "cbm/h": "m3/h",
+    "m³/d": "m3/d",
+    "m3/día": "m3/d",
+    "m3/dia": "m3/d",
+}
+
+
+@lru_cache(maxsize=None)
+def unit_scale(unit: str) -> UnitScale:
     """
-    Convierte un valor en l/min a la unidad deseada.
-    Soporta: l/min, l/s, m3/min, m3/h.
+    Resuelve flow_unit (o uno de sus alias) a su UnitScale. Se calcula una
+    vez por unidad distinta; error si la unidad no se conoce.
     """
-    if unit == "l/min":
-        return value
-    elif unit == "l/s":
-        return value / 60.0
-    elif unit == "m3/min":
-        return value / 1000.0
-    elif unit == "m3/h":
-        return value * 60.0 / 1000.0
-    else:
+    key = "".join(unit.split()).lower() if unit else ""
+    key = UNIT_ALIASES.get(key, key)
+    if key not in UNITS:
         raise ValueError(f"Unidad de flujo no soportada: {unit}")
+    return UNITS[key]
+
@@ -1,4 +1,5 @@
 import os
+from datetime import datetime
 from sqlalchemy import text
 from db import get_session
 from sqlalchemy.exc import IntegrityError 
@@ -28,10 +29,11 @@ def update_counter_blob():
         # 2. Actualizar el BLOB en la tabla 'counters'
         print(f"Leyendo {len(blob_data)} bytes del archivo...")
         
-        # Sentencia UPDATE SQL
+        # Sentencia UPDATE SQL. modified cambia con el BLOB: es la versión
+        # con la que la caché de segmentos y el almacén local detectan el cambio.
         UPDATE_SQL = text("""
             UPDATE counters 
-            SET kumuliertedaten = :data 
+            SET kumuliertedaten = :data, modified = :modified
             WHERE device_id = :device_id AND id = :counter_id;
         """)
 
@@ -39,6 +41,7 @@ def update_counter_blob():
             UPDATE_SQL,
             {
                 "data": blob_data, 
+                "modified": datetime.now(),
                 "device_id": DEVICE_ID, 
                 "counter_id": COUNTER_ID
             }
@@ -0,0 +1,160 @@
+# /opt/aqua104/app/writer.py
+import csv
+import io
+from typing import Dict, List, Sequence
+
+from sqlalchemy import case, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import Iec104AggregatedData
+
+# Clave de unicidad de un dato agregado (índice uq_asdu_ioa_period_ts).
+UPSERT_KEY = ("common_address", "ioa_address", "period_minutes", "timestamp_start")
+UPSERT_COLUMNS = UPSERT_KEY + ("value",)
+
+# Filas por executemany.
+UPSERT_BATCH_SIZE = 5000
+# A partir de cuántas filas conviene COPY + tabla staging en PostgreSQL.
+COPY_MIN_ROWS = 5000
+
+STAGING_TABLE = "iec104_aggregated_staging"
+
+_table = Iec104AggregatedData.__table__
+
+# --- helpers ---
+
+def _is_postgres(dialect_name: str) -> bool:
+    return dialect_name in ("postgresql", "postgres")
+
+def _upsert_statement(dialect_name: str):
+    """
+    INSERT ... ON CONFLICT (clave) DO UPDATE para SQLite o PostgreSQL.
+    Si el valor recalculado cambió, se vuelve a marcar como no enviado;
+    si es el mismo (re-ejecución), el flag sent_on_gi queda como estaba.
+    """
+    if dialect_name == "sqlite":
+        stmt = sqlite.insert(_table)
+    elif _is_postgres(dialect_name):
+        stmt = postgresql.insert(_table)
+    else:
+        raise NotImplementedError(f"DB dialect '{dialect_name}' no soportado")
+
+    return stmt.on_conflict_do_update(
+        index_elements=list(UPSERT_KEY),
+        set_={
+            "value": stmt.excluded.value,
+            "sent_on_gi": case(
+                (_table.c.value != stmt.excluded.value, False),
+                else_=_table.c.sent_on_gi
+            ),
+        },
+    )
+
+def _last_per_key(rows: List[Dict]) -> List[Dict]:
+    """
+    Una fila por UPSERT_KEY, la última. Un mismo INSERT ... ON CONFLICT no
+    puede tocar dos veces la misma fila en PostgreSQL (y executemany arma
+    VALUES de varias filas); SQLite se quedaría con la última.
+    """
+    last_by_key = {tuple(row[column] for column in UPSERT_KEY): row for row in rows}
+    return rows if len(last_by_key) == len(rows) else list(last_by_key.values())
+
+def _copy_upsert(connection: Connection, rows: Sequence[Dict]) -> None:
+    """
+    PostgreSQL + psycopg2: COPY a una tabla temporal y un único
+    INSERT ... SELECT ... ON CONFLICT desde ahí.
+    """
+    columns = ", ".join(UPSERT_COLUMNS)
+    key = ", ".join(UPSERT_KEY)
+
+    connection.execute(text(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} (
+            common_address INTEGER,
+            ioa_address INTEGER,
+            period_minutes INTEGER,
+            timestamp_start TIMESTAMP,
+            value DOUBLE PRECISION
+        ) ON COMMIT DELETE ROWS
+    """))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            row["common_address"],
+            row["ioa_address"],
+            row["period_minutes"],
+            row["timestamp_start"].isoformat(sep=" "),
+            repr(float(row["value"])),
+        ])
+    buffer.seek(0)
+
+    cursor = connection.connection.driver_connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {STAGING_TABLE} ({columns}) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+    finally:
+        cursor.close()
+
+    # Las filas ya llegan sin claves repetidas (_last_per_key).
+    connection.execute(text(f"""
+        INSERT INTO {_table.name} ({columns}, sent_on_gi, created_at)
+        SELECT {columns}, FALSE, NOW()
+        FROM {STAGING_TABLE}
+        ON CONFLICT ({key}) DO UPDATE SET
+            value = EXCLUDED.value,
+            sent_on_gi = CASE
+                WHEN {_table.name}.value <> EXCLUDED.value THEN FALSE
+                ELSE {_table.name}.sent_on_gi
+            END
+    """))
+    connection.execute(text(f"TRUNCATE {STAGING_TABLE}"))
+
+# --- API pública ---
+
+def upsert_aggregated(connection: Connection, rows: List[Dict]) -> int:
+    """
+    Escribe en bloque filas de Iec104AggregatedData (dicts con las claves de
+    UPSERT_COLUMNS) de forma idempotente sobre la clave UPSERT_KEY. Si una
+    clave viene repetida gana la última fila, en todos los dialectos.
+    No hace commit: usa la transacción de `connection`.
+    Devuelve la cantidad de filas procesadas (sin repetidas).
+    """
+    if not rows:
+        return 0
+    rows = _last_per_key(rows)
+
+    dialect_name = connection.dialect.name
+    if (
+        _is_postgres(dialect_name)
+        and connection.dialect.driver == "psycopg2"
+        and len(rows) >= COPY_MIN_ROWS
+    ):
+        _copy_upsert(connection, rows)
+        return len(rows)
+
+    stmt = _upsert_statement(dialect_name)
+    for batch_start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        connection.execute(stmt, rows[batch_start:batch_start + UPSERT_BATCH_SIZE])
+    return len(rows)
+
+def ensure_upsert_index(engine: Engine) -> None:
+    """
+    Crea el índice único en bases ya existentes (create_all no agrega
+    índices a tablas que ya estaban). Antes elimina duplicados que hayan
+    dejado versiones anteriores del exportador, conservando el más reciente.
+    """
+    key = ", ".join(UPSERT_KEY)
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            DELETE FROM {_table.name}
+            WHERE id NOT IN (
+                SELECT MAX(id) FROM {_table.name} GROUP BY {key}
+            )
+        """))
+        conn.execute(text(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS uq_asdu_ioa_period_ts ON {_table.name} ({key})"
+        ))